@@ -1,7 +1,16 @@
 import os
+import re
+import json
+import socket
+import signal
+import threading
+import time
 import unittest
 import sys
 import tempfile
+import shutil
+import configparser
+import paramiko
 from collections import OrderedDict
 from contextlib import contextmanager
 
@@ -16,7 +25,8 @@ from unittest.mock import patch, Mock, call
 import tunirlib
 from tunirlib.tunirutils import Result, system
 from tunirlib import main
-from tunirlib import tunirutils, tunirmultihost, tunirvagrant
+from tunirlib import tunirutils, tunirmultihost, tunirvagrant, tunirnet, tunirqmp, tunirbake, tunirscratch
+from tunirlib import tunirreap, tunirsample, tunirhistory, tunircompare, tunirartifacts, tunirfleet
 
 
 @contextmanager
@@ -51,6 +61,12 @@ class StupidArgs(object):
         self.image_dir = None
         self.multi = None
         self.debug = False
+        self.boot_bench = 0
+        self.bake = None
+        self.reap = False
+        self.history = None
+        self.history_db = ''
+        self.compare = None
 
 
 class TunirTests(unittest.TestCase):
@@ -72,6 +88,14 @@ class TunirTests(unittest.TestCase):
         with captured_output() as (out, err):
             self.assertFalse(tunirutils.match_vm_numbers(vms, path))
             self.assertIn('vm2', out.getvalue())
+        tdir = tempfile.mkdtemp()
+        path = os.path.join(tdir, 'job.txt')
+        with open(path, 'w') as fobj:
+            fobj.write('vm1 ls /\nREBOOT vm1 timeout=60\nPOLL vm5\n')
+        with captured_output() as (out, err):
+            self.assertFalse(tunirutils.match_vm_numbers(['vm1', 'vm2'], path))
+            self.assertIn('vm5', out.getvalue())
+        tunirutils.clean_tmp_dirs([tdir, ])
 
     def test_ansible(self):
         "test old style ansible function"
@@ -90,6 +114,54 @@ class TunirTests(unittest.TestCase):
         self.assertIn('vm2 ansible_ssh_host=192.168.1.102 ansible_ssh_user=fedora\n', data)
         self.assertIn('vm1 ansible_ssh_host=192.168.1.100 ansible_ssh_user=fedora\n', data)
         self.assertIn('[web]\nvm1\nvm2', data)
+        vms['vm2'].update({'host_string': '127.0.0.1', 'port': '10023'})
+        tdir = tempfile.mkdtemp()
+        new_inventory = os.path.join(tdir, 'tunir_ansible')
+        tunirutils.create_ansible_inventory(vms, new_inventory)
+        with open(new_inventory) as fobj:
+            data = fobj.read()
+        tunirutils.clean_tmp_dirs([tdir, ])
+        self.assertIn('vm2 ansible_ssh_host=127.0.0.1 ansible_ssh_user=fedora ansible_ssh_port=10023\n', data)
+
+    def test_ansible_config(self):
+        "the ansible.cfg of the job, what the ansible_dir gives stays"
+        vms = OrderedDict((name, {'ip': '192.168.1.10', 'user': 'fedora'}) for name in ('vm1', 'vm2', 'vm3'))
+        tdir = tempfile.mkdtemp()
+        with open(os.path.join(tdir, 'ansible.cfg'), 'w') as fobj:
+            fobj.write('[defaults]\nroles_path = ./roles\ngathering = explicit\n')
+        path = tunirutils.create_ansible_config(vms, tdir, '/tmp/private.pem')
+        parser = configparser.RawConfigParser()
+        parser.read(path)
+        tunirutils.clean_tmp_dirs([tdir, ])
+        self.assertEqual(path, os.path.join(tdir, 'ansible.cfg'))
+        self.assertEqual(parser.get('defaults', 'inventory'), os.path.join(tdir, 'tunir_ansible'))
+        self.assertEqual(parser.get('defaults', 'private_key_file'), '/tmp/private.pem')
+        self.assertEqual(parser.get('defaults', 'forks'), '3')
+        self.assertEqual(parser.get('defaults', 'roles_path'), './roles')
+        self.assertEqual(parser.get('defaults', 'gathering'), 'explicit')
+        self.assertEqual(parser.get('defaults', 'fact_caching_connection'), os.path.join(tdir, 'facts'))
+        self.assertEqual(parser.get('ssh_connection', 'pipelining'), 'True')
+        self.assertIn('ControlPersist=60s', parser.get('ssh_connection', 'ssh_args'))
+
+    @patch('tunirlib.tunirutils.subprocess.run')
+    def test_ansible_directive(self, p_run):
+        config = tunirutils.TunirConfig()
+        config.vms = {'vm1': {'ip': '192.168.1.10', 'user': 'fedora'}}
+        with self.assertRaises(ValueError):
+            tunirutils.ansible_directive('ANSIBLE site.yml', config)
+        config.general['ansible_config'] = '/tmp/seed/ansible.cfg'
+        p_run.return_value = Mock(returncode=2, stdout='PLAY RECAP\nvm1 : ok=1 failed=1\n')
+        result, seconds = tunirutils.ansible_directive("ANSIBLE site.yml --tags 'a b'", config)
+        args, kwargs = p_run.call_args
+        self.assertEqual(args[0], ['ansible-playbook', 'site.yml', '--tags', 'a b'])
+        self.assertEqual(kwargs['cwd'], '/tmp/seed')
+        self.assertEqual(kwargs['env']['ANSIBLE_CONFIG'], '/tmp/seed/ansible.cfg')
+        self.assertEqual(result.return_code, 2)
+        self.assertIn('vm1 : ok=1 failed=1\nPlaybook site.yml took ', result.text)
+        self.assertGreaterEqual(seconds, 0)
+        p_run.side_effect = FileNotFoundError('ansible-playbook')
+        result, seconds = tunirutils.ansible_directive('PLAYBOOK site.yml', config)
+        self.assertEqual(result.return_code, 127)
 
     @patch('tunirlib.tunirutils.run')
     @patch('codecs.open')
@@ -138,19 +210,228 @@ class TunirTests(unittest.TestCase):
         c5.returncode = 0
         p_usystem.side_effect = [c1, c2, c3, c4, c5]
 
-        with captured_output() as (out, err):
+        tdir = tempfile.mkdtemp()
+        with captured_output() as (out, err), \
+                patch('tunirlib.tunirnet.LEASE_PATH', os.path.join(tdir, 'leases.json')), \
+                patch('tunirlib.tunirreap.RUNS_DIR', tdir), \
+                patch('tunirlib.tunirhistory.HISTORY_PATH', os.path.join(tdir, 'history.db')), \
+                patch('tunirlib.tunirmultihost.wait_ready', return_value=True) as p_ready:
             tunirmultihost.start_multihost('multihost', './testvalues/multihost.txt',
                                            debug=False, config_dir='./testvalues/')
 
             data = out.getvalue()
+        self.assertEqual(p_ready.call_count, 2)
+        # The run cleaned up after itself, nothing for the reaper
+        self.assertEqual([name for name in os.listdir(tdir) if name.startswith('run-')], [])
         self.assertIn("Passed:1", data)
         self.assertIn("Job status: True", data)
         self.assertIn("bin/ls", data)
+        self.assertIn("vm2 profile: default", data)
         for filename in ['./current_run_info.json', ]:
             self.assertTrue(os.path.exists(filename), filename)
         last_call = p_system.call_args_list[-1]
         self.assertEqual(last_call, call("touch /tmp/hostcommand.txt",))
+        with open(os.path.join(tdir, 'leases.json')) as fobj:
+            self.assertEqual(json.load(fobj)['leases'], {})
+        history = tunirhistory.History(os.path.join(tdir, 'history.db'))
+        self.assertEqual(len(history.runs('multihost')), 1)
+        history.close()
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+
+    @patch('tunirlib.tunirutils.run')
+    @patch('os.system')
+    @patch('time.sleep')
+    @patch('tunirlib.tunirqmp.os.kill')
+    @patch('tunirlib.tunirmultihost.create_seed_img')
+    @patch('tunirlib.tunirmultihost.create_vm_seed')
+    @patch('tunirlib.tunirmultihost.boot_qcow2')
+    def test_multihost_user_key(self, p_br, p_seed, p_img, p_kill, p_sleep, p_system, p_run):
+        "user mode network with the key from the configuration"
+        p_br.return_value = (StupidProcess(), tunirnet.USER_MAC)
+        r1 = Result("bin")
+        r1.return_code = 0
+        p_run.return_value = r1
+        tdir = tempfile.mkdtemp()
+        private_key, public_key = tunirmultihost.generate_sshkey()
+        with open(os.path.join(tdir, 'id_rsa'), 'w') as fobj:
+            fobj.write(private_key)
+        with open(os.path.join(tdir, 'userkey.cfg'), 'w') as fobj:
+            fobj.write('[general]\nnetwork = user\nkey = {0}\nresult_path = {1}\n\n'.format(
+                os.path.join(tdir, 'id_rsa'), os.path.join(tdir, 'result.txt')))
+            for name in ('vm1', 'vm2'):
+                fobj.write('[{0}]\nuser = fedora\nimage = /tmp/Fedora.qcow2\n\n'.format(name))
+        jobpath = os.path.join(tdir, 'userkey.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('vm1 ls /\nvm2 ls /\n')
+        with captured_output() as (out, err), \
+                patch('tunirlib.tunirnet.LEASE_PATH', os.path.join(tdir, 'leases.json')), \
+                patch('tunirlib.tunirmultihost.wait_ready', return_value=True):
+            status = tunirmultihost.start_multihost('userkey', jobpath, config_dir=tdir)
+        self.assertTrue(status)
+        self.assertEqual(p_seed.call_count, 2)
+        self.assertEqual(p_seed.call_args[0][2].split()[:2], public_key.split()[:2])
+        for boot in p_br.call_args_list:
+            self.assertIn('mcast=230.0.0.1', ' '.join(boot[1]['netargs']))
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+    def test_profiles(self):
+        "qemu performance profiles"
+        profile = tunirmultihost.read_profile({'profile': 'bench'}, {'cache': 'unsafe'})
+        self.assertEqual(profile['cache'], 'unsafe')
+        self.assertEqual(profile['aio'], 'io_uring')
+        self.assertEqual(tunirmultihost.read_profile({'profile': 'bench'}, {'profile': 'default'}),
+                         {'name': 'default'})
+        with self.assertRaises(ValueError):
+            tunirmultihost.read_profile({'profile': 'turbo'}, {})
+        args = tunirmultihost.profile_args(profile, 'a.qcow2', 'seed.img', 1024, '4')
+        self.assertEqual(args[:2], ['-cpu', 'host'])
+        self.assertIn('file=a.qcow2,if=none,id=disk0,cache=unsafe,aio=io_uring', args)
+        self.assertIn('virtio-blk-pci,drive=disk0,iothread=io0,num-queues=4', args)
+        self.assertEqual(tunirmultihost.disk_name(profile), 'disk0')
+        self.assertEqual(tunirmultihost.profile_args({}, 'a.qcow2', 'seed.img', 1024, '1'),
+                         ['-drive', 'file=a.qcow2,if=virtio', '-drive', 'file=seed.img,if=virtio'])
+        self.assertEqual(tunirmultihost.network_args('00:16:3e:0a:00:0a', profile=profile, vcpu='4'),
+                         ['-netdev', 'bridge,id=net0,br=virbr0,vhost=on,queues=4',
+                          '-device', 'virtio-net-pci,netdev=net0,mac=00:16:3e:0a:00:0a,mq=on,vectors=10'])
+        self.assertEqual(tunirmultihost.profile_text({'name': 'fast', 'cache': 'unsafe'}), 'fast (cache=unsafe)')
+
+    def test_fastboot(self):
+        "direct kernel boot options"
+        self.assertEqual(tunirmultihost.fastboot_args({}, {'image': 'a.qcow2'}), [])
+        args = tunirmultihost.fastboot_args({'kernel': '/boot/vmlinuz', 'initrd': '/boot/initrd.img'},
+                                            {'append': 'root=/dev/vda5 console=ttyS0'})
+        self.assertEqual(args, ['-machine', 'microvm,pcie=on,accel=kvm', '-kernel', '/boot/vmlinuz',
+                                '-initrd', '/boot/initrd.img', '-append', 'root=/dev/vda5 console=ttyS0'])
+        args = tunirmultihost.fastboot_args({'kernel': '/boot/vmlinuz'}, {'machine': 'q35'})
+        self.assertEqual(args[:2], ['-machine', 'q35,accel=kvm'])
+        self.assertEqual(args[-1], 'root=/dev/vda1 ro console=ttyS0 quiet')
+
+    @patch('tunirlib.tunirmultihost.start_multihost')
+    def test_boot_benchmark(self, p_start):
+        "boot times with and without the kernel"
+        def fake_start(jobname, jobpath, config_dir, fastboot, stats):
+            stats['boot'] = {'vm1': 3.0 if fastboot else 30.0}
+            return True
+        p_start.side_effect = fake_start
+        with captured_output() as (out, err):
+            times = tunirmultihost.boot_benchmark('fedora', './testvalues/', 2)
+        self.assertEqual(times, {'fastboot': [3.0, 3.0], 'firmware': [30.0, 30.0]})
+        self.assertIn('fastboot: min 3.00 median 3.00 max 3.00 (2 boots)', out.getvalue())
+
+    @patch('tunirlib.tunirmultihost.create_seed_img')
+    def test_address_plan(self, p_seed):
+        "static addresses and /etc/hosts from cloud-init"
+        config = tunirutils.TunirConfig()
+        config.general = {'address_plan': '192.168.122.200/24'}
+        config.vms = OrderedDict([('vm1', {'user': 'fedora', 'image': 'a.qcow2'}),
+                                  ('db', {'user': 'fedora', 'ip': '10.0.0.5'}),
+                                  ('vm2', {'user': 'fedora', 'image': 'a.qcow2', 'hostname': 'web'})])
+        plan = tunirmultihost.plan_addresses(config)
+        self.assertEqual(list(plan.keys()), ['vm1', 'vm2'])
+        self.assertEqual(plan['vm2'], {'ip': '192.168.122.201', 'mac': '00:16:3e:28:7a:c9',
+                                       'prefix': '24', 'gateway': '192.168.122.1'})
+        hosts = tunirmultihost.create_hosts_text(OrderedDict((name, dict(config.vms[name], **plan.get(name, {})))
+                                                             for name in config.vms))
+        self.assertEqual(hosts, "\n192.168.122.200    vm1\n10.0.0.5    db\n192.168.122.201    vm2 web\n")
+        tdir = tempfile.mkdtemp()
+        tunirmultihost.create_vm_seed(tdir, 'web', 'ssh-rsa AAAA', plan['vm2'], hosts)
+        with open(os.path.join(tdir, 'meta', 'network-config')) as fobj:
+            self.assertIn('"192.168.122.201/24"', fobj.read())
+        with open(os.path.join(tdir, 'meta', 'user-data')) as fobj:
+            self.assertIn('tunir-hosts', fobj.read())
+        with open(os.path.join(tdir, 'meta', 'meta-data')) as fobj:
+            self.assertIn('local-hostname: web', fobj.read())
+        tunirutils.clean_tmp_dirs([tdir, ])
+        config.general['address_plan'] = '192.168.122.254/24'
+        with self.assertRaises(tunirutils.IPException):
+            tunirmultihost.plan_addresses(config)
+
+
+class LeaseTests(unittest.TestCase):
+    """
+    Tests the MAC/IP lease registry.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tdir, 'leases.json')
+
+    def tearDown(self):
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    def test_unique_leases(self):
+        one = tunirnet.LeaseRegistry(self.path)
+        two = tunirnet.LeaseRegistry(self.path)
+        two.pid = 1 # init never goes away
+        macs = [one.acquire_mac('vm1'), two.acquire_mac('vm1'), one.acquire_mac('vm2')]
+        self.assertEqual(len(set(macs)), 3)
+        self.assertEqual(one.acquire_ip('vm3', '192.168.122.200/24'), ('192.168.122.200', '00:16:3e:28:7a:c8'))
+        self.assertEqual(two.acquire_ip('vm2', '192.168.122.200/24')[0], '192.168.122.201')
+        one.release()
+        # We do not hand out the released MAC again right away
+        self.assertNotIn(one.acquire_mac('vm1'), macs)
+        self.assertEqual(one.acquire_ip('vm3', '192.168.122.200/24')[0], '192.168.122.200')
+
+    def test_runtime_path(self):
+        "normal users get their own lease file"
+        self.assertEqual(tunirnet.runtime_path(self.path), self.path)
+        with patch('tunirlib.tunirnet.os.access', return_value=False), \
+                patch.dict(os.environ, {'XDG_RUNTIME_DIR': self.tdir}):
+            self.assertEqual(tunirnet.runtime_path('/var/run/tunir/leases.json'),
+                             os.path.join(self.tdir, 'tunir', 'leases.json'))
+        self.assertTrue(os.path.isdir(os.path.join(self.tdir, 'tunir')))
+
+    def test_lease_path(self):
+        "the users on the bridge share one lease file"
+        with patch('tunirlib.tunirnet.os.access', side_effect=lambda path, mode: path == '/var/lib/tunir'):
+            self.assertEqual(tunirnet.lease_path(), tunirnet.SHARED_LEASE_PATH)
+        with patch('tunirlib.tunirnet.os.access', return_value=False):
+            with self.assertRaises(OSError):
+                tunirnet.lease_path('bridge')
+            with patch.dict(os.environ, {'XDG_RUNTIME_DIR': self.tdir}):
+                self.assertEqual(tunirnet.lease_path('user'), os.path.join(self.tdir, 'tunir', 'leases.json'))
+        registry = tunirnet.LeaseRegistry(self.path)
+        registry.sweep()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o664)
+        self.assertEqual(os.stat(registry.lockpath).st_mode & 0o777, 0o664)
+
+    @patch('tunirlib.tunirnet.pid_alive')
+    def test_reclaim(self, t_alive):
+        registry = tunirnet.LeaseRegistry(self.path)
+        t_alive.return_value = True
+        mac = registry.acquire_mac('vm1')
+        registry.attach([mac], 4242)
+        # The tunir process crashed, but the vm is still there
+        t_alive.side_effect = lambda pid: pid == 4242
+        self.assertNotEqual(registry.acquire_mac('vm2'), mac)
+        t_alive.side_effect = lambda pid: False
+        with registry.locked() as data:
+            self.assertEqual(data['leases'], {})
+        # The multicast port is used by every vm
+        t_alive.side_effect = None
+        port = registry.acquire_port('mcast', tunirnet.MCAST_PORTS, check=False)
+        registry.attach(['port:{0}'.format(port)], 4242)
+        registry.attach(['port:{0}'.format(port)], 4243)
+        t_alive.side_effect = lambda pid: pid == 4243
+        self.assertNotEqual(registry.acquire_port('mcast', tunirnet.MCAST_PORTS, check=False), port)
+
+    @patch('tunirlib.tunirnet.port_free')
+    def test_acquire_port(self, t_free):
+        registry = tunirnet.LeaseRegistry(self.path)
+        t_free.side_effect = lambda port: port != 10022
+        self.assertEqual(registry.acquire_port('vm1'), 10023)
+        self.assertEqual(registry.acquire_port('vm2'), 10024)
+        self.assertEqual(registry.acquire_port('mcast', tunirnet.MCAST_PORTS, check=False), 11000)
+        registry.release(['port:10023'])
+        self.assertEqual(registry.acquire_port('vm3'), 10023)
 
+    def test_user_network_args(self):
+        args = tunirmultihost.network_args('00:16:3e:0a:00:0a', 'user', 10022, '230.0.0.1:11000')
+        self.assertIn('user,id=user0,hostfwd=tcp:127.0.0.1:10022-:22', args)
+        self.assertIn('socket,id=mcast0,mcast=230.0.0.1:11000', args)
+        self.assertIn('virtio-net-pci,netdev=mcast0,mac=00:16:3e:0a:00:0a', args)
+        self.assertEqual(tunirmultihost.network_args('00:16:3e:0a:00:0a'),
+                         ['-net', 'bridge,br=virbr0', '-net', 'nic,macaddr=00:16:3e:0a:00:0a,model=virtio'])
 
 
 class ExecuteTests(unittest.TestCase):
@@ -190,6 +471,874 @@ class ExecuteTests(unittest.TestCase):
         self.assertEqual(str(res), "result1")
         self.assertEqual(negative, "dontcare")
 
+    @patch('tunirlib.tunirutils.run')
+    def test_execute_batch(self, t_run):
+        config = {"host_string": "127.0.0.1",
+                  "user": "fedora"}
+        commands = ['ls', '## foobar', 'false', 'date']
+
+        def fake_run(*args, **kargs):
+            script = args[4]
+            self.assertIn('( false\n)', script)
+            marker = re.search('__TUNIR_[0-9a-f]+', script).group(0)
+            text = 'bin\r\n\r\n{0} 0 0\r\nnot found\r\n{0} 1 127\r\n\r\n{0} 2 1\r\n'.format(marker)
+            res = Result(text)
+            res.return_code = 0
+            return res
+        t_run.side_effect = fake_run
+        values = tunirutils.execute_batch(config, commands)
+        self.assertEqual(len(values), 3)
+        self.assertEqual(str(values[0][0]), "bin\r\n")
+        self.assertEqual(values[1][0].return_code, 127)
+        self.assertEqual(values[1][1], "dontcare")
+        self.assertEqual(values[2][0].return_code, 1)
+        self.assertEqual(values[2][1], "no")
+
+    @patch('tunirlib.tunirutils.run')
+    def test_execute_batch_truncated(self, t_run):
+        "commands after a broken batch script are failures"
+        config = {"host_string": "127.0.0.1",
+                  "user": "fedora"}
+        commands = ['ls /', '', 'echo "oops', 'date']
+
+        def fake_run(*args, **kargs):
+            script = args[4]
+            self.assertIn('( :\n)', script)
+            marker = re.search('__TUNIR_[0-9a-f]+', script).group(0)
+            res = Result('bin\r\n\r\n{0} 0 0\r\n\r\n{0} 1 0\r\nsh: 9: Syntax error: Unterminated quoted string\r\n'.format(marker))
+            res.return_code = 2
+            return res
+        t_run.side_effect = fake_run
+        values = tunirutils.execute_batch(config, commands)
+        self.assertEqual(len(values), 3)
+        self.assertEqual(values[2][0].return_code, -1)
+        self.assertEqual(values[2][1], "no")
+        self.assertIn("Syntax error", str(values[2][0]))
+        self.assertFalse(tunirutils.update_result(values[2][0], commands[2], values[2][1]))
+
+    @patch('time.sleep')
+    @patch('tunirlib.tunirutils.run', side_effect=paramiko.ssh_exception.SSHException('lost'))
+    def test_execute_batch_no_retry(self, t_run, t_sleep):
+        "the commands of a batch may have run, we never send it again"
+        with self.assertRaises(paramiko.ssh_exception.SSHException):
+            tunirutils.execute_batch({"host_string": "127.0.0.1", "user": "fedora"}, ['ls', 'date'])
+        self.assertEqual(t_run.call_count, 1)
+
+    @patch('tunirlib.tunirutils.run')
+    def test_batch_steps(self, t_run):
+        "every line of a batch has the wall time, and the sampler sees every line"
+        def fake_run(*args, **kargs):
+            marker = re.search('__TUNIR_[0-9a-f]+', args[4]).group(0)
+            res = Result('bin\r\n\r\n{0} 0 0\r\nMon\r\n{0} 1 0\r\n'.format(marker))
+            res.return_code = 0
+            return res
+        t_run.side_effect = fake_run
+        tconfig = tunirutils.TunirConfig()
+        tconfig.general = {'keypath': 'private.pem', 'batch': '5'}
+        tconfig.vms = {'vm1': {"host_string": "127.0.0.1", "user": "fedora", "ip": "127.0.0.1"}}
+        tdir = tempfile.mkdtemp()
+        jobpath = os.path.join(tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('ls\ndate\nSLEEP 0\n')
+        sampler = Mock()
+        sampler.report.return_value = []
+        results = OrderedDict()
+        with captured_output() as (out, err):
+            self.assertTrue(tunirutils.run_job(jobpath, config=tconfig, sampler=sampler, results=results,
+                                               extra_config={'result_path': os.path.join(tdir, 'result.txt')}))
+        tunirutils.clean_tmp_dirs([tdir, ])
+        self.assertEqual(t_run.call_count, 1)
+        self.assertEqual([value['elapsed'] != '' for value in results.values()], [True, True])
+        # What the vm(s) use while we sleep does not go to the last command
+        self.assertEqual(sampler.mark.call_args_list, [call('ls'), call('date'), call('SLEEP 0')])
+
+    @patch('tunirlib.tunirutils.POOL')
+    def test_execute_nongating_error(self, t_pool):
+        config = {"host_string": "127.0.0.1",
+                  "user": "fedora"}
+        t_pool.run.side_effect = OSError("No route to host")
+        res, negative = tunirutils.execute_nongating(config, '## dmesg')
+        t_pool.run.assert_called_with(config, 'dmesg')
+        self.assertEqual(res.return_code, -1)
+        self.assertIn("No route to host", str(res))
+        self.assertEqual(negative, "dontcare")
+
+
+class WaitTests(unittest.TestCase):
+    """
+    Tests the WAITFOR and WAITUNTIL directives.
+    """
+    def test_parse_waitfor(self):
+        values = tunirutils.parse_waitfor('WAITFOR vm2 sudo journalctl -f /Started (nginx|httpd)/ timeout=60')
+        self.assertEqual(values, ('vm2', 'sudo journalctl -f', 'Started (nginx|httpd)', 60))
+        values = tunirutils.parse_waitfor('WAITFOR vm1 tail -f /var/log/messages /Started/')
+        self.assertEqual(values, ('vm1', 'tail -f /var/log/messages', 'Started', 300))
+        values = tunirutils.parse_waitfor('WAITUNTIL vm1 curl -s localhost')
+        self.assertEqual(values, ('vm1', 'curl -s localhost', '', 300))
+        with self.assertRaises(ValueError):
+            tunirutils.parse_waitfor('WAITFOR vm1 journalctl -f timeout=60')
+
+    @patch('time.sleep')
+    @patch('tunirlib.tunirutils.POOL')
+    def test_wait_until(self, t_pool, t_sleep):
+        config = {"host_string": "127.0.0.1",
+                  "user": "fedora"}
+        r1 = Result("refused")
+        r1.return_code = 7
+        r2 = Result("ok")
+        r2.return_code = 0
+        t_pool.run.side_effect = [socket.timeout(), r1, r2]
+        tconfig = tunirutils.TunirConfig()
+        tconfig.vms = {'vm1': config}
+        res, duration = tunirutils.wait_directive('WAITUNTIL vm1 curl -s localhost timeout=60', tconfig)
+        self.assertEqual(res.return_code, 0)
+        self.assertEqual(t_pool.run.call_count, 3)
+        self.assertEqual(t_sleep.call_count, 2)
+        self.assertTrue(t_pool.drop.called)
+
+
+class RebootTests(unittest.TestCase):
+    """
+    Tests the REBOOT directive.
+    """
+    @patch('tunirlib.tunirutils.ssh_banner_ready', return_value=True)
+    @patch('time.sleep')
+    @patch('tunirlib.tunirutils.POOL')
+    def test_reboot(self, t_pool, t_sleep, t_banner):
+        tconfig = tunirutils.TunirConfig()
+        tconfig.vms = {'vm1': {"host_string": "192.168.122.100", "user": "fedora"},
+                       'vm2': {"host_string": "192.168.122.101", "user": "fedora"}}
+        boot_ids = {'192.168.122.100': ['old1', socket.error(), 'old1', 'new1'],
+                    '192.168.122.101': ['old2', 'new2']}
+
+        def fake_run(config, command, timeout=None):
+            value = boot_ids[config['host_string']].pop(0)
+            if isinstance(value, Exception):
+                raise value
+            return Result(value)
+        t_pool.run.side_effect = fake_run
+        res, duration = tunirutils.reboot_directive('REBOOT vm1,vm2 timeout=600', tconfig)
+        self.assertEqual(res.return_code, 0)
+        self.assertIn('vm1 rebooted in', str(res))
+        self.assertIn('vm2 rebooted in', str(res))
+        self.assertEqual(boot_ids, {'192.168.122.100': [], '192.168.122.101': []})
+        with self.assertRaises(ValueError):
+            tunirutils.reboot_directive('REBOOT vm3', tconfig)
+
+
+class BenchTests(unittest.TestCase):
+    """
+    Tests the BENCH directive.
+    """
+    def setUp(self):
+        self.tconfig = tunirutils.TunirConfig()
+        self.tconfig.vms = {'vm1': {"host_string": "192.168.122.100", "user": "fedora"}}
+
+    def test_parse_bench(self):
+        self.assertEqual(tunirutils.parse_bench('BENCH vm1 runs=10 warmup=2 max=0.5 dd if=/dev/zero of=/tmp/a'),
+                         ('vm1', {'runs': '10', 'warmup': '2', 'max': '0.5', 'tolerance': '10', 'better': 'lower'},
+                          'dd if=/dev/zero of=/tmp/a'))
+        self.assertEqual(tunirutils.parse_bench('BENCH vm1 min=500 ./disk-test')[1]['better'], 'higher')
+        for command in ('BENCH vm1 runs=10', 'BENCH vm1 runs=0 true', 'BENCH vm1 warmup=-1 true',
+                        'BENCH vm1 runs=x true', 'BENCH vm1 better=faster true'):
+            with self.assertRaises(ValueError):
+                tunirutils.parse_bench(command)
+
+    def test_bench_stats(self):
+        stats = tunirutils.bench_stats([float(i) for i in range(20, 0, -1)])
+        self.assertEqual((stats['min'], stats['median'], stats['p95']), (1.0, 10.5, 19.0))
+        self.assertAlmostEqual(stats['stddev'], 5.916, places=3)
+        self.assertEqual(tunirutils.bench_stats([2.0])['stddev'], 0.0)
+
+    @patch('tunirlib.tunirutils.POOL')
+    def test_bench_metric(self, t_pool):
+        outputs = ['100 MB/s', '10 MB/s', '20 MB/s', '30 MB/s']
+
+        def fake_run(config, command, timeout=None):
+            result = Result(outputs.pop(0))
+            result.return_code = 0
+            return result
+        t_pool.run.side_effect = fake_run
+        with captured_output() as (out, err):
+            res, duration = tunirutils.bench_directive('BENCH vm1 runs=3 metric=([0-9.]+)\\sMB/s min=25 ./disk',
+                                                       self.tconfig)
+        # The warmup run does not count
+        self.assertIn('median 20.0000', res.text)
+        self.assertIn('median is under the min 25', res.text)
+        self.assertEqual(res.return_code, 1)
+        self.assertEqual(t_pool.run.call_args, call(self.tconfig.vms['vm1'], './disk'))
+
+    @patch('tunirlib.tunirutils.POOL')
+    def test_bench_baseline(self, t_pool):
+        tdir = tempfile.mkdtemp()
+        self.tconfig.general['bench_baseline'] = os.path.join(tdir, 'baseline.json')
+        result = Result('')
+        result.return_code = 0
+        t_pool.run.return_value = result
+        with captured_output() as (out, err):
+            res, duration = tunirutils.bench_directive('BENCH vm1 runs=3 /bin/true', self.tconfig)
+            self.assertIn('recorded as the baseline', res.text)
+            with open(self.tconfig.general['bench_baseline'], 'w') as fobj:
+                json.dump({'BENCH vm1 runs=3 /bin/true': 0.0}, fobj)
+            with patch('time.perf_counter', side_effect=[0, 1] * 4):
+                res, duration = tunirutils.bench_directive('BENCH vm1 runs=3 /bin/true', self.tconfig)
+            self.assertIn('median is over the baseline', res.text)
+            self.assertEqual(res.return_code, 1)
+            # A throughput, higher is better
+            t_pool.run.side_effect = lambda vm, command: Mock(return_code=0, text='{0} MB/s'.format(values.pop(0)))
+            key = r'BENCH vm1 runs=3 warmup=0 metric=([0-9.]+) better=higher /bin/true'
+            with open(self.tconfig.general['bench_baseline'], 'w') as fobj:
+                json.dump({key: 100.0}, fobj)
+            values = [150, 140, 160]
+            res, duration = tunirutils.bench_directive(key, self.tconfig)
+            self.assertEqual(res.return_code, 0)
+            self.assertIn('limit 90.0000 (higher is better)', res.text)
+            values = [50, 40, 60]
+            res, duration = tunirutils.bench_directive(key, self.tconfig)
+            self.assertEqual(res.return_code, 1)
+            self.assertIn('median is under the baseline', res.text)
+            t_pool.run.side_effect = None
+            result.return_code = 2
+            res, duration = tunirutils.bench_directive('BENCH vm1 runs=3 /bin/true', self.tconfig)
+            self.assertIn('BENCH run 1 failed', res.text)
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+
+class CompareTests(unittest.TestCase):
+    """
+    Tests the A/B compare mode.
+    """
+    def setUp(self):
+        self.config = tunirutils.TunirConfig()
+        self.config.general = {'cpu': '1', 'ram': '1024'}
+        self.config.vms = OrderedDict([('vm1', {'user': 'fedora', 'image': '/a.qcow2', 'hostname': 'web'}),
+                                       ('vm2', {'user': 'fedora', 'image': '/a.qcow2'}),
+                                       ('vm3', {'user': 'fedora', 'ip': '192.168.1.10'})])
+
+    def test_compare_config(self):
+        config = tunircompare.compare_config(self.config, ('/new/a.qcow2', '/new/b.qcow2'))
+        self.assertEqual(list(config.vms.keys()), ['vm1', 'vm2', 'vm3', 'vm1-b', 'vm2-b'])
+        self.assertEqual(config.vms['vm1']['image'], '/new/a.qcow2')
+        self.assertEqual(config.vms['vm2-b'], {'user': 'fedora', 'image': '/new/b.qcow2'})
+        self.assertEqual(config.vms['vm1-b']['hostname'], 'web-b')
+        self.assertEqual(self.config.vms['vm1']['image'], '/a.qcow2')
+        tdir = tempfile.mkdtemp()
+        path = os.path.join(tdir, 'job.cfg')
+        tunircompare.write_config(config, path)
+        self.assertEqual(tunirmultihost.read_multihost_config(path).vms, config.vms)
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+    def test_compare_job(self):
+        commands = ['HOSTCOMMAND: date\n', 'vm1 make\n', 'ls\n', 'vm1,vm3 uptime\n', 'vm3 uptime\n',
+                    'BENCH vm2 runs=3 ./test\n', 'POLL\n', 'REBOOT vm2 timeout=60\n', '\n',
+                    'PUT a.tar vm1:/tmp/\n', 'GET vm2:/tmp/log ./logs/\n']
+        lines, pairs = tunircompare.compare_job(commands, self.config)
+        self.assertEqual(lines, ['HOSTCOMMAND: date', 'vm1 make', 'vm1-b make', 'vm1-b ls', 'vm1 ls',
+                                 'vm1,vm3 uptime', 'vm1-b uptime', 'vm3 uptime', 'BENCH vm2,vm2-b runs=3 ./test',
+                                 'POLL vm1,vm1-b', 'REBOOT vm2-b timeout=60', 'REBOOT vm2 timeout=60', '',
+                                 'PUT a.tar vm1:/tmp/', 'PUT a.tar vm1-b:/tmp/', 'GET vm2,vm2-b:/tmp/log ./logs/'])
+        self.assertEqual(pairs[0], ('vm1 make', 'vm1 make', 'vm1-b make'))
+        self.assertEqual(pairs[3], ('BENCH vm2 runs=3 ./test', 'BENCH vm2,vm2-b runs=3 ./test',
+                                    'BENCH vm2,vm2-b runs=3 ./test'))
+
+    def test_compare_report(self):
+        steps = OrderedDict([('vm1 make', {'elapsed': '2.0'}), ('vm1-b make', {'elapsed': '3.0'}),
+                             ('vm1 uptime', {'elapsed': '1.0'}), ('vm3 uptime', {'elapsed': '1.5'}),
+                             ('vm1-b uptime', {'elapsed': '1.0'}),
+                             ('BENCH vm2,vm2-b ./t', {'result': 'runs: 3\ndelta vm2-b - vm2: mean +0.1'})])
+        pairs = [('vm1 make', 'vm1 make', 'vm1-b make'), ('vm1,vm3 uptime', 'vm1,vm3 uptime', 'vm1-b uptime'),
+                 ('BENCH vm2 ./t', 'BENCH vm2,vm2-b ./t', 'BENCH vm2,vm2-b ./t'), ('vm1 ls', 'vm1 ls', 'vm1-b ls')]
+        vms = {'vm1': {'boot_time': '4.00'}, 'vm1-b': {'boot_time': '3.50'}}
+        lines = tunircompare.compare_report(pairs, steps, vms, ('/a', '/b'))
+        self.assertEqual(lines, ['compare: A = /a', 'compare: B = /b', 'compare: boot vm1: A 4.00s B 3.50s delta -0.50s',
+                                 'compare: vm1 make: A 2.00s B 3.00s delta +1.00s (+50.0%)',
+                                 'compare: vm1,vm3 uptime: A 1.50s B 1.00s delta -0.50s (-33.3%)',
+                                 'compare: BENCH vm2 ./t: delta vm2-b - vm2: mean +0.1'])
+
+    def test_mean_difference(self):
+        diff, low, high = tunirutils.mean_difference([1.0, 1.2, 1.1, 0.9], [2.0, 2.2, 2.1, 1.9])
+        self.assertAlmostEqual(diff, 1.0)
+        self.assertAlmostEqual(high - diff, diff - low)
+        # 6 degrees of freedom
+        self.assertAlmostEqual(high - diff, 2.447 * (0.05 / 3 / 2) ** 0.5, places=6)
+        self.assertEqual(tunirutils.mean_difference([1.0], [2.0]), (1.0, 1.0, 1.0))
+
+    @patch('tunirlib.tunirutils.POOL')
+    def test_bench_interleaved(self, t_pool):
+        tconfig = tunirutils.TunirConfig()
+        tconfig.vms = {'vm1': {'host_string': 'a'}, 'vm1-b': {'host_string': 'b'}}
+        order = []
+
+        def fake_run(config, command, timeout=None):
+            order.append(config['host_string'])
+            result = Result('{0} MB/s'.format(10 if config['host_string'] == 'a' else 12 + len(order) % 2))
+            result.return_code = 0
+            return result
+        t_pool.run.side_effect = fake_run
+        with captured_output() as (out, err):
+            res, duration = tunirutils.bench_directive('BENCH vm1,vm1-b runs=4 warmup=1 metric=([0-9]+) ./t',
+                                                       tconfig)
+        self.assertEqual(''.join(order), 'abbaabbaab')
+        self.assertIn('vm1: min 10.0000 median 10.0000', res.text)
+        self.assertIn('delta vm1-b - vm1: mean +2.5000', res.text)
+        self.assertEqual(res.return_code, 0)
+
+    @patch('tunirlib.tunirmultihost.start_multihost')
+    def test_compare_images(self, p_start):
+        tdir = tempfile.mkdtemp()
+        for name in ('a.qcow2', 'b.qcow2'):
+            with open(os.path.join(tdir, name), 'w') as fobj:
+                fobj.write('')
+        with open(os.path.join(tdir, 'job.cfg'), 'w') as fobj:
+            fobj.write('[general]\ncpu = 1\nresult_path = {0}\n\n[vm1]\nuser = fedora\nimage = /a\n'.format(
+                os.path.join(tdir, 'result.txt')))
+        with open(os.path.join(tdir, 'job.txt'), 'w') as fobj:
+            fobj.write('vm1 make\n')
+        seen = {}
+
+        def fake_start(jobname, jobpath, config_dir, stats):
+            with open(jobpath) as fobj:
+                seen['job'] = fobj.read()
+            seen['config'] = tunirmultihost.read_multihost_config(os.path.join(config_dir, jobname + '.cfg'))
+            stats['boot'] = {'vm1': 4.0, 'vm1-b': 5.0}
+            tunirutils.STR.update({'vm1 make': {'elapsed': '1.0'}, 'vm1-b make': {'elapsed': '1.5'}})
+            return True
+        p_start.side_effect = fake_start
+        images = (os.path.join(tdir, 'a.qcow2'), os.path.join(tdir, 'b.qcow2'))
+        with patch.dict(tunirutils.STR, clear=True), captured_output() as (out, err):
+            self.assertTrue(tunirmultihost.compare_images('job', tdir, images))
+            self.assertFalse(tunirmultihost.compare_images('job', tdir, (images[0], '/missing')))
+        self.assertEqual(seen['job'], 'vm1 make\nvm1-b make\n')
+        self.assertEqual(seen['config'].vms['vm1-b']['image'], images[1])
+        with open(os.path.join(tdir, 'result.txt')) as fobj:
+            data = fobj.read()
+        self.assertIn('compare: boot vm1: A 4.00s B 5.00s delta +1.00s\n', data)
+        self.assertIn('compare: vm1 make: A 1.00s B 1.50s delta +0.50s (+50.0%)\n', data)
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+
+class TransferTests(unittest.TestCase):
+    """
+    Tests the PUT and GET directives.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.tconfig = tunirutils.TunirConfig()
+        self.tconfig.vms = OrderedDict((name, {'host_string': name, 'user': 'fedora'}) for name in ('vm1', 'vm2', 'vm3'))
+        self.tconfig.groups = {'web': 'vm2,vm3'}
+
+    def tearDown(self):
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    def test_parse_transfer(self):
+        self.assertEqual(tunirutils.parse_transfer('PUT a.tar web:/tmp/', self.tconfig),
+                         (['vm2', 'vm3'], 'a.tar', '/tmp/'))
+        self.assertEqual(tunirutils.parse_transfer('GET vm1:/var/log/messages logs/', self.tconfig),
+                         (['vm1'], 'logs/', '/var/log/messages'))
+        for command in ('PUT a.tar /tmp/', 'GET vm1: logs/', 'PUT a.tar'):
+            with self.assertRaises(ValueError):
+                tunirutils.parse_transfer(command, self.tconfig)
+        with self.assertRaises(ValueError):
+            tunirutils.parse_transfer('PUT a.tar vm4:/tmp/', self.tconfig)
+        jobpath = os.path.join(self.tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('PUT a.tar vm4:/tmp/\n')
+        with captured_output() as (out, err):
+            self.assertFalse(tunirutils.match_vm_numbers(['vm1'], jobpath))
+
+    @patch('tunirlib.tunirutils.POOL')
+    def test_put(self, t_pool):
+        local = os.path.join(self.tdir, 'run.sh')
+        with open(local, 'w') as fobj:
+            fobj.write('#!/bin/sh\n')
+        os.chmod(local, 0o755)
+        sftp = Mock()
+        t_pool.sftp.return_value = sftp
+        with captured_output() as (out, err):
+            res, duration = tunirutils.transfer_directive('PUT {0} web:/tmp/'.format(local), self.tconfig)
+        self.assertEqual(res.return_code, 0)
+        self.assertEqual(sftp.put.call_args_list, [call(local, '/tmp/run.sh')] * 2)
+        self.assertEqual(sftp.chmod.call_args, call('/tmp/run.sh', 0o755))
+        self.assertEqual(sftp.close.call_count, 2)
+        self.assertEqual(t_pool.sftp.call_args_list, [call(self.tconfig.vms['vm2']), call(self.tconfig.vms['vm3'])])
+        self.assertIn('vm2: 10 bytes in ', res.text)
+        self.assertIn('total: 20 bytes in ', res.text)
+        sftp.put.side_effect = IOError('No space left')
+        with captured_output() as (out, err):
+            res, duration = tunirutils.transfer_directive('PUT {0} vm1:/tmp/'.format(local), self.tconfig)
+        self.assertEqual((res.return_code, res.text), (1, 'vm1: No space left'))
+
+    @patch('tunirlib.tunirutils.POOL')
+    def test_get(self, t_pool):
+        def fake_get(remote, local):
+            with open(local, 'w') as fobj:
+                fobj.write(remote)
+        t_pool.sftp.return_value.get.side_effect = fake_get
+        logs = os.path.join(self.tdir, 'logs')
+        with captured_output() as (out, err):
+            res, duration = tunirutils.transfer_directive('GET vm1,vm2:/var/log/messages {0}'.format(logs),
+                                                          self.tconfig)
+            self.assertEqual(res.return_code, 0)
+            for name in ('vm1', 'vm2'):
+                with open(os.path.join(logs, name, 'messages')) as fobj:
+                    self.assertEqual(fobj.read(), '/var/log/messages')
+            res, duration = tunirutils.transfer_directive('GET vm1:/etc/os-release {0}'.format(logs), self.tconfig)
+        self.assertTrue(os.path.exists(os.path.join(logs, 'os-release')))
+        self.assertIn('vm1: 15 bytes in ', res.text)
+
+
+class LocalSFTP(object):
+    "SFTP on the local filesystem, for the SYNC tests, each vm has its own copy of the root"
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+
+    def path(self, path):
+        return path.replace(self.root, self.root + self.name) if self.name != 'vm1' else path
+
+    def put(self, local, remote):
+        shutil.copy(local, self.path(remote))
+
+    def chmod(self, path, mode):
+        os.chmod(self.path(path), mode)
+
+    def utime(self, path, times):
+        os.utime(self.path(path), times)
+
+    def close(self):
+        pass
+
+
+class SyncTests(unittest.TestCase):
+    """
+    Tests the SYNC directive, the vm is a local directory.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.local = os.path.join(self.tdir, 'src')
+        self.remote = os.path.join(self.tdir, 'dst')
+        os.makedirs(os.path.join(self.local, 'lib'))
+        for name, text in (('run.sh', '#!/bin/sh\n'), ('lib/a.py', 'a = 1\n'), ('lib/b.py', 'b = 2\n')):
+            with open(os.path.join(self.local, name), 'w') as fobj:
+                fobj.write(text)
+        self.tconfig = tunirutils.TunirConfig()
+        self.tconfig.vms = OrderedDict((name, {'host_string': name, 'user': 'fedora'}) for name in ('vm1', 'vm2'))
+        self.commands = []
+        self.patcher = patch('tunirlib.tunirutils.POOL')
+        self.pool = self.patcher.start()
+        self.pool.key.side_effect = tunirutils.SSHPool().key
+        self.pool.sftp.side_effect = lambda config: LocalSFTP(self.remote, config['host_string'])
+
+        def fake_run(config, command, timeout=None):
+            self.commands.append(command)
+            command = LocalSFTP(self.remote, config['host_string']).path(command)
+            out, err, code = system(command)
+            result = Result(out + err)
+            result.return_code = code
+            return result
+        self.pool.run.side_effect = fake_run
+        tunirutils.REMOTE_HASHES.clear()
+
+    def tearDown(self):
+        self.patcher.stop()
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    def sync(self, command):
+        with captured_output() as (out, err):
+            return tunirutils.sync_directive(command, self.tconfig)[0]
+
+    def test_sync(self):
+        res = self.sync('SYNC {0} vm1:{1}/'.format(self.local, self.remote))
+        self.assertEqual((res.return_code, res.text), (0, 'vm1: 3 copied, 0 deleted, 0 unchanged, 22 bytes'))
+        with open(os.path.join(self.remote, 'lib', 'a.py')) as fobj:
+            self.assertEqual(fobj.read(), 'a = 1\n')
+        # The same files again, nothing to copy, and we hash nothing on the vm
+        self.commands = []
+        res = self.sync('SYNC {0} vm1:{1}'.format(self.local, self.remote))
+        self.assertEqual(res.text, 'vm1: 0 copied, 0 deleted, 3 unchanged, 0 bytes')
+        self.assertEqual(len(self.commands), 1)
+        # A step of the job changed a file on the vm
+        with open(os.path.join(self.remote, 'lib', 'b.py'), 'w') as fobj:
+            fobj.write('b = 3\n')
+        with open(os.path.join(self.remote, 'extra.txt'), 'w') as fobj:
+            fobj.write('extra\n')
+        os.unlink(os.path.join(self.local, 'run.sh'))
+        res = self.sync('SYNC {0} vm1:{1}'.format(self.local, self.remote))
+        self.assertEqual(res.text, 'vm1: 1 copied, 0 deleted, 1 unchanged, 6 bytes')
+        self.assertTrue(os.path.exists(os.path.join(self.remote, 'run.sh')))
+        res = self.sync('SYNC {0} vm1:{1} delete=yes'.format(self.local, self.remote))
+        self.assertEqual(res.text, 'vm1: 0 copied, 2 deleted, 2 unchanged, 0 bytes')
+        self.assertEqual(sorted(os.listdir(self.remote)), ['lib'])
+        with open(os.path.join(self.remote, 'lib', 'b.py')) as fobj:
+            self.assertEqual(fobj.read(), 'b = 2\n')
+
+    def test_sync_names(self):
+        "names sha256sum would escape, and the directories delete=yes leaves empty"
+        odd = os.path.join(self.local, 'lib', 'back\\slash\nnew line.txt')
+        with open(odd, 'w') as fobj:
+            fobj.write('odd\n')
+        os.makedirs(os.path.join(self.local, 'old', 'deep'))
+        with open(os.path.join(self.local, 'old', 'deep', 'c.py'), 'w') as fobj:
+            fobj.write('c = 3\n')
+        res = self.sync('SYNC {0} vm1:{1}'.format(self.local, self.remote))
+        self.assertEqual(res.text, 'vm1: 5 copied, 0 deleted, 0 unchanged, 32 bytes')
+        # The vm changed the odd file, we have to hash it there
+        tunirutils.REMOTE_HASHES.clear()
+        with open(os.path.join(self.remote, 'lib', 'back\\slash\nnew line.txt'), 'w') as fobj:
+            fobj.write('ODD\n')
+        res = self.sync('SYNC {0} vm1:{1}'.format(self.local, self.remote))
+        self.assertEqual(res.text, 'vm1: 1 copied, 0 deleted, 4 unchanged, 4 bytes')
+        shutil.rmtree(os.path.join(self.local, 'old'))
+        os.unlink(odd)
+        res = self.sync('SYNC {0} vm1:{1} delete=yes'.format(self.local, self.remote))
+        self.assertEqual(res.text, 'vm1: 0 copied, 2 deleted, 3 unchanged, 0 bytes')
+        self.assertEqual(sorted(os.listdir(self.remote)), ['lib', 'run.sh'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.remote, 'lib'))), ['a.py', 'b.py'])
+
+    def test_sync_many(self):
+        res = self.sync('SYNC {0} vm1,vm2:{1}'.format(self.local, self.remote))
+        self.assertEqual(res.text, 'vm1: 3 copied, 0 deleted, 0 unchanged, 22 bytes\n'
+                                   'vm2: 3 copied, 0 deleted, 0 unchanged, 22 bytes')
+        self.assertTrue(os.path.exists(os.path.join(self.remote + 'vm2', 'lib', 'b.py')))
+        with self.assertRaises(ValueError):
+            self.sync('SYNC {0}/missing vm1:{1}'.format(self.local, self.remote))
+
+
+class ArtifactTests(unittest.TestCase):
+    """
+    Tests the collection of the artifacts.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.tconfig = tunirutils.TunirConfig()
+        self.tconfig.vms = OrderedDict((name, {'host_string': name, 'user': 'fedora'}) for name in ('vm1', 'vm2'))
+        self.tconfig.vms['vm3'] = {'user': 'fedora'} # Never came up
+        self.tconfig.artifacts = OrderedDict([('all', '/var/log/messages'), ('vm1', '/tmp/*.xml /var/log/messages')])
+
+    def tearDown(self):
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    def test_config(self):
+        path = os.path.join(self.tdir, 'job.cfg')
+        with open(path, 'w') as fobj:
+            fobj.write('[general]\ncpu = 1\n\n[vm1]\nuser = fedora\n\n[artifacts]\nvm1 = /tmp/*.xml\n')
+        config = tunirmultihost.read_multihost_config(path)
+        self.assertEqual(list(config.vms.keys()), ['vm1'])
+        self.assertEqual(config.artifacts, {'vm1': '/tmp/*.xml'})
+        self.assertEqual(tunirartifacts.artifact_globs(self.tconfig),
+                         {'vm1': ['/var/log/messages', '/tmp/*.xml'], 'vm2': ['/var/log/messages'],
+                          'vm3': ['/var/log/messages']})
+        self.assertIn('tar czf - --ignore-failed-read tmp/*.xml var/log/messages',
+                      tunirartifacts.tar_command(['/tmp/*.xml', '/var/log/messages']))
+
+    @patch('tunirlib.tunirartifacts.POOL')
+    def test_collect(self, t_pool):
+        chunks = {'vm1': [b'a' * 10, b'b' * 10, b''], 'vm2': [b'c' * 30, b'd' * 30, b'']}
+        channels = {}
+
+        def fake_client(vm):
+            chan = Mock()
+            chan.recv.side_effect = chunks[vm['host_string']]
+            channels[vm['host_string']] = chan
+            client = Mock()
+            client.get_transport.return_value.open_session.return_value = chan
+            return client
+        t_pool.client.side_effect = fake_client
+        path = os.path.join(self.tdir, 'artifacts')
+        lines = tunirartifacts.collect_artifacts(self.tconfig, path, cap=50)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('artifacts: vm1 0.0 MB in '))
+        self.assertIn(', stopped at the cap', lines[1])
+        with open(os.path.join(path, 'vm1.tar.gz'), 'rb') as fobj:
+            self.assertEqual(fobj.read(), b'a' * 10 + b'b' * 10)
+        self.assertEqual(os.path.getsize(os.path.join(path, 'vm2.tar.gz')), 50)
+        self.assertTrue(channels['vm2'].close.called)
+        self.assertFalse(channels['vm1'].get_pty.called)
+        t_pool.client.side_effect = socket.error('No route to host')
+        lines = tunirartifacts.collect_artifacts(self.tconfig, path)
+        self.assertEqual(lines[0], 'artifacts: vm1 failed: No route to host')
+
+    @patch('tunirlib.tunirmultihost.collect_artifacts', return_value=['artifacts: vm1 1.0 MB'])
+    def test_failed_job(self, p_collect):
+        "the artifacts are collected when the job fails too"
+        config = {'type': 'bare', 'image': '127.0.0.1', 'ip': '127.0.0.1', 'user': 'fedora',
+                  'artifacts': ['/var/log/messages'], 'history': 'off'}
+        config['key'] = os.path.join(self.tdir, 'private.pem')
+        with open(config['key'], 'w') as fobj:
+            fobj.write(tunirmultihost.generate_sshkey(1024)[0])
+        jobpath = os.path.join(self.tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('')
+        with captured_output() as (out, err), \
+                patch('tunirlib.tunirreap.RUNS_DIR', self.tdir), \
+                patch('tunirlib.tunirnet.LEASE_PATH', os.path.join(self.tdir, 'leases.json')), \
+                patch('tunirlib.tunirmultihost.run_job', return_value=False), \
+                patch('tunirlib.tunirmultihost.create_seed_img'), \
+                patch('tunirlib.tunirmultihost.POOL'):
+            self.assertFalse(tunirmultihost.start_multihost('job', jobpath, oldconfig=config, config_dir=self.tdir))
+        config = p_collect.call_args[0][0]
+        self.assertEqual(config.artifacts, {'vm1': '/var/log/messages'})
+        self.assertTrue(p_collect.call_args[0][1].endswith('-artifacts'))
+        self.assertIn('artifacts: vm1 1.0 MB', out.getvalue())
+
+
+class FleetTests(unittest.TestCase):
+    """
+    Tests a bare job on many hosts.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.config = {'type': 'bare', 'user': 'root', 'key': '/tmp/private.pem', 'port': '22',
+                       'hosts': ['10.0.0.1', '10.0.0.2:2222'], 'inventory': 'hosts.txt',
+                       'fleet_dir': os.path.join(self.tdir, 'fleet'), 'fleet_workers': 2}
+        with open(os.path.join(self.tdir, 'hosts.txt'), 'w') as fobj:
+            fobj.write('# The rack\n10.0.0.3\n\n10.0.0.1\n')
+
+    def tearDown(self):
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    def test_fleet_hosts(self):
+        self.assertEqual(tunirfleet.fleet_hosts(self.config, self.tdir),
+                         [('10.0.0.1', '22'), ('10.0.0.2', '2222'), ('10.0.0.3', '22')])
+        config = tunirfleet.host_config(self.config, '10.0.0.2', '2222')
+        vm = config.vms['vm1']
+        self.assertEqual((vm['host_string'], vm['ip'], vm['port'], vm['user']), ('10.0.0.2', '10.0.0.2', '2222', 'root'))
+        self.assertNotIn('hosts', vm)
+        self.assertEqual(config.general['keypath'], '/tmp/private.pem')
+
+    @patch('tunirlib.tunirfleet.POOL')
+    @patch('tunirlib.tunirutils.execute')
+    def test_fleet_run(self, t_execute, t_pool):
+        def fake_execute(vm, command):
+            result = Result('output of {0}'.format(command))
+            # The second step fails on one host
+            result.return_code = 1 if vm['host_string'] == '10.0.0.2' and command == 'false' else 0
+            return result, 'no'
+        t_execute.side_effect = fake_execute
+        tunirutils.STR = OrderedDict()
+        jobpath = os.path.join(self.tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('uname -a\nfalse\nvm1 ls /\n')
+        with captured_output() as (out, err):
+            self.assertFalse(tunirfleet.fleet_run('job', jobpath, self.config, self.tdir))
+        self.assertEqual(tunirutils.STR, {})
+        self.assertEqual(t_execute.call_count, 8)
+        self.assertEqual(t_pool.drop.call_count, 3)
+        self.assertTrue(t_pool.close_all.called)
+        dirpath = self.config['fleet_dir']
+        self.assertEqual(sorted(os.listdir(dirpath)), ['10.0.0.1.json', '10.0.0.1.txt', '10.0.0.2_2222.json',
+                                                       '10.0.0.2_2222.txt', '10.0.0.3.json', '10.0.0.3.txt',
+                                                       'fleet.txt'])
+        with open(os.path.join(dirpath, '10.0.0.2_2222.json')) as fobj:
+            self.assertEqual(json.load(fobj), {'user': 'root', 'keyfile': '/tmp/private.pem', 'vm1': '10.0.0.2'})
+        with open(os.path.join(dirpath, '10.0.0.2_2222.txt')) as fobj:
+            self.assertIn('output of false', fobj.read())
+        with open(os.path.join(dirpath, 'fleet.txt')) as fobj:
+            lines = fobj.read().splitlines()
+        self.assertEqual(lines[:3], ['fleet: step 1: uname -a', 'fleet: step 2: false', 'fleet: step 3: vm1 ls /'])
+        self.assertTrue(lines[4].startswith('fleet: 10.0.0.1      pass '))
+        self.assertTrue(lines[4].endswith('s P P P'))
+        self.assertTrue(lines[5].startswith('fleet: 10.0.0.2:2222 fail '))
+        self.assertTrue(lines[5].endswith('s P F -'))
+        self.assertEqual(lines[7], 'fleet: 2 passed, 1 failed out of 3 hosts.')
+
+    def test_stragglers(self):
+        outcomes = OrderedDict([('a', (True, 10.0, {})), ('b', (True, 12.0, {})), ('c', (False, 30.0, {}))])
+        lines = tunirfleet.fleet_report(outcomes)
+        self.assertEqual(lines[-1], 'fleet: straggler c took 30.00 seconds, the median is 12.00 seconds.')
+        self.assertEqual(len([line for line in lines if 'straggler' in line]), 1)
+        self.assertFalse([line for line in tunirfleet.fleet_report(outcomes, 3.0) if 'straggler' in line])
+
+    def test_missing_inventory(self):
+        self.config['inventory'] = 'missing.txt'
+        with captured_output() as (out, err):
+            self.assertFalse(tunirfleet.fleet_run('job', 'job.txt', self.config, self.tdir))
+        self.assertIn('missing.txt', out.getvalue())
+
+
+class JumpTests(unittest.TestCase):
+    """
+    Tests the vm(s) behind a bastion.
+    """
+    def setUp(self):
+        self.vms = [{'host_string': '10.1.0.{0}'.format(index), 'port': '22', 'user': 'fedora',
+                     'key': '/tmp/vm.pem', 'proxy_jump': 'admin@bastion.example.com:2222'} for index in (1, 2)]
+
+    def test_parse_jump(self):
+        self.assertEqual(tunirutils.parse_jump('admin@bastion:2222', 'fedora'), ('bastion', 2222, 'admin'))
+        self.assertEqual(tunirutils.parse_jump('bastion', 'fedora'), ('bastion', 22, 'fedora'))
+        with self.assertRaises(ValueError):
+            tunirutils.parse_jump('one,two', 'fedora')
+
+    @patch('tunirlib.tunirutils.connect')
+    def test_pool(self, t_connect):
+        bastion = Mock()
+        clients = [bastion, Mock(), Mock()]
+        t_connect.side_effect = lambda *args, **kwargs: clients.pop(0)
+        pool = tunirutils.SSHPool()
+        for vm in self.vms:
+            pool.client(vm)
+        pool.client(self.vms[0])
+        self.assertEqual(t_connect.call_count, 3)
+        self.assertEqual(t_connect.call_args_list[0], call('bastion.example.com', '2222', 'admin',
+                                                           key_filename='/tmp/vm.pem', pkey=None))
+        transport = bastion.get_transport.return_value
+        self.assertEqual(transport.open_channel.call_args_list,
+                         [call('direct-tcpip', ('10.1.0.1', 22), ('127.0.0.1', 0)),
+                          call('direct-tcpip', ('10.1.0.2', 22), ('127.0.0.1', 0))])
+        args, kwargs = t_connect.call_args
+        self.assertEqual(args[0], '10.1.0.2')
+        self.assertEqual(kwargs['sock'], transport.open_channel.return_value)
+        pool.close_all()
+        self.assertTrue(bastion.close.called)
+        self.assertEqual(pool.jumps, {})
+        # The direct connection does not open a channel
+        t_connect.side_effect = None
+        pool.client({'host_string': '10.1.0.3', 'user': 'fedora'})
+        self.assertEqual(t_connect.call_args[1]['sock'], None)
+
+    @patch('tunirlib.tunirutils.connect')
+    def test_same_address(self, t_connect):
+        "the same private address behind two bastions is two machines"
+        t_connect.side_effect = lambda *args, **kwargs: Mock()
+        pool = tunirutils.SSHPool()
+        other = dict(self.vms[0], proxy_jump='admin@bastion2.example.com')
+        self.assertIsNot(pool.client(self.vms[0]), pool.client(other))
+        self.assertEqual(len(pool.jumps), 2)
+        self.assertEqual(len(pool.clients), 2)
+
+    @patch('tunirlib.tunirutils.POOL')
+    def test_banner(self, t_pool):
+        chan = t_pool.sock.return_value
+        chan.recv.return_value = b'SSH-2.0-OpenSSH_8.0'
+        self.assertTrue(tunirutils.vm_banner_ready(self.vms[0]))
+        self.assertTrue(chan.close.called)
+        t_pool.sock.side_effect = paramiko.ssh_exception.ChannelException(2, 'Connect failed')
+        self.assertFalse(tunirutils.vm_banner_ready(self.vms[0]))
+
+    def test_inventory(self):
+        tdir = tempfile.mkdtemp()
+        path = os.path.join(tdir, 'tunir_ansible')
+        vm = dict(self.vms[0], ip='10.1.0.1')
+        tunirutils.create_ansible_inventory({'vm1': vm}, path)
+        with open(path) as fobj:
+            data = fobj.read()
+        tunirutils.clean_tmp_dirs([tdir, ])
+        self.assertEqual(data, "vm1 ansible_ssh_host=10.1.0.1 ansible_ssh_user=fedora "
+                               "ansible_ssh_common_args='-o ProxyCommand=\"ssh -i /tmp/vm.pem "
+                               "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -W %h:%p "
+                               "-p 2222 admin@bastion.example.com\"'\n")
+        vm['proxy_key'] = '/tmp/bastion.pem'
+        self.assertIn('ssh -i /tmp/bastion.pem ', tunirutils.proxy_command(vm))
+
+
+class PollTests(unittest.TestCase):
+    """
+    Tests the readiness probe and the POLL directive.
+    """
+    @patch('tunirlib.tunirutils.ssh_banner_ready')
+    @patch('time.sleep')
+    @patch('tunirlib.tunirutils.POOL')
+    def test_poll_directive(self, t_pool, t_sleep, t_banner):
+        tconfig = tunirutils.TunirConfig()
+        tconfig.vms = {'vm1': {"host_string": "192.168.122.100", "user": "fedora"},
+                       'vm2': {"host_string": "192.168.122.101", "user": "fedora"},
+                       'vm3': {"host_string": "192.168.122.102", "user": "fedora"}}
+        # vm3 needs two more tries before sshd answers
+        banners = {'192.168.122.100': [True], '192.168.122.101': [True],
+                   '192.168.122.102': [False, False, True]}
+        t_banner.side_effect = lambda host, port: banners[host].pop(0)
+        r1 = Result("")
+        r1.return_code = 0
+        t_pool.run.return_value = r1
+        self.assertTrue(tunirutils.poll_directive('POLL vm2,vm3', tconfig))
+        self.assertEqual(t_pool.run.call_count, 2)
+        self.assertEqual(t_sleep.call_count, 2)
+        self.assertEqual(banners['192.168.122.100'], [True])
+
+    @patch('tunirlib.tunirutils.ssh_banner_ready', return_value=False)
+    @patch('time.time')
+    @patch('time.sleep')
+    def test_wait_ready_deadline(self, t_sleep, t_time, t_banner):
+        config = {"host_string": "192.168.122.100", "user": "fedora"}
+        t_time.side_effect = [0, 5, 20, 40]
+        self.assertFalse(tunirutils.wait_ready(config, deadline=30))
+        self.assertEqual(t_banner.call_count, 3)
+
+    def test_poll_unknown_vm(self):
+        "a typo in POLL fails the job"
+        tconfig = tunirutils.TunirConfig()
+        tconfig.general = {'keypath': 'private.pem'}
+        tconfig.vms = {'vm1': {"host_string": "192.168.122.100", "user": "fedora", "ip": "192.168.122.100"}}
+        tdir = tempfile.mkdtemp()
+        jobpath = os.path.join(tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('POLL vm5\n')
+        with captured_output() as (out, err):
+            status = tunirutils.run_job(jobpath, config=tconfig,
+                                        extra_config={'result_path': os.path.join(tdir, 'result.txt')})
+        self.assertFalse(status)
+        self.assertIn('Unknown vm vm5', out.getvalue())
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+    @patch('tunirlib.tunirutils.ssh_banner_ready', return_value=False)
+    @patch('time.sleep')
+    def test_wait_ready_failed(self, t_sleep, t_banner):
+        "stop waiting when qemu says the vm shut down"
+        config = {"host_string": "192.168.122.100", "user": "fedora"}
+        events = ['', 'SHUTDOWN']
+        with captured_output() as (out, err):
+            self.assertFalse(tunirutils.wait_ready(config, deadline=300, failed=lambda: events.pop(0)))
+        self.assertIn('SHUTDOWN', out.getvalue())
+        self.assertEqual(t_banner.call_count, 1)
+
+
+class TargetTests(unittest.TestCase):
+    """
+    Tests vm names, ranges and groups in the job file.
+    """
+    def setUp(self):
+        self.config = tunirutils.TunirConfig()
+        self.config.vms = OrderedDict((name, {"host_string": name, "user": "fedora"})
+                                      for name in ['master'] + ['vm%d' % i for i in range(1, 13)])
+        self.config.groups = {'workers': 'vm[2-4],vm12'}
+
+    def test_split_targets(self):
+        self.assertEqual(tunirutils.split_targets('ls /', self.config), (['vm1'], 'ls /'))
+        self.assertEqual(tunirutils.split_targets('master ls /', self.config), (['master'], 'ls /'))
+        self.assertEqual(tunirutils.split_targets('vm11 ls /', self.config), (['vm11'], 'ls /'))
+        self.assertEqual(tunirutils.split_targets('workers ls /', self.config),
+                         (['vm2', 'vm3', 'vm4', 'vm12'], 'ls /'))
+        names, command = tunirutils.split_targets('all ## uptime', self.config)
+        self.assertEqual(len(names), 13)
+        self.assertEqual(command, '## uptime')
+        with self.assertRaises(ValueError):
+            tunirutils.split_targets('vm[10-13] ls /', self.config)
+        self.assertEqual(tunirutils.expand_range('node[08-10]'), ['node08', 'node09', 'node10'])
+
+    def test_match_vm_ranges(self):
+        tdir = tempfile.mkdtemp()
+        jobpath = os.path.join(tdir, 'cluster.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('vm[1-12] ls /\nworkers uptime\nvm10,vm11 date\n')
+        vms = ['vm%d' % i for i in range(1, 13)]
+        self.assertTrue(tunirutils.match_vm_numbers(vms, jobpath, {'workers': 'vm2'}))
+        with captured_output() as (out, err):
+            self.assertFalse(tunirutils.match_vm_numbers(vms[:10], jobpath, {'workers': 'vm2'}))
+            self.assertIn('vm11', out.getvalue())
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+    @patch('tunirlib.tunirutils.execute')
+    def test_execute_fanout(self, t_execute):
+        def fake_execute(config, command):
+            res = Result(config['host_string'])
+            res.return_code = 1 if config['host_string'] == 'vm3' else 0
+            return res, 'no'
+        t_execute.side_effect = fake_execute
+        values = tunirutils.execute_fanout(self.config, ['vm2', 'vm3', 'vm4'], 'ls /')
+        self.assertEqual([(name, res.return_code) for name, res, negative in values],
+                         [('vm2', 0), ('vm3', 1), ('vm4', 0)])
+
 
 class UpdateResultTest(unittest.TestCase):
     """
@@ -216,6 +1365,456 @@ class UpdateResultTest(unittest.TestCase):
             self.assertEqual(out[1]['status'], result)
 
 
+class BakeTests(unittest.TestCase):
+    """
+    Tests the baked images.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tdir, 'base.qcow2')
+        with open(self.base, 'w') as fobj:
+            fobj.write('base image')
+
+    def tearDown(self):
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    def test_split_setup(self):
+        lines = ['sudo dnf install -y nginx\n', 'BAKE\n', 'vm1 curl localhost\n']
+        self.assertEqual(tunirbake.split_setup(lines), (lines[:1], lines[2:]))
+        self.assertEqual(tunirbake.split_setup(lines[:1]), (lines[:1], []))
+
+    def test_store(self):
+        store = tunirbake.BakeStore(os.path.join(self.tdir, 'baked'))
+        digest = store.input_hash(self.base, ['sudo dnf install -y nginx'])
+        self.assertEqual(digest, store.input_hash(self.base, ['sudo dnf install -y nginx  \n']))
+        self.assertNotEqual(digest, store.input_hash(self.base, ['sudo dnf install -y httpd']))
+        self.assertEqual(store.lookup('web'), '')
+        with self.assertRaises(ValueError):
+            store.resolve('baked:web')
+        os.makedirs(store.path, exist_ok=True)
+        first = store.image_path('web', digest)
+        with open(first, 'w') as fobj:
+            fobj.write('baked')
+        store.add('web', digest, self.base)
+        self.assertEqual(store.resolve('baked:web'), first)
+        self.assertEqual(store.resolve(self.base), self.base)
+        self.assertEqual(store.lookup('web', digest), first)
+        # The base image changed
+        with open(self.base, 'w') as fobj:
+            fobj.write('new base image')
+        os.utime(self.base, (1, 1))
+        new_digest = store.input_hash(self.base, ['sudo dnf install -y nginx'])
+        self.assertNotEqual(digest, new_digest)
+        self.assertEqual(store.lookup('web', new_digest), '')
+        second = store.image_path('web', new_digest)
+        with open(second, 'w') as fobj:
+            fobj.write('baked')
+        store.add('web', new_digest, self.base)
+        self.assertFalse(os.path.exists(first))
+
+    @patch('tunirlib.tunirmultihost.start_multihost', return_value=True)
+    def test_bake_job(self, p_start):
+        with open(os.path.join(self.tdir, 'web.cfg'), 'w') as fobj:
+            fobj.write('[general]\nbake_dir = {0}\n\n[vm1]\nuser = fedora\nimage = {1}\n'.format(
+                os.path.join(self.tdir, 'baked'), self.base))
+        with open(os.path.join(self.tdir, 'web.txt'), 'w') as fobj:
+            fobj.write('sudo dnf install -y nginx\nBAKE\ncurl localhost\n')
+        with captured_output() as (out, err):
+            self.assertTrue(tunirmultihost.bake_job('web', self.tdir))
+            path = p_start.call_args[1]['bake']
+            with open(path, 'w') as fobj:
+                fobj.write('baked')
+            # Nothing changed, so nothing to do
+            self.assertTrue(tunirmultihost.bake_job('web', self.tdir))
+        self.assertEqual(p_start.call_count, 1)
+        self.assertIn('baked:web is up to date', out.getvalue())
+
+    @patch('tunirlib.tunirmultihost.POOL')
+    def test_bake_failed_boot(self, p_pool):
+        "no sealing for a vm which did not come up, and the teardown still runs"
+        p_pool.run.side_effect = socket.error('No route to host')
+        with captured_output() as (out, err):
+            self.assertFalse(tunirmultihost.seal_image({'host_string': '127.0.0.1', 'user': 'fedora'},
+                                                       os.path.join(self.tdir, 'new.qcow2')))
+        self.assertIn('Sealing the image failed: No route to host', out.getvalue())
+        p_pool.run.side_effect = None
+        config = {'type': 'bare', 'image': '127.0.0.1', 'ip': '127.0.0.1', 'user': 'fedora', 'history': 'off',
+                  'key': os.path.join(self.tdir, 'private.pem')}
+        with open(config['key'], 'w') as fobj:
+            fobj.write(tunirmultihost.generate_sshkey(1024)[0])
+        jobpath = os.path.join(self.tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('')
+        with captured_output() as (out, err), \
+                patch('tunirlib.tunirreap.RUNS_DIR', self.tdir), \
+                patch('tunirlib.tunirnet.LEASE_PATH', os.path.join(self.tdir, 'leases.json')), \
+                patch('tunirlib.tunirmultihost.run_job', side_effect=tunirutils.IPException()), \
+                patch('tunirlib.tunirmultihost.create_seed_img'), \
+                patch('tunirlib.tunirmultihost.seal_image') as p_seal:
+            self.assertFalse(tunirmultihost.start_multihost('job', jobpath, oldconfig=config, config_dir=self.tdir,
+                                                            bake=os.path.join(self.tdir, 'new.qcow2')))
+        self.assertFalse(p_seal.called)
+        self.assertEqual([name for name in os.listdir(self.tdir) if name.startswith('run-')], [])
+
+
+class ScratchTests(unittest.TestCase):
+    """
+    Tests the RAM backed run directories.
+    """
+    @patch('tunirlib.tunirscratch.mem_available')
+    def test_scratch(self, p_mem):
+        MB = tunirscratch.MB
+        root = tempfile.mkdtemp()
+        p_mem.return_value = 3000 * MB
+        scratch = tunirscratch.Scratch(root, headroom=1000 * MB)
+        seed = scratch.mkdtemp('seed', 1 * MB)
+        vm1 = scratch.mkdtemp('vm1', 500 * MB, 1024 * MB)
+        with captured_output() as (out, err):
+            # 1000 MB of vm1 headroom, 1500 MB more and 1024 MB for the guest is too much
+            vm2 = scratch.mkdtemp('vm2', 500 * MB, 1024 * MB)
+        self.assertIn('Not enough RAM for vm2', out.getvalue())
+        self.assertTrue(seed.startswith(root))
+        self.assertTrue(vm1.startswith(root))
+        self.assertFalse(vm2.startswith(root))
+        self.assertEqual(scratch.prefixes(), ('/tmp', root))
+        with open(os.path.join(vm1, 'disk.qcow2'), 'wb') as fobj:
+            fobj.write(b'a' * 2 * MB)
+        lines = scratch.report()
+        self.assertIn('scratch: vm1 ram 2.0 MB', lines[1])
+        self.assertTrue(lines[-1].startswith('scratch total: ram 2.0 MB, disk 0.0 MB'))
+        tunirutils.clean_tmp_dirs([seed, vm1, vm2], scratch.prefixes())
+        self.assertFalse(os.path.exists(vm1))
+        self.assertFalse(os.path.exists(vm2))
+        self.assertEqual(tunirscratch.scratch_root('ram'), '/dev/shm')
+        self.assertFalse(tunirscratch.Scratch('').fits(0))
+        # The memory of the first guest counts before it uses it
+        scratch = tunirscratch.Scratch(root, headroom=100 * MB)
+        vm1 = scratch.mkdtemp('vm1', 10 * MB, 1500 * MB)
+        with captured_output() as (out, err):
+            vm2 = scratch.mkdtemp('vm2', 10 * MB, 1500 * MB)
+        self.assertTrue(vm1.startswith(root))
+        self.assertFalse(vm2.startswith(root))
+        self.assertEqual(scratch.reserved_ram, 1500 * MB)
+        tunirutils.clean_tmp_dirs([vm1, vm2, root], scratch.prefixes())
+
+
+class ReapTests(unittest.TestCase):
+    """
+    Tests the run manifest and the reaper of crashed runs.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    @patch('tunirlib.tunirreap.destroy_box')
+    @patch('tunirlib.tunirreap.stop_vm')
+    @patch('tunirlib.tunirreap.is_qemu')
+    @patch('tunirlib.tunirreap.pid_alive')
+    def test_reap(self, p_alive, p_qemu, p_stop, p_destroy):
+        vmdir = tempfile.mkdtemp()
+        lease_file = os.path.join(self.tdir, 'leases.json')
+        manifest = tunirreap.RunManifest(path=os.path.join(self.tdir, 'run-1234.json'))
+        manifest.set('pid', 1234)
+        manifest.set('lease_file', lease_file)
+        manifest.add('dirs', [vmdir, vmdir])
+        manifest.add_vm('vm1', {'process': '4242', 'qmp': '/tmp/qmp.sock', 'mac': 'ABCD'})
+        node = tunirreap.RunManifest('node', path=os.path.join(self.tdir, 'run-1234-node.json'))
+        node.set('pid', 1234)
+        node.set('vagrant', {'path': '/tmp/box', 'name': 'box', 'provider': 'libvirt'})
+        with open(manifest.path) as fobj:
+            data = json.load(fobj)
+        self.assertEqual(data['dirs'], [vmdir])
+        self.assertEqual(data['vms'], {'vm1': {'process': '4242', 'qmp': '/tmp/qmp.sock'}})
+        # The tunir process is still running
+        p_alive.return_value = True
+        self.assertEqual(tunirreap.reap(self.tdir), 0)
+        self.assertTrue(os.path.exists(vmdir))
+
+        p_alive.return_value = False
+        p_qemu.return_value = True
+        with captured_output() as (out, err):
+            self.assertEqual(tunirreap.reap(self.tdir), 2)
+        p_stop.assert_called_once_with({'process': '4242', 'qmp': '/tmp/qmp.sock'})
+        p_destroy.assert_called_once_with('/tmp/box', 'box', 'libvirt')
+        self.assertFalse(os.path.exists(vmdir))
+        self.assertTrue(os.path.exists(lease_file))
+        self.assertEqual([name for name in os.listdir(self.tdir) if name.startswith('run-')], [])
+
+    def test_marker(self):
+        marker = tunirreap.run_marker()
+        self.assertFalse(tunirreap.marker_dead(marker))
+        with patch('tunirlib.tunirreap.pid_alive', return_value=False):
+            self.assertTrue(tunirreap.marker_dead(marker))
+            # Runs from other hosts are not ours to clean
+            self.assertFalse(tunirreap.marker_dead('otherhost:1234'))
+
+    @patch('tunirlib.tunirmultihost.os._exit')
+    @patch('tunirlib.tunirmultihost.background')
+    def test_background_teardown(self, p_back, p_exit):
+        "the parent returns before the teardown, the child does it and exits"
+        config = {'type': 'bare', 'image': '127.0.0.1', 'ip': '127.0.0.1', 'user': 'fedora',
+                  'teardown': 'background', 'key': os.path.join(self.tdir, 'private.pem')}
+        with open(config['key'], 'w') as fobj:
+            fobj.write(tunirmultihost.generate_sshkey(1024)[0])
+        jobpath = os.path.join(self.tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('')
+        for parent in (True, False):
+            p_back.return_value = parent
+            with captured_output() as (out, err), \
+                    patch('tunirlib.tunirreap.RUNS_DIR', self.tdir), \
+                    patch('tunirlib.tunirhistory.HISTORY_PATH', os.path.join(self.tdir, 'history.db')), \
+                    patch('tunirlib.tunirnet.LEASE_PATH', os.path.join(self.tdir, 'leases.json')), \
+                    patch('tunirlib.tunirmultihost.run_job', return_value=True), \
+                    patch('tunirlib.tunirmultihost.create_seed_img'), \
+                    patch('tunirlib.tunirmultihost.POOL'):
+                self.assertTrue(tunirmultihost.start_multihost('job', jobpath, oldconfig=dict(config),
+                                                               config_dir=self.tdir))
+            manifests = [name for name in os.listdir(self.tdir) if name.startswith('run-')]
+            if parent:
+                self.assertIn('Tearing down in the background.', out.getvalue())
+                self.assertFalse(p_exit.called)
+                self.assertEqual(len(manifests), 1)
+                with open(os.path.join(self.tdir, manifests[0])) as fobj:
+                    tunirutils.clean_tmp_dirs(json.load(fobj)['dirs'])
+                os.unlink(os.path.join(self.tdir, manifests[0]))
+            else:
+                p_exit.assert_called_once_with(0)
+                self.assertEqual(manifests, [])
+
+
+    @patch('os._exit')
+    @patch('tunirlib.tunirmultihost.background')
+    def test_background_teardown_failed(self, p_back, p_exit):
+        "the child exits even when the teardown fails, and owns the manifest from the fork on"
+        pids = [1111]
+
+        def fork():
+            pids[0] = 2222
+            return False
+        p_back.side_effect = fork
+        config = {'type': 'bare', 'image': '127.0.0.1', 'ip': '127.0.0.1', 'user': 'fedora',
+                  'teardown': 'background', 'history': 'off'}
+        jobpath = os.path.join(self.tdir, 'job.txt')
+        with open(jobpath, 'w') as fobj:
+            fobj.write('')
+        with captured_output() as (out, err), \
+                patch('os.getpid', side_effect=lambda: pids[0]), \
+                patch('tunirlib.tunirreap.RUNS_DIR', self.tdir), \
+                patch('tunirlib.tunirnet.LEASE_PATH', os.path.join(self.tdir, 'leases.json')), \
+                patch('tunirlib.tunirmultihost.run_job', return_value=True), \
+                patch('tunirlib.tunirmultihost.create_seed_img'), \
+                patch('tunirlib.tunirmultihost.clean_tmp_dirs', side_effect=OSError('busy')), \
+                patch('tunirlib.tunirmultihost.POOL'):
+            tunirmultihost.start_multihost('job', jobpath, oldconfig=config, config_dir=self.tdir)
+        p_exit.assert_called_once_with(0)
+        with open(os.path.join(self.tdir, 'run-1111.json')) as fobj:
+            data = json.load(fobj)
+        self.assertEqual(data['pid'], 2222)
+        tunirutils.clean_tmp_dirs(data['dirs'])
+
+
+class HistoryTests(unittest.TestCase):
+    """
+    Tests the run history and the regression gate.
+    """
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.history = tunirhistory.History(os.path.join(self.tdir, 'history.db'))
+
+    def tearDown(self):
+        self.history.close()
+        tunirutils.clean_tmp_dirs([self.tdir, ])
+
+    def steps(self, elapsed, status='True'):
+        return OrderedDict([('vm1 make', {'command': 'vm1 make', 'status': status, 'elapsed': str(elapsed)}),
+                            ('vm1 ls', {'command': 'vm1 ls', 'status': 'True'})])
+
+    def test_history(self):
+        vms = {'vm1': {'boot_time': '4.20', 'boot_mode': 'kernel'}}
+        for elapsed in (10.0, 10.5, 9.5, 10.2, 9.8):
+            self.history.record('job', time.time(), True, self.steps(elapsed), vms,
+                                {'vm1': ('/tmp/f.qcow2', 'abcd')})
+        self.history.record('other', time.time(), True, self.steps(100.0), {})
+        self.history.record('job', time.time(), False, self.steps(100.0, ''), vms)
+        # Failed steps are not in the history of the step
+        self.assertEqual(sorted(self.history.step_times('job', 'vm1 make')), [9.5, 9.8, 10.0, 10.2, 10.5])
+        self.assertEqual(self.history.regressions('job', self.steps(10.4), 3), [])
+        lines = self.history.regressions('job', self.steps(12.0), 3)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith('regression: vm1 make took 12.00 seconds, history mean 10.00'))
+        # Not enough history
+        self.assertEqual(self.history.regressions('other', self.steps(500.0), 3), [])
+        lines = self.history.report('job')
+        self.assertEqual(len(self.history.runs('job')), 6)
+        self.assertIn(' fail boot: vm1 4.20s', lines[1])
+        self.assertEqual(lines[-1], 'vm1 make: 6 runs, mean 25.00s, min 9.50s, max 100.00s')
+
+    def test_history_path(self):
+        path = os.path.join(self.tdir, 'history.db')
+        self.assertEqual(tunirhistory.history_path(path), path)
+        with patch('tunirlib.tunirhistory.os.access', return_value=False), \
+                patch.dict(os.environ, {'HOME': self.tdir}):
+            self.assertEqual(tunirhistory.history_path('/var/lib/tunir/history.db'),
+                             os.path.join(self.tdir, '.local', 'share', 'tunir', 'history.db'))
+
+    def test_record_history(self):
+        "the gate fails the job, and the failed run goes to the history"
+        config = tunirutils.TunirConfig()
+        config.general = {'history': os.path.join(self.tdir, 'history.db'), 'regression_sigma': '2'}
+        config.vms = {'vm1': {'ip': '127.0.0.1'}}
+        for elapsed in (10.0, 10.5, 9.5, 10.2, 9.8):
+            self.history.record('job', time.time(), True, self.steps(elapsed), {})
+        result_path = os.path.join(self.tdir, 'result.txt')
+        store = tunirbake.BakeStore(self.tdir)
+        with patch.dict(tunirutils.STR, self.steps(10.1), clear=True), captured_output() as (out, err):
+            self.assertTrue(tunirmultihost.record_history('job', time.time(), True, config, store, result_path))
+        with patch.dict(tunirutils.STR, self.steps(20.0), clear=True), captured_output() as (out, err):
+            self.assertFalse(tunirmultihost.record_history('job', time.time(), True, config, store, result_path))
+        with open(result_path) as fobj:
+            self.assertIn('regression: vm1 make took 20.00 seconds', fobj.read())
+        self.assertEqual([run[3] for run in self.history.runs('job', 2)], [0, 1])
+        config.general['history'] = 'off'
+        self.assertFalse(tunirmultihost.record_history('job', time.time(), False, config, store, result_path))
+        self.assertEqual(len(self.history.runs('job')), 7)
+
+
+class SampleTests(unittest.TestCase):
+    """
+    Tests the sampler of the vm processes.
+    """
+    def test_read_proc(self):
+        values = tunirsample.read_proc(os.getpid())
+        self.assertGreater(values['rss'], 0)
+        self.assertGreater(values['cpu'], 0)
+        self.assertEqual(tunirsample.read_proc(2 ** 22 + 1), {})
+
+    def test_sampler(self):
+        "the CPU time goes to the step which used it"
+        tdir = tempfile.mkdtemp()
+        path = os.path.join(tdir, 'samples.csv')
+        vms = {'vm1': {'process': str(os.getpid())}, 'vm2': {'ip': '192.168.1.100'}}
+        self.assertIsNone(tunirsample.start_sampler(vms, 0, path))
+        sampler = tunirsample.start_sampler(vms, 60, path)
+        self.assertEqual(sampler.pids, {'vm1': os.getpid()})
+        sampler.mark('vm1 make')
+        start = time.process_time()
+        while time.process_time() - start < 0.3:
+            pass
+        sampler.mark('vm1 sleep 1')
+        sampler.stop()
+        sampler.stop()
+        self.assertGreater(sampler.steps['vm1 make']['vm1']['cpu'], 0.1)
+        self.assertLess(sampler.steps['vm1 sleep 1']['vm1']['cpu'], 0.1)
+        lines = sampler.report()
+        self.assertTrue(lines[0].startswith('resources: vm1 cpu '))
+        self.assertTrue([line for line in lines if line.startswith('resources: vm1 [vm1 make] cpu ')])
+        self.assertEqual(lines[-1], 'resources: samples in {0}'.format(path))
+        with open(path) as fobj:
+            rows = fobj.read().splitlines()
+        self.assertEqual(rows[0], 'time,vm,step,cpu,rss,read,write,load')
+        # The first sample is the start, then one for each mark and the last one
+        self.assertEqual(len(rows), 4)
+        self.assertIn(',vm1,"vm1 make",', rows[2])
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+
+class QMPTests(unittest.TestCase):
+    """
+    Tests the QMP client and the guest agent helpers
+    """
+
+    def fake_qemu(self, path):
+        "Answers like qemu, with an event before the reply to query-status"
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+
+        def serve():
+            conn, _ = server.accept()
+            conn.sendall(b'{"QMP": {"version": {}, "capabilities": []}}\n')
+            for line in conn.makefile('r'):
+                message = json.loads(line)
+                replies = []
+                if message['execute'] == 'query-status':
+                    replies.append({'event': 'STOP'})
+                    replies.append({'return': {'status': 'running'}, 'id': message['id']})
+                elif message['execute'] == 'system_powerdown':
+                    replies.append({'return': {}, 'id': message['id']})
+                    replies.append({'event': 'SHUTDOWN'})
+                else:
+                    replies.append({'return': {}, 'id': message['id']})
+                for reply in replies:
+                    conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+            conn.close()
+            server.close()
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+
+    def test_qmp_client(self):
+        "replies go to the command, events to the queue"
+        tdir = tempfile.mkdtemp()
+        path = os.path.join(tdir, 'qmp.sock')
+        self.fake_qemu(path)
+        client = tunirqmp.QMPClient(path, timeout=5).connect()
+        self.assertEqual(client.query_status(), 'running')
+        self.assertEqual(client.seen_event(), '')
+        client.execute('system_powerdown')
+        self.assertEqual(client.wait_event('SHUTDOWN', 5)['event'], 'SHUTDOWN')
+        client.close()
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+    @patch('tunirlib.tunirqmp.guest_agent')
+    def test_guest_ip(self, p_agent):
+        "IP address of the right network card"
+        p_agent.return_value = [
+            {'name': 'lo', 'hardware-address': '00:00:00:00:00:00',
+             'ip-addresses': [{'ip-address-type': 'ipv4', 'ip-address': '127.0.0.1'}]},
+            {'name': 'eth0', 'hardware-address': '00:16:3e:7f:00:01',
+             'ip-addresses': [{'ip-address-type': 'ipv6', 'ip-address': 'fe80::1'},
+                              {'ip-address-type': 'ipv4', 'ip-address': '192.168.122.7'}]}]
+        self.assertEqual(tunirqmp.guest_ip('qga.sock', '00:16:3E:7F:00:01'), '192.168.122.7')
+        self.assertEqual(tunirqmp.guest_ip('qga.sock', '00:16:3e:7f:00:02'), '')
+        p_agent.side_effect = OSError("No agent yet")
+        self.assertEqual(tunirqmp.guest_ip('qga.sock', '00:16:3e:7f:00:01'), '')
+
+    @patch('tunirlib.tunirqmp.os.kill')
+    def test_stop_vm_kill(self, p_kill):
+        "kill the vm when QMP does not work"
+        tdir = tempfile.mkdtemp()
+        broken = os.path.join(tdir, 'qmp.sock')
+        with open(broken, 'w') as fobj:
+            fobj.write('not a socket')
+        tunirqmp.stop_vm({'process': '42', 'qmp': broken}, timeout=5)
+        tunirqmp.stop_vm({'process': '43'})
+        self.assertEqual(p_kill.call_args_list, [call(42, signal.SIGKILL), call(43, signal.SIGKILL)])
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+    @patch('tunirlib.tunirqmp.os.kill')
+    def test_no_greeting(self, p_kill):
+        "qemu closes the socket before the greeting"
+        tdir = tempfile.mkdtemp()
+        path = os.path.join(tdir, 'qmp.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(2)
+
+        def serve():
+            for i in range(2):
+                server.accept()[0].close()
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        with self.assertRaises(tunirqmp.QMPError):
+            tunirqmp.QMPClient(path, timeout=5).connect()
+        tunirqmp.stop_vm({'process': '42', 'qmp': path}, timeout=5)
+        p_kill.assert_called_with(42, signal.SIGKILL)
+        thread.join()
+        server.close()
+        tunirutils.clean_tmp_dirs([tdir, ])
+
+
 class TestVagrant(unittest.TestCase):
     "To test the vagrant class"
 
@@ -10,9 +10,12 @@ except:
 from typing import Dict
 
 from .tunirvagrant import vagrant_and_run
-from .tuniraws import aws_and_run
-from .tunirmultihost import start_multihost
+from .tuniraws import aws_and_run, reap_nodes
+from .tunirmultihost import start_multihost, boot_benchmark, bake_job, compare_images
 from .tunirutils import run_job, Result
+from .tunirhistory import History
+from .tunirfleet import fleet_run
+from .tunirreap import RunManifest, background, reap, run_marker, marker_dead
 from collections import OrderedDict
 
 
@@ -54,7 +57,35 @@ def main(args):
 
     if args.debug:
         debug = True
+    if args.reap:
+        # Clean up after the crashed runs, before we take new resources
+        count = reap()
+        if args.job:
+            config = read_job_configuration(args.job, args.config_dir)
+            if config and config['type'] == 'aws':
+                count += reap_nodes(config, marker_dead)
+        print("Reaped {0} runs.".format(count))
+        if not (args.multi or args.job):
+            sys.exit(0)
+    if args.history:
+        history = History(args.history_db)
+        for line in history.report(args.history):
+            print(line)
+        history.close()
+        sys.exit(0)
+    if args.bake:
+        status = bake_job(args.bake, args.config_dir)
+        os.system('stty sane')
+        sys.exit(0 if status else 2)
     # For multihost
+    if args.multi and args.compare:
+        status = compare_images(args.multi, args.config_dir, tuple(args.compare))
+        os.system('stty sane')
+        sys.exit(0 if status else 2)
+    if args.multi and args.boot_bench:
+        boot_benchmark(args.multi, args.config_dir, args.boot_bench)
+        os.system('stty sane')
+        sys.exit(0)
     if args.multi:
         jobpath = os.path.join(args.config_dir, args.multi + '.txt')
         status = start_multihost(args.multi, jobpath, debug, config_dir=args.config_dir)
@@ -77,6 +108,11 @@ def main(args):
         sys.exit(-1)
 
     os.system('mkdir -p /var/run/tunir')
+    if config['type'] == 'bare' and (config.get('hosts') or config.get('inventory')):
+        status = fleet_run(job_name, jobpath, config, args.config_dir)
+        if status:
+            return_code = 0
+        sys.exit(return_code)
     if config['type'] == 'vm':
         status = start_multihost(job_name, jobpath, debug, config, args.config_dir)
         if status:
@@ -84,13 +120,16 @@ def main(args):
         os.system('stty sane')
         sys.exit(return_code)
 
+    manifest = RunManifest('node')
     if config['type'] == 'vagrant':
         node, config = vagrant_and_run(config)
+        manifest.set('vagrant', {'path': node.path, 'name': node.name, 'provider': node.provider})
         if node.failed:
             run_job_flag = False
 
     elif config['type'] == 'aws':
-        node, config = aws_and_run(config)
+        # The node has the tag, tunir --reap --job finds it with the same credentials
+        node, config = aws_and_run(config, run_marker())
         if node.failed:
             run_job_flag = False
         else:
@@ -108,8 +147,25 @@ def main(args):
                 return_code = 0
     finally:
         if config['type'] != 'bare':
-            # Destroy and remove the Vagrant box or AWS instance
-            node.destroy()
+            child = False
+            if config.get('teardown') == 'background':
+                if background():
+                    print("Tearing down in the background.")
+                    sys.exit(return_code)
+                child = True
+                # tunir --reap must wait for this process, not for the parent
+                manifest.set('pid', os.getpid())
+            try:
+                # Destroy and remove the Vagrant box or AWS instance
+                node.destroy()
+                manifest.remove()
+            except Exception as err:
+                if not child:
+                    raise
+                log.error("Teardown failed: {0}".format(err))
+            finally:
+                if child: # Never back into the call stack of the parent
+                    os._exit(0)
 
         sys.exit(return_code)
 
@@ -121,6 +177,16 @@ def startpoint():
                         default='./')
     parser.add_argument("--debug", help="Keep the vms running for debug in multihost mode.", action='store_true')
     parser.add_argument("--multi", help="The multivm configuration using .cfg configuration file")
+    parser.add_argument("--boot-bench", help="Boot the vm(s) of the multivm configuration this many times with and "
+                        "without the direct kernel boot, and print the boot times.", type=int, default=0)
+    parser.add_argument("--bake", help="Bake a new image for the multivm configuration with the setup section "
+                        "of the job file.")
+    parser.add_argument("--reap", help="Clean up the vm(s), directories and leases of crashed tunir runs. With "
+                        "--multi or --job we run the job after that.", action='store_true')
+    parser.add_argument("--compare", help="Run the multivm job with two images side by side, and compare the "
+                        "time of each step.", nargs=2, metavar=('IMAGE_A', 'IMAGE_B'))
+    parser.add_argument("--history", help="Show the last runs of the job, and the time of each step.")
+    parser.add_argument("--history-db", help="Path of the history database.", default='')
     args = parser.parse_args()
 
     main(args)
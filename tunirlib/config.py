@@ -11,6 +11,46 @@ password: %s
 chpasswd: { expire: False }
 ssh_pwauth: True
 """ 
+# Appended to USER_DATA to add the other vm(s) in /etc/hosts (base64 text)
+HOSTS_USER_DATA = """bootcmd:
+  - [ cloud-init-per, once, tunir-hosts, sh, -c, "echo {0} | base64 -d >> /etc/hosts" ]
+"""
+NETWORK_CONFIG = """version: 2
+ethernets:
+  tunir0:
+    match:
+      macaddress: "{mac}"
+    addresses: [ "{ip}/{prefix}" ]
+    gateway4: {gateway}
+    nameservers:
+      addresses: [ {gateway} ]
+"""
+# For user mode networking, the first card gets DHCP from qemu, the second one
+# is on the multicast network between the vm(s)
+USER_NETWORK_CONFIG = """version: 2
+ethernets:
+  tunir0:
+    match:
+      macaddress: "{user_mac}"
+    dhcp4: true
+  tunir1:
+    match:
+      macaddress: "{mac}"
+    addresses: [ "{ip}/{prefix}" ]
+"""
+# Named qemu performance profiles, selected with profile = NAME in the general
+# section or in a vm section. Any of PROFILE_KEYS given there overrides the profile.
+PROFILE_KEYS = ('cpu_model', 'cache', 'aio', 'vhost', 'queues', 'hugepages', 'iothreads')
+QEMU_PROFILES = {
+    'default': {},
+    # For throwaway overlays, the disk writes never need to reach the host disk
+    'fast': {'cpu_model': 'host', 'cache': 'unsafe', 'aio': 'io_uring', 'vhost': 'on'},
+    # For guest benchmarks, stable numbers without the host page cache
+    'bench': {'cpu_model': 'host', 'cache': 'none', 'aio': 'io_uring', 'vhost': 'on', 'queues': 'auto',
+              'iothreads': '1'},
+}
+# Kernel command line for the direct kernel boot of the cloud images
+FASTBOOT_APPEND = 'root=/dev/vda1 ro console=ttyS0 quiet'
 ATOMIC_USER_DATA = """#cloud-config
 password: %s
 chpasswd: { expire: False }
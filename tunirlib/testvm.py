@@ -12,10 +12,10 @@ import subprocess
 from .config import USER_DATA
 
 
-def create_user_data(path, password):
-    # type: (str, str) -> str
+def create_user_data(path, password, extra=''):
+    # type: (str, str, str) -> str
     "Creates a simple user data file"
-    file_data = USER_DATA % password
+    file_data = USER_DATA % password + extra
     with open(path + '/meta/user-data', 'w') as user_file:
         user_file.write(file_data)
     return "user-data file generated."
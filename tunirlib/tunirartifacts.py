@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"Tunir module to collect the artifacts (logs, test results) of the vm(s) at the end of a job"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import time
+import logging
+import concurrent.futures
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Any
+
+from .tunirutils import TunirConfig, POOL, expand_targets
+
+log = logging.getLogger('tunir')
+
+MB = 1024 * 1024
+# Default cap of the compressed artifacts of each vm, in MB
+ARTIFACTS_MAX = 100
+
+
+def artifact_globs(config: TunirConfig) -> Dict[str, List[str]]:
+    """
+    Finds the remote globs to collect from each vm, from the artifacts
+    section. The keys are vm names, ranges, groups or all.
+
+    :param config: TunirConfig with the vm(s).
+    :return: Ordered dictionary of vm names to the globs.
+    """
+    result = OrderedDict() # type: Dict[str, List[str]]
+    for target, value in config.artifacts.items():
+        for name in expand_targets(target, config):
+            globs = result.setdefault(name, [])
+            globs.extend(item for item in value.split() if item not in globs)
+    return result
+
+
+def tar_command(globs: List[str]) -> str:
+    "The shell command which writes a compressed tar of the globs, as root if we can"
+    paths = ' '.join(item.lstrip('/') or '.' for item in globs)
+    return ("S=''; if [ $(id -u) != 0 ] && sudo -n true 2>/dev/null; then S='sudo -n'; fi; "
+            "cd / && $S tar czf - --ignore-failed-read {0} 2>/dev/null".format(paths))
+
+
+def stream_artifacts(vm: Dict[str, Any], globs: List[str], path: str, cap: int) -> Tuple[int, float, bool]:
+    """
+    Streams a compressed tar of the globs from a vm into a file, on a new
+    channel of the pooled connection.
+
+    :param vm: Configuration dictionary of the vm.
+    :param globs: Remote globs, absolute paths.
+    :param path: Path of the local .tar.gz file.
+    :param cap: Maximum bytes we write.
+    :return: (bytes, seconds, True if we stopped at the cap)
+    """
+    start = time.perf_counter()
+    chan = POOL.client(vm).get_transport().open_session()
+    chan.settimeout(int(vm.get('timeout', 600)))
+    chan.exec_command(tar_command(globs))
+    size = 0
+    truncated = False
+    try:
+        with open(path, 'wb') as fobj:
+            while True:
+                data = chan.recv(1024 * 1024)
+                if not data:
+                    break
+                if size + len(data) > cap:
+                    fobj.write(data[:cap - size])
+                    size = cap
+                    truncated = True
+                    break
+                fobj.write(data)
+                size += len(data)
+    finally:
+        chan.close()
+    return size, time.perf_counter() - start, truncated
+
+
+def collect_artifacts(config: TunirConfig, path: str, cap: int=ARTIFACTS_MAX * MB) -> List[str]:
+    """
+    Collects the artifacts of all the vm(s) at the same time, one
+    vmname.tar.gz for each vm in the artifacts directory.
+
+    :param config: TunirConfig with the vm(s) and the artifacts section.
+    :param path: The artifacts directory of the run.
+    :param cap: Maximum bytes for each vm.
+    :return: Lines for the report.
+    """
+    try:
+        targets = artifact_globs(config)
+    except ValueError as err: # Like an unknown vm name
+        return ["artifacts: {0}".format(err)]
+    targets = OrderedDict((name, globs) for name, globs in targets.items() if config.vms[name].get('host_string'))
+    if not targets:
+        return []
+    os.makedirs(path, exist_ok=True)
+    lines = [] # type: List[str]
+    workers = int(config.general.get('fanout', 16) or 16)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(targets))) as executor:
+        futures = OrderedDict((name, executor.submit(stream_artifacts, config.vms[name], globs,
+                                                     os.path.join(path, name + '.tar.gz'), cap))
+                              for name, globs in targets.items())
+        for name, future in futures.items():
+            try:
+                size, seconds, truncated = future.result()
+            except Exception as err: # The vm may be gone, the others still count
+                log.error("Artifacts of {0}: {1}".format(name, err))
+                lines.append("artifacts: {0} failed: {1}".format(name, err))
+                continue
+            lines.append("artifacts: {0} {1:.1f} MB in {2:.2f} seconds{3} ({4})".format(
+                name, size / MB, seconds, ', stopped at the cap' if truncated else '',
+                os.path.join(path, name + '.tar.gz')))
+    return lines
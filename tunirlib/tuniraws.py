@@ -22,7 +22,7 @@ from typing import List, Dict, Set, Tuple, Union, Callable, TypeVar, Any, cast
 
 class EC2Node(object):
     def __init__(self, ACCESS_ID, SECRET_KEY, IMAGE_ID, SIZE_ID, region="us-west-1",
-                 aki=None, keyname='tunir', security_group='ssh', virt_type='paravirtual'):
+                 aki=None, keyname='tunir', security_group='ssh', virt_type='paravirtual', marker=''):
 
         print("Starting an AWS EC2 based job.")
         self.region = region
@@ -48,14 +48,17 @@ class EC2Node(object):
             self.failed = True
             return
         try:
+            # The tag tells tunir --reap which run created the node
+            tags = {'tunir': marker} if marker else {}
             if self.virt_type == 'hvm':
                 self.node = self.driver.create_node(name='tunir_test_node',
                                                     image=self.image, size=self.size, ex_keyname=keyname,
-                                                    ex_security_groups=[security_group, ], )
+                                                    ex_security_groups=[security_group, ], ex_metadata=tags)
             else:
                 self.node = self.driver.create_node(name='tunir_test_node',
                                                     image=self.image, size=self.size, ex_keyname=keyname,
-                                                    ex_security_groups=[security_group, ], kernel_id=aki )
+                                                    ex_security_groups=[security_group, ], kernel_id=aki,
+                                                    ex_metadata=tags)
             # Now we will try for 3 minutes to get an ip.
             for i in range(5):
                 time.sleep(30)
@@ -96,18 +99,40 @@ class EC2Node(object):
             print("There was in issue in destorying the node.")
 
 
-def aws_and_run(config):
+def aws_and_run(config, marker=''):
     """Takes a config object, starts a new EC2 instance, and then returns it.
 
     :param config: Dictionary
+    :param marker: Tag value to find the node later.
 
     :returns: EC2Node object
     """
     node = EC2Node(config['access_key'], config['secret_key'],
                    config['image'], config['size_id'], config.get('region', 'us-west-1'),
                    config.get('aki', None), config.get('keyname', 'ssh'), config.get('security_group', 'ssh'),
-                   config.get('virt_type', 'paravirtual'))
+                   config.get('virt_type', 'paravirtual'), marker)
     if not node.failed:  # Means we have an ip
         config['host_string'] = node.ip
         config['ip'] = node.ip
     return node, config
+
+
+def reap_nodes(config, dead):
+    # type: (Dict[str, Any], Callable[[str], bool]) -> int
+    """Destroys the EC2 nodes left behind by crashed tunir runs.
+
+    :param config: Dictionary with the AWS credentials and region.
+    :param dead: Function which finds if the run of a tunir tag is gone.
+
+    :returns: Number of nodes destroyed.
+    """
+    cls = get_driver(Provider.EC2)
+    driver = cls(config['access_key'], config['secret_key'], region=config.get('region', 'us-west-1'))
+    count = 0
+    for node in driver.list_nodes():
+        marker = node.extra.get('tags', {}).get('tunir', '')
+        if marker and node.state != 'terminated' and dead(marker):
+            print("Destroying EC2 node {0} of {1}".format(node.id, marker))
+            node.destroy()
+            count += 1
+    return count
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"Tunir module to keep the baked (golden) images"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import List, Dict, Tuple, Any
+
+log = logging.getLogger('tunir')
+
+BAKE_DIR = '/var/lib/tunir/baked'
+# Prefix of the image value in a .cfg file to use a baked image
+BAKED_PREFIX = 'baked:'
+# Line in the job file which ends the setup section
+BAKE_MARKER = 'BAKE'
+
+
+def split_setup(commands: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Splits the job file at the BAKE line, the setup section is before it.
+    Without a BAKE line the whole job file is the setup section.
+
+    :param commands: Lines of the job file.
+    :return: (setup lines, test lines)
+    """
+    for index, command in enumerate(commands):
+        if command.strip() == BAKE_MARKER:
+            return commands[:index], commands[index + 1:]
+    return commands, []
+
+
+class BakeStore(object):
+    """
+    Keeps the baked images of a directory, and an index.json with the name,
+    the path and the input hash of each of them. We also remember the hash
+    of the base images, so we do not read a big image again if it did not
+    change.
+    """
+    def __init__(self, path: str=BAKE_DIR) -> None:
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+
+    def load(self) -> Dict[str, Any]:
+        if not os.path.exists(self.index_path):
+            return {'images': {}, 'files': {}}
+        with open(self.index_path) as fobj:
+            return json.load(fobj)
+
+    def save(self, data: Dict[str, Any]) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        temppath = self.index_path + '.tmp'
+        with open(temppath, 'w') as fobj:
+            json.dump(data, fobj, indent=2)
+        os.rename(temppath, self.index_path)
+
+    def file_hash(self, path: str) -> str:
+        "sha256 of a file, from the index if the size and mtime did not change"
+        data = self.load()
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        known = data['files'].get(path, {})
+        if known.get('size') == stat.st_size and known.get('mtime') == stat.st_mtime:
+            return known['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fobj:
+            for block in iter(lambda: fobj.read(1024 * 1024), b''):
+                digest.update(block)
+        data['files'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest.hexdigest()}
+        self.save(data)
+        return digest.hexdigest()
+
+    def input_hash(self, base: str, setup: List[str], extra: str='') -> str:
+        """
+        Hash of everything which goes into a baked image.
+
+        :param base: Path to the base image.
+        :param setup: The setup lines of the job file.
+        :param extra: Any other input, like the user name.
+        :return: sha256 hex digest.
+        """
+        digest = hashlib.sha256()
+        digest.update(self.file_hash(base).encode('utf-8'))
+        for line in setup:
+            digest.update(line.strip().encode('utf-8') + b'\n')
+        digest.update(extra.encode('utf-8'))
+        return digest.hexdigest()
+
+    def lookup(self, name: str, digest: str='') -> str:
+        """
+        Finds the path of a baked image.
+
+        :param name: Name of the baked image.
+        :param digest: If given, only an image baked from these inputs.
+        :return: Path of the image, empty string if we do not have it.
+        """
+        image = self.load()['images'].get(name)
+        if not image or not os.path.exists(image['path']):
+            return ''
+        if digest and image['hash'] != digest:
+            return ''
+        return image['path']
+
+    def image_path(self, name: str, digest: str) -> str:
+        "Where the image baked from these inputs goes"
+        return os.path.join(self.path, '{0}-{1}.qcow2'.format(name, digest[:12]))
+
+    def add(self, name: str, digest: str, base: str) -> None:
+        "Records a new baked image, and removes the older one of the same name"
+        data = self.load()
+        path = self.image_path(name, digest)
+        old = data['images'].get(name, {}).get('path')
+        data['images'][name] = {'path': path, 'hash': digest, 'base': base, 'time': time.time()}
+        self.save(data)
+        if old and old != path and os.path.exists(old):
+            os.unlink(old)
+
+    def resolve(self, image: str) -> str:
+        """
+        Gives the path of an image value from the configuration, which can
+        be baked:NAME for a baked image.
+
+        :param image: The image value.
+        :return: Path of the image.
+        """
+        if not image.startswith(BAKED_PREFIX):
+            return image
+        path = self.lookup(image[len(BAKED_PREFIX):])
+        if not path:
+            raise ValueError("Missing baked image {0}, run tunir --bake first.".format(image))
+        return path
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"Tunir module to compare two images with the same job, side by side"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import configparser as ConfigParser
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Any
+
+from .tunirutils import TunirConfig, TARGET_DIRECTIVES, TRANSFER_DIRECTIVES, expand_targets, is_target, default_vm
+from .tunirbake import BAKE_MARKER
+
+# The copy of each vm which boots the second image
+COMPARE_SUFFIX = '-b'
+# Lines which run on the host, once for both images
+HOST_DIRECTIVES = ('SLEEP', 'HOSTCOMMAND:', 'HOSTTEST:', 'ANSIBLE', 'PLAYBOOK')
+# Directives which take both images in one line
+JOINED_DIRECTIVES = ('BENCH', 'GET', 'POLL')
+
+
+def compare_config(config: TunirConfig, images: Tuple[str, str]) -> TunirConfig:
+    """
+    Makes the configuration with two copies of each vm we boot, the first
+    with image A and the copy (name-b) with image B. Everything else,
+    like the profile and the memory, is the same for both.
+
+    :param config: Configuration of the job.
+    :param images: Paths of the images A and B.
+    :return: New TunirConfig.
+    """
+    result = TunirConfig()
+    result.general = dict(config.general)
+    result.groups = dict(config.groups)
+    result.artifacts = dict(config.artifacts)
+    copies = OrderedDict() # type: Dict[str, Dict[str, str]]
+    for name, vm in config.vms.items():
+        result.vms[name] = dict(vm)
+        if 'ip' in vm: # A remote machine, we can not boot it twice
+            continue
+        result.vms[name]['image'] = images[0]
+        copies[name + COMPARE_SUFFIX] = dict(vm, image=images[1])
+        if 'hostname' in vm:
+            copies[name + COMPARE_SUFFIX]['hostname'] = vm['hostname'] + COMPARE_SUFFIX
+    result.vms.update(copies)
+    for target, value in config.artifacts.items():
+        for name in expand_targets(target, config):
+            if name + COMPARE_SUFFIX in copies:
+                result.artifacts[name + COMPARE_SUFFIX] = value
+    return result
+
+
+def write_config(config: TunirConfig, path: str) -> None:
+    "Writes a TunirConfig as a .cfg file"
+    parser = ConfigParser.RawConfigParser()
+    parser.add_section('general')
+    for key, value in config.general.items():
+        parser.set('general', key, value)
+    for section, values in (('groups', config.groups), ('artifacts', config.artifacts)):
+        if values:
+            parser.add_section(section)
+            for key, value in values.items():
+                parser.set(section, key, value)
+    for name, vm in config.vms.items():
+        parser.add_section(name)
+        for key, value in vm.items():
+            parser.set(name, key, value)
+    with open(path, 'w') as fobj:
+        parser.write(fobj)
+
+
+def compare_job(commands: List[str], config: TunirConfig) -> Tuple[List[str], List[Tuple[str, str, str]]]:
+    """
+    Makes the job file which runs each step on the vm(s) of image A and
+    on the copies with image B, one after the other. Every other step B
+    goes first, so that neither gets a warm host all the time. A BENCH
+    line becomes one interleaved BENCH on both.
+
+    :param commands: Lines of the job file.
+    :param config: Configuration of the job, before compare_config.
+    :return: (lines of the new job file, (step, line for A, line for B) for each step)
+    """
+    def copies(names: List[str]) -> List[str]:
+        return [name + COMPARE_SUFFIX for name in names if 'ip' not in config.vms[name]]
+
+    lines = [] # type: List[str]
+    pairs = [] # type: List[Tuple[str, str, str]]
+    for command in commands:
+        command = command.strip(' \n')
+        words = command.split(' ')
+        if not command or command == BAKE_MARKER or command.startswith(HOST_DIRECTIVES):
+            lines.append(command)
+            continue
+        if words[0] in TRANSFER_DIRECTIVES and len(words) > TRANSFER_DIRECTIVES[words[0]]:
+            index = TRANSFER_DIRECTIVES[words[0]]
+            target, _, path = words[index].partition(':')
+            names = expand_targets(target, config)
+            others = copies(names)
+
+            def replaced(targets: List[str]) -> str:
+                return ' '.join(words[:index] + ['{0}:{1}'.format(','.join(targets), path)] + words[index + 1:])
+            if words[0] in JOINED_DIRECTIVES: # A GET from many vm(s) goes in a directory for each
+                line = replaced(names + others)
+                lines.append(line)
+                pairs.append((command, line, line))
+                continue
+            first = replaced(names)
+            second = replaced(others) if others else ''
+        elif words[0] in TARGET_DIRECTIVES:
+            if len(words) > 1 and is_target(words[1], config):
+                names, rest = expand_targets(words[1], config), words[2:]
+            else:
+                names, rest = [default_vm(config)], words[1:]
+            others = copies(names)
+            if words[0] in JOINED_DIRECTIVES:
+                line = ' '.join([words[0], ','.join(names + others)] + rest)
+                lines.append(line)
+                pairs.append((command, line, line))
+                continue
+            first = ' '.join([words[0], ','.join(names)] + rest)
+            second = ' '.join([words[0], ','.join(others)] + rest) if others else ''
+        else:
+            if len(words) > 1 and is_target(words[0], config):
+                names, rest = expand_targets(words[0], config), words[1:]
+            else:
+                names, rest = [default_vm(config)], words
+            others = copies(names)
+            first = ' '.join([','.join(names)] + rest)
+            second = ' '.join([','.join(others)] + rest) if others else ''
+        if not second: # Only remote machines, nothing to compare
+            lines.append(first)
+            continue
+        lines.extend([first, second] if len(pairs) % 2 == 0 else [second, first])
+        pairs.append((command, first, second))
+    return lines, pairs
+
+
+def step_elapsed(steps: Dict[str, Dict[str, str]], line: str) -> float:
+    "Wall time of a step of the job, the slowest vm for a step on many vm(s)"
+    if line in steps:
+        return float(steps[line].get('elapsed') or 0)
+    target, _, command = line.partition(' ')
+    values = [float(steps[key].get('elapsed') or 0) for key in
+              ('{0} {1}'.format(name, command) for name in target.split(',')) if key in steps]
+    return max(values) if values else 0.0
+
+
+def compare_report(pairs: List[Tuple[str, str, str]], steps: Dict[str, Dict[str, str]],
+                   vms: Dict[str, Dict[str, Any]], images: Tuple[str, str]) -> List[str]:
+    """
+    Lines with the difference between the two images for each step.
+
+    :param pairs: (step, line for A, line for B) from compare_job.
+    :param steps: The results of the job, like tunirutils.STR.
+    :param vms: The vm(s) with their boot_time.
+    :param images: Paths of the images A and B.
+    :return: Lines of the report.
+    """
+    lines = ["compare: A = {0}".format(images[0]), "compare: B = {0}".format(images[1])]
+    for name, vm in vms.items():
+        other = vms.get(name + COMPARE_SUFFIX, {})
+        if vm.get('boot_time') and other.get('boot_time'):
+            lines.append("compare: boot {0}: A {1}s B {2}s delta {3:+.2f}s".format(
+                name, vm['boot_time'], other['boot_time'], float(other['boot_time']) - float(vm['boot_time'])))
+    for step, first, second in pairs:
+        if first == second: # A joined directive, BENCH gives the difference
+            deltas = [line for line in str(steps.get(first, {}).get('result', '')).splitlines()
+                      if line.startswith('delta ')]
+            for delta in deltas:
+                lines.append("compare: {0}: {1}".format(step, delta))
+            continue
+        value_a = step_elapsed(steps, first)
+        value_b = step_elapsed(steps, second)
+        if not (value_a and value_b): # The job stopped before
+            continue
+        lines.append("compare: {0}: A {1:.2f}s B {2:.2f}s delta {3:+.2f}s ({4:+.1f}%)".format(
+            step, value_a, value_b, value_b - value_a, (value_b - value_a) * 100 / value_a))
+    return lines
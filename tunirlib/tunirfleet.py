@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"Tunir module to run a bare job on a fleet of remote hosts at the same time"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import time
+import logging
+import tempfile
+import statistics
+import concurrent.futures
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Any
+
+from .tunirutils import TunirConfig, POOL, run_job, match_vm_numbers, write_ip_information
+from .tunirmultihost import GENERAL_KEYS
+
+log = logging.getLogger('tunir')
+
+# Hosts we run the job on at the same time
+FLEET_WORKERS = 8
+# A host is a straggler when it takes this many times the median of the fleet
+STRAGGLER_FACTOR = 2.0
+
+
+def read_inventory(path: str) -> List[str]:
+    """
+    Reads a host inventory, one host (or host:port) in each line. Empty
+    lines and lines starting with # are skipped.
+
+    :param path: Path of the inventory file.
+    :return: List of the hosts.
+    """
+    with open(path) as fobj:
+        return [line.strip() for line in fobj if line.strip() and not line.strip().startswith('#')]
+
+
+def fleet_hosts(config: Dict[str, Any], config_dir: str='.') -> List[Tuple[str, str]]:
+    """
+    Finds the hosts of a fleet job, from the hosts list and the inventory
+    file of the job configuration.
+
+    :param config: The JSON job configuration.
+    :param config_dir: Directory of the job configuration, for a relative inventory path.
+    :return: List of (host, port), in the given order without the duplicates.
+    """
+    hosts = list(config.get('hosts') or [])
+    if config.get('inventory'):
+        hosts.extend(read_inventory(os.path.join(config_dir, config['inventory'])))
+    result = OrderedDict() # type: Dict[Tuple[str, str], bool]
+    for item in hosts:
+        host, _, port = item.partition(':')
+        result[(host, port or str(config.get('port', '22')))] = True
+    return list(result.keys())
+
+
+def host_config(config: Dict[str, Any], host: str, port: str) -> TunirConfig:
+    "The configuration to run the job on one host of the fleet"
+    vm = dict(config, host_string=host, ip=host, port=port)
+    for key in ('hosts', 'inventory'):
+        vm.pop(key, None)
+    result = TunirConfig()
+    result.vms = {'vm1': vm}
+    result.general = {key: config.get(key, None) for key in GENERAL_KEYS}
+    result.general['keypath'] = config.get('key', '')
+    return result
+
+
+def run_host(jobname: str, jobpath: str, config: TunirConfig, path: str) -> Tuple[bool, float, Dict[str, Dict[str, str]]]:
+    """
+    Runs the job on one host of the fleet, with its own results.
+
+    :param jobname: Name of the job.
+    :param jobpath: Path of the job file.
+    :param config: Configuration from host_config.
+    :param path: Path of the result file of the host, the host information goes next to it.
+    :return: (status, seconds, results)
+    """
+    results = OrderedDict() # type: Dict[str, Dict[str, str]]
+    start = time.time()
+    try:
+        # Not ./current_run_info.json, all the hosts run at the same time
+        write_ip_information(config.vms['vm1'].get('user', ''), config.general['keypath'], config,
+                             os.path.splitext(path)[0] + '.json')
+        status = run_job(jobpath, job_name=jobname, extra_config={'result_path': path}, config=config,
+                         results=results)
+    except Exception as err: # One host can not stop the fleet
+        log.error("{0}: {1}".format(config.vms['vm1']['host_string'], err))
+        status = False
+    finally:
+        POOL.drop(config.vms['vm1'])
+    return status, time.time() - start, results
+
+
+def fleet_report(outcomes: Dict[str, Tuple[bool, float, Dict[str, Dict[str, str]]]],
+                 factor: float=STRAGGLER_FACTOR) -> List[str]:
+    """
+    Lines with the pass/fail matrix of the fleet, one row for each host
+    and one column for each step, and the stragglers.
+
+    :param outcomes: (status, seconds, results) of each host.
+    :param factor: Hosts slower than this many times the median are stragglers.
+    :return: Lines of the report.
+    """
+    steps = OrderedDict() # type: Dict[str, bool]
+    for _, _, results in outcomes.values():
+        for command in results:
+            steps[command] = True
+    lines = ["fleet: step {0}: {1}".format(index, command) for index, command in enumerate(steps, 1)]
+    width = max([len(host) for host in outcomes] + [4])
+    lines.append("fleet: {0:{1}} status elapsed  {2}".format('host', width, ' '.join(
+        str(index % 10) for index in range(1, len(steps) + 1))))
+    for host, (status, seconds, results) in outcomes.items():
+        cells = ['-' if command not in results else 'P' if results[command]['status'] else 'F'
+                 for command in steps]
+        lines.append("fleet: {0:{1}} {2:6} {3:7.2f}s {4}".format(host, width, 'pass' if status else 'fail',
+                                                                 seconds, ' '.join(cells)))
+    passed = len([value for value in outcomes.values() if value[0]])
+    lines.append("fleet: {0} passed, {1} failed out of {2} hosts.".format(passed, len(outcomes) - passed,
+                                                                        len(outcomes)))
+    if outcomes:
+        median = statistics.median(value[1] for value in outcomes.values())
+        for host, (_, seconds, _) in outcomes.items():
+            if median and seconds > factor * median:
+                lines.append("fleet: straggler {0} took {1:.2f} seconds, the median is {2:.2f} seconds.".format(
+                    host, seconds, median))
+    return lines
+
+
+def fleet_run(jobname: str, jobpath: str, config: Dict[str, Any], config_dir: str='.') -> bool:
+    """
+    Runs a bare job on all the hosts of the fleet, fleet_workers (8 by
+    default) hosts at the same time, each on its pooled connection. Each
+    host gets its result file (and its information, like
+    current_run_info.json) in the fleet directory, fleet.txt there has the
+    matrix of all of them.
+
+    :param jobname: Name of the job.
+    :param jobpath: Path of the job file.
+    :param config: The JSON job configuration.
+    :param config_dir: Directory of the job configuration.
+    :return: True if the job passed on every host.
+    """
+    try:
+        hosts = fleet_hosts(config, config_dir)
+    except OSError as err: # Missing inventory
+        print(err)
+        log.error(str(err))
+        return False
+    if not hosts:
+        print("No hosts in the fleet.")
+        return False
+    if not os.path.exists(jobpath):
+        print("Missing job file {0}".format(jobpath))
+        return False
+    if not match_vm_numbers(['vm1'], jobpath):
+        return False
+    dirpath = config.get('fleet_dir') or tempfile.mkdtemp(prefix='tunir-fleet-')
+    os.makedirs(dirpath, exist_ok=True)
+    workers = min(int(config.get('fleet_workers') or FLEET_WORKERS), len(hosts))
+    print("Running {0} on {1} hosts, {2} at a time, results in {3}".format(jobname, len(hosts), workers, dirpath))
+    names = OrderedDict(('{0}:{1}'.format(host, port) if port != '22' else host, (host, port))
+                        for host, port in hosts)
+    outcomes = OrderedDict() # type: Dict[str, Tuple[bool, float, Dict[str, Dict[str, str]]]]
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = OrderedDict((executor.submit(run_host, jobname, jobpath, host_config(config, host, port),
+                                               os.path.join(dirpath, name.replace(':', '_') + '.txt')), name)
+                              for name, (host, port) in names.items())
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            outcomes[name] = future.result()
+            print("fleet: {0} {1} in {2:.2f} seconds ({3}/{4} done)".format(
+                name, 'passed' if outcomes[name][0] else 'failed', outcomes[name][1], len(outcomes), len(hosts)))
+    POOL.close_all()
+    # The matrix in the order of the inventory
+    outcomes = OrderedDict((name, outcomes[name]) for name in names)
+    lines = fleet_report(outcomes, float(config.get('straggler_factor') or STRAGGLER_FACTOR))
+    lines.append("fleet: {0} hosts in {1:.2f} seconds.".format(len(hosts), time.time() - start))
+    with open(os.path.join(dirpath, 'fleet.txt'), 'w') as fobj:
+        for line in lines:
+            print(line)
+            fobj.write(line + '\n')
+    return all(value[0] for value in outcomes.values())
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"Tunir module to keep the history of the runs in SQLite, and to find the slow steps"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import time
+import sqlite3
+import logging
+import statistics
+from typing import List, Dict, Tuple, Any
+
+log = logging.getLogger('tunir')
+
+HISTORY_PATH = '/var/lib/tunir/history.db'
+# Steps faster than this many seconds are all noise for the regression gate
+MIN_REGRESSION = 0.05
+# Runs we need in the history before we gate a step
+MIN_HISTORY = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, job TEXT, started REAL, duration REAL, status INTEGER);
+CREATE TABLE IF NOT EXISTS steps (run_id INTEGER, command TEXT, elapsed REAL, status INTEGER);
+CREATE TABLE IF NOT EXISTS boots (run_id INTEGER, vm TEXT, seconds REAL, mode TEXT);
+CREATE TABLE IF NOT EXISTS images (run_id INTEGER, vm TEXT, path TEXT, sha256 TEXT);
+CREATE INDEX IF NOT EXISTS steps_command ON steps (command);
+CREATE INDEX IF NOT EXISTS runs_job ON runs (job);
+"""
+
+
+def history_path(path: str='') -> str:
+    "The history database, in the home directory of the users who can not write to /var/lib/tunir"
+    path = path or HISTORY_PATH
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname, exist_ok=True)
+    except OSError:
+        pass
+    if os.access(dirname, os.W_OK):
+        return path
+    newpath = os.path.join(os.path.expanduser('~'), '.local', 'share', 'tunir', os.path.basename(path))
+    os.makedirs(os.path.dirname(newpath), exist_ok=True)
+    return newpath
+
+
+class History(object):
+    """
+    Keeps every run of every job in a SQLite database: the status, the wall
+    time of each step, the boot time of each vm and the hash of the images.
+    """
+    def __init__(self, path: str='') -> None:
+        self.path = history_path(path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def record(self, job: str, started: float, status: bool, steps: Dict[str, Dict[str, str]],
+               vms: Dict[str, Dict[str, Any]], images: Dict[str, Tuple[str, str]]=None) -> int:
+        """
+        Adds a run.
+
+        :param job: Name of the job.
+        :param started: When the run started.
+        :param status: Verdict of the job.
+        :param steps: The results of the job, like tunirutils.STR.
+        :param vms: The vm(s) with their boot_time and boot_mode.
+        :param images: Path and sha256 of the image of each vm.
+        :return: Id of the new run.
+        """
+        with self.conn:
+            cursor = self.conn.execute("INSERT INTO runs (job, started, duration, status) VALUES (?, ?, ?, ?)",
+                                       (job, started, time.time() - started, int(bool(status))))
+            run_id = cursor.lastrowid
+            for value in steps.values():
+                if value.get('elapsed'):
+                    self.conn.execute("INSERT INTO steps VALUES (?, ?, ?, ?)",
+                                      (run_id, value['command'], float(value['elapsed']), int(bool(value['status']))))
+            for name, vm in vms.items():
+                if vm.get('boot_time'):
+                    self.conn.execute("INSERT INTO boots VALUES (?, ?, ?, ?)",
+                                      (run_id, name, float(vm['boot_time']), vm.get('boot_mode', '')))
+            for name, (path, digest) in (images or {}).items():
+                self.conn.execute("INSERT INTO images VALUES (?, ?, ?, ?)", (run_id, name, path, digest))
+        return run_id
+
+    def step_times(self, job: str, command: str, limit: int=20) -> List[float]:
+        "Wall times of a step in the last passing runs of the job"
+        rows = self.conn.execute("SELECT steps.elapsed FROM steps JOIN runs ON steps.run_id = runs.id "
+                                 "WHERE runs.job = ? AND steps.command = ? AND steps.status = 1 "
+                                 "ORDER BY runs.id DESC LIMIT ?", (job, command, limit))
+        return [row[0] for row in rows]
+
+    def regressions(self, job: str, steps: Dict[str, Dict[str, str]], sigma: float) -> List[str]:
+        """
+        Finds the steps which took longer than the mean of their history
+        and sigma standard deviations.
+
+        :param job: Name of the job.
+        :param steps: The results of this run.
+        :param sigma: Number of standard deviations we allow.
+        :return: One line for each slow step.
+        """
+        lines = [] # type: List[str]
+        for value in steps.values():
+            if not value.get('elapsed'):
+                continue
+            elapsed = float(value['elapsed'])
+            times = self.step_times(job, value['command'])
+            if len(times) < MIN_HISTORY:
+                continue
+            mean = statistics.mean(times)
+            stddev = statistics.stdev(times)
+            if elapsed > mean + sigma * stddev and elapsed - mean > MIN_REGRESSION:
+                lines.append("regression: {0} took {1:.2f} seconds, history mean {2:.2f} stddev {3:.2f} "
+                             "({4} runs)".format(value['command'], elapsed, mean, stddev, len(times)))
+        return lines
+
+    def runs(self, job: str, limit: int=10) -> List[Tuple[int, float, float, int]]:
+        "The last runs of a job, (id, started, duration, status)"
+        return list(self.conn.execute("SELECT id, started, duration, status FROM runs WHERE job = ? "
+                                      "ORDER BY id DESC LIMIT ?", (job, limit)))
+
+    def report(self, job: str, limit: int=10) -> List[str]:
+        "Lines with the last runs of a job, and the history of each step"
+        lines = ["Last runs of {0}:".format(job)]
+        for run_id, started, duration, status in self.runs(job, limit):
+            boots = ', '.join('{0} {1:.2f}s'.format(vm, seconds) for vm, seconds in
+                              self.conn.execute("SELECT vm, seconds FROM boots WHERE run_id = ?", (run_id,)))
+            lines.append("{0} {1} {2:.1f}s {3}{4}".format(run_id, time.strftime('%Y-%m-%d %H:%M', time.localtime(started)),
+                                                       duration, 'pass' if status else 'fail',
+                                                       ' boot: ' + boots if boots else ''))
+        lines.append("Steps:")
+        rows = self.conn.execute("SELECT command, COUNT(*), AVG(elapsed), MIN(elapsed), MAX(elapsed) FROM steps "
+                                 "JOIN runs ON steps.run_id = runs.id WHERE runs.job = ? GROUP BY command "
+                                 "ORDER BY MIN(steps.rowid)", (job,))
+        for command, count, mean, low, high in rows:
+            lines.append("{0}: {1} runs, mean {2:.2f}s, min {3:.2f}s, max {4:.2f}s".format(command, count, mean,
+                                                                                          low, high))
+        return lines
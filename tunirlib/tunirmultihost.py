@@ -1,8 +1,12 @@
 import os
 import sys
 import time
-import signal
+import base64
+import ipaddress
+import statistics
+import concurrent.futures
 import random
+import sqlite3
 import subprocess
 import tempfile
 import logging
@@ -11,18 +15,43 @@ import configparser as ConfigParser
 
 from io import StringIO
 from pprint import pprint
+from collections import OrderedDict
 from paramiko.rsakey import RSAKey
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
-from typing import Tuple, Dict, Any, Union, List
+from typing import Tuple, Dict, Any, Union, List, Callable, cast
 
-from .tunirutils import run, clean_tmp_dirs, system, run_job, TunirConfig
-from .tunirutils import match_vm_numbers, create_ansible_inventory
-from .tunirutils import IPException
+from .tunirutils import run, clean_tmp_dirs, system, run_job, TunirConfig, wait_ready, backoff
+from .tunirutils import match_vm_numbers, create_ansible_inventory, create_ansible_config
+from .tunirutils import IPException, POOL
+from . import tunirutils
 from .testvm import  create_user_data, create_seed_img
+from .config import HOSTS_USER_DATA, NETWORK_CONFIG, USER_NETWORK_CONFIG, QEMU_PROFILES, PROFILE_KEYS
+from .config import FASTBOOT_APPEND
+from .tunirqmp import QMPClient, QMPError, qmp_args, guest_ip, stop_vm, process_gone
+from .tunirbake import BakeStore, BAKE_DIR, BAKED_PREFIX, split_setup
+from .tunirreap import RunManifest, background
+from .tunirsample import start_sampler
+from .tunirhistory import History
+from .tunirartifacts import collect_artifacts, ARTIFACTS_MAX
+from .tunircompare import compare_config, compare_job, compare_report, write_config
+from .tunirscratch import Scratch, scratch_root, MB
+from .tunirnet import LeaseRegistry, lease_path, MCAST_PORTS, USER_MAC, mac_from_ip
 log = logging.getLogger('tunir')
 
+# Network between the vm(s) in user mode networking, if there is no address_plan
+USER_ADDRESS_PLAN = '10.0.100.10/24'
+
+# Direct kernel boot options, in the general section or in a vm section
+FASTBOOT_KEYS = ('kernel', 'initrd', 'append', 'machine')
+# Job wide options which can be given in a JSON job configuration too
+GENERAL_KEYS = ('ansible_dir', 'batch', 'nongating_workers', 'fanout', 'address_plan', 'gateway', 'boot_timeout',
+                'lease_file', 'network', 'shutdown_timeout', 'profile', 'bake_dir', 'scratch',
+                'scratch_headroom', 'teardown', 'sample_interval',
+                'bench_baseline', 'history', 'regression_sigma',
+                'artifacts_dir', 'artifacts_max', 'proxy_jump', 'proxy_key') + PROFILE_KEYS + FASTBOOT_KEYS
+
 
 def true_test(vms: Dict[str,Dict[str,str]], private_key: str, command: str='cat /proc/cpuinfo') -> None:
     """
@@ -35,29 +64,39 @@ def true_test(vms: Dict[str,Dict[str,str]], private_key: str, command: str='cat
     :return: None
     """
     "Just to test the connection of a vm"
-    key = create_rsa_key(private_key)
-    for vm in vms.values():
+    key = None
+    if private_key:
+        key = create_rsa_key(private_key)
+
+    def true_test_vm(vm: Dict[str, Any]) -> None:
+        if not vm.get('pkey') and not vm.get('password') and not vm.get('key'):
+            vm = dict(vm, pkey=key)
         for i in range(5):
             try:
-                run(vm['ip'], port=vm['port'], user=vm['user'], command=command,pkey=key, debug=False)
+                POOL.run(vm, command, timeout=120)
                 break
             except Exception as e:
                 print("Try {0} failed for IP injection to /etc/hosts.".format(i))
+                POOL.drop(vm)
                 if i == 4: # If it does not allow in 2 minutes, something is super wrong
                     raise e
                 time.sleep(30)
                 continue
 
+    if not vms:
+        return
+    # All the vm(s) at the same time over the pooled connections
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(vms)) as executor:
+        list(executor.map(true_test_vm, vms.values()))
+
 
-def inject_ip_to_vms(vms, private_key):
+def create_hosts_text(vms: Dict[str, Dict[str, str]]) -> str:
     """
-    Updates each vm's /etc/hosts file with IP addresses.
+    Creates the /etc/hosts lines for all the vm(s).
 
     :param vms: Dictionary of VM(s)/IPs
-    :param private_key: String version of the private key
-    :return: None
+    :return: Text to append in /etc/hosts
     """
-
     text = "\n"
     for k, v in vms.items():
         line = ''
@@ -67,7 +106,83 @@ def inject_ip_to_vms(vms, private_key):
         else:
             line = "{0}    {1}\n".format(v['ip'],k)
         text += line
-    true_test(vms, private_key, """sudo sh -c 'echo -e "{0}" >> /etc/hosts'""".format(text))
+    return text
+
+
+def inject_ip_to_vms(vms, private_key, targets=None):
+    """
+    Updates each vm's /etc/hosts file with IP addresses.
+
+    :param vms: Dictionary of VM(s)/IPs
+    :param private_key: String version of the private key
+    :param targets: Dictionary of VM(s) to update, default is all of vms
+    :return: None
+    """
+    text = create_hosts_text(vms)
+    if targets is None:
+        targets = vms
+    true_test(targets, private_key, """sudo sh -c 'echo -e "{0}" >> /etc/hosts'""".format(text))
+
+
+def plan_addresses(config: TunirConfig, registry: LeaseRegistry=None) -> Dict[str, Dict[str, str]]:
+    """
+    Gives a fixed IP and MAC address to each vm we will boot, starting from
+    the address_plan value of the general section (like 192.168.122.200/24).
+    Then we know all the IP addresses before booting any vm.
+
+    :param config: TunirConfig with the vm(s).
+    :param registry: LeaseRegistry to skip the addresses used by other tunir processes.
+    :return: Dictionary of vm name to ip, mac, prefix and gateway.
+    """
+    interface = ipaddress.ip_interface(config.general['address_plan'])
+    network = interface.network
+    gateway = config.general.get('gateway', str(next(network.hosts())))
+    plan = {}  # type: Dict[str, Dict[str, str]]
+    address = interface.ip
+    for name, vm in config.vms.items():
+        if 'ip' in vm: # Remote vm/bare metal
+            continue
+        if registry:
+            try:
+                ip, mac = registry.acquire_ip(name, config.general['address_plan'])
+            except ValueError as err:
+                raise IPException(str(err))
+        else:
+            if address not in network or address == network.broadcast_address:
+                raise IPException("Not enough addresses in {0}".format(config.general['address_plan']))
+            ip, mac = str(address), mac_from_ip(str(address))
+            address += 1
+        plan[name] = {'ip': ip, 'mac': mac, 'prefix': str(network.prefixlen),
+                      'gateway': gateway}
+    return plan
+
+
+def create_vm_seed(path: str, name: str, public_key: str, address: Dict[str, str], hosts: str,
+                   network: str='bridge') -> str:
+    """
+    Creates a seed image only for one vm, with the static network configuration
+    and the /etc/hosts entries, so that we do not have to ssh to add those later.
+
+    :param path: Directory to create the seed image.
+    :param name: Name of the vm.
+    :param public_key: The public ssh key.
+    :param address: Address plan of the vm, from plan_addresses.
+    :param hosts: Text to add in /etc/hosts.
+    :param network: bridge or user, the networking mode of the vm.
+    :return: Path to the seed image.
+    """
+    meta = os.path.join(path, 'meta')
+    os.makedirs(meta)
+    hosts_data = base64.b64encode(hosts.encode('utf-8')).decode('utf-8')
+    create_user_data(path, "passw0rd", HOSTS_USER_DATA.format(hosts_data))
+    create_ssh_metadata(path, public_key, hostname=name)
+    with open(os.path.join(meta, 'network-config'), 'w') as fobj:
+        if network == 'user':
+            fobj.write(USER_NETWORK_CONFIG.format(user_mac=USER_MAC, **address))
+        else:
+            fobj.write(NETWORK_CONFIG.format(**address))
+    create_seed_img(meta, path)
+    return os.path.join(path, 'seed.img')
 
 
 def create_rsa_key(private_key: str) -> RSAKey:
@@ -124,6 +239,10 @@ def read_multihost_config(filepath: str) -> TunirConfig:
         out = {k:str(v) for k,v in items}  # type: Dict[str,str]
         if sec == 'general':
             result.general = out
+        elif sec == 'groups':
+            result.groups = out
+        elif sec == 'artifacts':
+            result.artifacts = out
         else:
             result.vms[sec] = out
     return result
@@ -141,22 +260,165 @@ def random_mac() -> str:
     return ':'.join(map(lambda x: "%02x" % x, mac))
 
 
-def boot_qcow2(image:str , seed: str, ram: int=1024, vcpu: str='1') -> Tuple[subprocess.Popen, str]:
+def read_profile(general: Dict[str, str], vm: Dict[str, str]) -> Dict[str, str]:
+    """
+    Finds the qemu performance profile of a vm. The profile of the vm section
+    wins over the general section, and so do the single keys.
+
+    :param general: The general section of the configuration.
+    :param vm: The vm section of the configuration.
+    :return: Dictionary with the name of the profile and its values.
+    """
+    name = vm.get('profile') or general.get('profile') or 'default'
+    if name not in QEMU_PROFILES:
+        raise ValueError("Unknown profile {0}, we have {1}".format(name, ', '.join(sorted(QEMU_PROFILES))))
+    profile = dict(QEMU_PROFILES[name])
+    for section in (general, vm):
+        for key in PROFILE_KEYS:
+            if section.get(key):
+                profile[key] = section[key]
+    profile['name'] = name
+    return profile
+
+
+def profile_text(profile: Dict[str, str]) -> str:
+    "Profile name with the values, for the report"
+    values = ', '.join('{0}={1}'.format(key, profile[key]) for key in PROFILE_KEYS if key in profile)
+    return '{0} ({1})'.format(profile.get('name', 'default'), values) if values else profile.get('name', 'default')
+
+
+def profile_queues(profile: Dict[str, str], vcpu: str) -> int:
+    "Number of virtio queues, auto means one for each vcpu"
+    queues = profile.get('queues', '1')
+    if queues == 'auto':
+        return int(vcpu)
+    return int(queues)
+
+
+def profile_args(profile: Dict[str, str], image: str, seed: str, ram: int, vcpu: str) -> List[str]:
+    """
+    Creates the qemu cpu, memory and disk options of a performance profile.
+
+    :param profile: Dictionary from read_profile.
+    :param image: Path to the disk image.
+    :param seed: Path to the seed image.
+    :param ram: Memory in MB.
+    :param vcpu: Number of vcpu(s).
+    :return: List of qemu options.
+    """
+    args = [] # type: List[str]
+    if profile.get('cpu_model'):
+        args += ['-cpu', profile['cpu_model']]
+    if profile.get('hugepages', 'off') != 'off':
+        path = profile['hugepages'] if profile['hugepages'].startswith('/') else '/dev/hugepages'
+        args += ['-mem-path', path, '-mem-prealloc']
+    if not (profile.get('cache') or profile.get('aio') or profile.get('iothreads')):
+        # The old style options
+        return args + ['-drive', 'file=%s,if=virtio' % image,
+                       '-drive', 'file=%s,if=virtio' % seed]
+    iothreads = int(profile.get('iothreads', '0'))
+    for i in range(iothreads):
+        args += ['-object', 'iothread,id=io{0}'.format(i)]
+    for i, path in enumerate((image, seed)):
+        drive = 'file={0},if=none,id=disk{1}'.format(path, i)
+        for key in ('cache', 'aio'):
+            if profile.get(key):
+                drive += ',{0}={1}'.format(key, profile[key])
+        device = 'virtio-blk-pci,drive=disk{0}'.format(i)
+        if iothreads:
+            device += ',iothread=io{0}'.format(i % iothreads)
+        if i == 0 and profile.get('queues'):
+            device += ',num-queues={0}'.format(profile_queues(profile, vcpu))
+        args += ['-drive', drive, '-device', device]
+    return args
+
+
+def disk_name(profile: Dict[str, str]) -> str:
+    "The QMP name of the main disk of a vm booted with the profile"
+    if profile.get('cache') or profile.get('aio') or profile.get('iothreads'):
+        return 'disk0'
+    return 'virtio0'
+
+
+def network_args(mac: str, network: str='bridge', ssh_port: int=0, mcast: str='',
+                 profile: Dict[str, str]=None, vcpu: str='1') -> List[str]:
+    """
+    Creates the qemu network options for a vm.
+
+    :param mac: MAC address of the vm.
+    :param network: bridge for virbr0, or user for user mode networking.
+    :param ssh_port: Host port forwarded to the ssh port of the vm in user mode.
+    :param mcast: Multicast address:port of the network between the vm(s) in user mode.
+    :param profile: Performance profile for vhost and multiqueue on the bridge.
+    :param vcpu: Number of vcpu(s), for the auto number of queues.
+    :return: List of qemu options.
+    """
+    profile = profile or {}
+    if network != 'user' and (profile.get('vhost') == 'on' or profile.get('queues')):
+        netdev = 'bridge,id=net0,br=virbr0'
+        device = 'virtio-net-pci,netdev=net0,mac={0}'.format(mac)
+        if profile.get('vhost') == 'on':
+            netdev += ',vhost=on'
+        queues = profile_queues(profile, vcpu)
+        if queues > 1:
+            netdev += ',queues={0}'.format(queues)
+            device += ',mq=on,vectors={0}'.format(2 * queues + 2)
+        return ['-netdev', netdev, '-device', device]
+    if network != 'user':
+        return ['-net',
+                'bridge,br=virbr0',
+                '-net',
+                'nic,macaddr={0},model=virtio'.format(mac)]
+    args = ['-netdev',
+            'user,id=user0,hostfwd=tcp:127.0.0.1:{0}-:22'.format(ssh_port),
+            '-device',
+            'virtio-net-pci,netdev=user0,mac={0}'.format(USER_MAC)]
+    if mcast:
+        args += ['-netdev',
+                 'socket,id=mcast0,mcast={0}'.format(mcast),
+                 '-device',
+                 'virtio-net-pci,netdev=mcast0,mac={0}'.format(mac)]
+    return args
+
+
+def fastboot_args(general: Dict[str, str], vm: Dict[str, str]) -> List[str]:
+    """
+    Creates the qemu options to boot the kernel directly, without the
+    firmware and the bootloader, if the configuration has a kernel.
+
+    :param general: The general section of the configuration.
+    :param vm: The vm section of the configuration.
+    :return: List of qemu options, empty for the normal boot.
+    """
+    values = {key: vm.get(key) or general.get(key) for key in FASTBOOT_KEYS}
+    if not values['kernel']:
+        return []
+    machine = values['machine'] or 'microvm'
+    if machine == 'microvm':
+        # With PCIe on, all the virtio-pci devices work the same as before
+        machine = 'microvm,pcie=on'
+    args = ['-machine', machine + ',accel=kvm', '-kernel', values['kernel']]
+    if values['initrd']:
+        args += ['-initrd', values['initrd']]
+    return args + ['-append', values['append'] or FASTBOOT_APPEND]
+
+
+def boot_qcow2(image:str , seed: str, ram: int=1024, vcpu: str='1', mac: str='',
+               netargs: List[str]=None, qmp: str='', qga: str='',
+               profile: Dict[str, str]=None, bootargs: List[str]=None) -> Tuple[subprocess.Popen, str]:
     "Boots the image with a seed image"
-    mac = random_mac()
+    if not mac:
+        mac = random_mac()
+    if not netargs:
+        netargs = network_args(mac, profile=profile, vcpu=vcpu)
+    if qmp:
+        netargs = netargs + qmp_args(qmp, qga)
     boot_args = ['/usr/bin/qemu-kvm',
                  '-m',
                  str(ram),
                  '-smp',
                  vcpu,
-                 '-drive',
-                 'file=%s,if=virtio' % image,
-                 '-drive',
-                 'file=%s,if=virtio' % seed,
-                 '-net',
-                 'bridge,br=virbr0',
-                 '-net',
-                 'nic,macaddr={0},model=virtio'.format(mac),
+                 ] + (bootargs or []) + profile_args(profile or {}, image, seed, ram, vcpu) + netargs + [
                  '-device', 'virtio-rng-pci', # https://bugzilla.redhat.com/show_bug.cgi?id=1212082
                  '-display',
                  'none'
@@ -168,16 +430,63 @@ def boot_qcow2(image:str , seed: str, ram: int=1024, vcpu: str='1') -> Tuple[sub
 
     return vm, mac
 
-def create_ssh_metadata(path: str, pub_key: str, private_key: str='') -> None:
+def discover_ip(vm: Dict[str, str], timeout: int=300) -> str:
+    """
+    Finds the IP address of a new vm on the bridge, first asking the guest
+    agent, then looking at the ARP table, till the timeout.
+
+    :param vm: Configuration dictionary of the vm, with process, mac and qga.
+    :param timeout: Maximum seconds to wait.
+    :return: The IP address, empty string if we could not find it.
+    """
+    end = time.time() + timeout
+    for delay in backoff(initial=2, maximum=10):
+        ip = ''
+        if vm.get('qga') and os.path.exists(vm['qga']):
+            ip = guest_ip(vm['qga'], vm['mac'])
+        ip = ip or scan_arp(vm['mac'])
+        if ip:
+            return ip
+        if process_gone(int(vm['process'])):
+            print("The vm process exited.")
+            return ''
+        if time.time() >= end:
+            return ''
+        time.sleep(delay)
+    return ''
+
+
+def watch_vms(config: TunirConfig, names: List[str]) -> Dict[str, QMPClient]:
+    """
+    Connects to the QMP socket of the booting vm(s), so that we can stop
+    waiting for a vm which shut down or panicked.
+
+    :param config: TunirConfig with the vm(s).
+    :param names: Names of the vm(s).
+    :return: Dictionary of the connected QMP clients.
+    """
+    watchers = {} # type: Dict[str, QMPClient]
+    for name in names:
+        qmp = config.vms[name].get('qmp', '')
+        if not qmp or not os.path.exists(qmp):
+            continue
+        try:
+            watchers[name] = QMPClient(qmp).connect(tries=20)
+        except (OSError, ValueError, QMPError) as err:
+            log.info("Can not watch {0}: {1}".format(name, err))
+    return watchers
+
+
+def create_ssh_metadata(path: str, pub_key: str, private_key: str='', hostname: str='tunirtests') -> None:
     "Creates the user data with ssh key"
     text = """instance-id: iid-123456
-local-hostname: tunirtests
+local-hostname: {1}
 public-keys:
   default: {0}
 """
     fname = os.path.join(path, 'meta/meta-data')
     with open(fname, 'w') as fobj:
-        fobj.write(text.format(pub_key))
+        fobj.write(text.format(pub_key, hostname))
 
     # just for debugging
     if private_key:
@@ -186,15 +495,109 @@ public-keys:
             fobj.write(private_key)
         os.system('chmod 0600 {0}'.format(pname))
 
-def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Dict[str,str]=None, config_dir: str='.') -> bool:
-    "Start the executation here."
+def ready_time(vm: Dict[str, Any], deadline: float, failed: Callable[[], str], started: float) -> float:
+    "Waits for the vm, and gives the seconds since it started booting, 0 if it never came up"
+    if wait_ready(vm, deadline, failed):
+        return time.time() - started
+    return 0.0
+
+
+def record_history(jobname: str, started: float, status: bool, config: TunirConfig, store: BakeStore,
+                   result_path: str) -> bool:
+    """
+    Adds the run to the history database, and with regression_sigma in the
+    general section fails the job if a step was slower than its history.
+
+    :param jobname: Name of the job.
+    :param started: When the run started.
+    :param status: Status of the job.
+    :param config: TunirConfig with the vm(s).
+    :param store: BakeStore, which keeps the hash of the images.
+    :param result_path: We add the regressions to the result file.
+    :return: Status of the job.
+    """
+    path = config.general.get('history') or ''
+    if path == 'off':
+        return status
+    try:
+        history = History(path)
+    except (OSError, sqlite3.Error) as err:
+        log.error("Can not open the history: {0}".format(err))
+        return status
+    try:
+        sigma = config.general.get('regression_sigma')
+        if sigma and status:
+            lines = history.regressions(jobname, tunirutils.STR, float(sigma))
+            if lines:
+                status = False
+                with open(result_path, 'a') as fobj:
+                    for line in lines:
+                        print(line)
+                        fobj.write(line + '\n')
+        images = {} # type: Dict[str, Tuple[str, str]]
+        for name, vm in config.vms.items():
+            if vm.get('process') and os.path.exists(vm.get('image', '')):
+                try:
+                    images[name] = (vm['image'], store.file_hash(vm['image']))
+                except OSError as err: # The bake index may not be writable
+                    log.error(str(err))
+                    images[name] = (vm['image'], '')
+        history.record(jobname, started, status, tunirutils.STR, config.vms, images)
+    except sqlite3.Error as err:
+        log.error("Can not record the history: {0}".format(err))
+    finally:
+        history.close()
+    return status
+
+
+def seal_image(vm: Dict[str, Any], path: str, timeout: int=120) -> bool:
+    """
+    Makes a baked image out of the disk of a vm, after the setup steps.
+    cloud-init runs again on the next boot, for the new ssh key.
+
+    :param vm: Configuration dictionary of the vm.
+    :param path: Path of the new qcow2 image.
+    :param timeout: Seconds to wait for the guest to power down.
+    :return: True if the image is ready.
+    """
+    try:
+        result = POOL.run(vm, 'sudo cloud-init clean --logs && sync', timeout=300)
+        if result.return_code != 0:
+            print("cloud-init clean failed: {0}".format(result))
+            return False
+        POOL.drop(vm)
+        stop_vm(vm, timeout)
+    except Exception as error: # The teardown must still run
+        print("Sealing the image failed: {0}".format(error))
+        log.error("Sealing the image failed: {0}".format(error))
+        return False
+    temppath = path + '.tmp'
+    out, err, eid = system('qemu-img convert -c -O qcow2 {0} {1}'.format(vm['disk_path'], temppath))
+    if eid != 0:
+        print("qemu-img convert failed: {0}".format(err))
+        return False
+    os.rename(temppath, path)
+    return True
+
+
+def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Dict[str,str]=None, config_dir: str='.',
+                    fastboot: bool=True, stats: Dict[str, Any]=None, bake: str='') -> bool:
+    """
+    Start the executation here.
+
+    :param fastboot: Boot the kernel directly if the configuration has one.
+    :param stats: Dictionary to fill with the boot time of each vm we boot.
+    :param bake: Path of the image to bake out of the first vm, after the setup section of the job.
+    """
+    run_started = time.time()
     temppath = tempfile.mktemp()
     extra_config = {'result_path' : temppath} # type: Dict[str,str]
-    print('Result file at: {0}'.format(temppath))
     status = True # type: bool
     ansible_inventory_path = "" # type: str
     fault_in_ip_addr = False # type: bool
     private_key = "" # type: str
+    public_key = "" # type: str
+    plan = {} # type: Dict[str, Dict[str, str]]
     config_path = os.path.join(config_dir, jobname + '.cfg') # type: str
     if debug:
         print(config_path)
@@ -210,7 +613,7 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
         result_path = config.general.get('result_path', None)
         if result_path:
             extra_config['result_path'] = result_path
-        vm_keys = [name for name in config.vms.keys() if name.startswith('vm')]
+        vm_keys = list(config.vms.keys())
         if 'key' in config.general:
             data = ''
             try:
@@ -225,7 +628,9 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
             config.general['keypath'] = config.general['key']
     else: # For a single vm job or Vagrant or AWS
         config.vms = {'vm1': oldconfig}
-        config.general = {'ansible_dir': oldconfig.get('ansible_dir', None)}
+        config.general = {key: oldconfig.get(key, None) for key in GENERAL_KEYS}
+        if oldconfig.get('artifacts'):
+            config.artifacts = {'vm1': ' '.join(oldconfig['artifacts'])}
         if 'key' in oldconfig:
             data = ''
             with open(oldconfig['key']) as fobj:
@@ -242,14 +647,50 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
         return False
 
     # For extra vm(s) in the job file fail fast
-    if not match_vm_numbers(vm_keys, jobpath):
+    if not match_vm_numbers(vm_keys, jobpath, config.groups):
+        return False
+    profiles = {} # type: Dict[str, Dict[str, str]]
+    store = BakeStore(config.general.get('bake_dir') or BAKE_DIR)
+    try:
+        for name in vm_keys:
+            if 'ip' not in config.vms[name]:
+                profiles[name] = read_profile(config.general, config.vms[name])
+                image = config.vms[name].get('image', '')
+                if image.startswith(BAKED_PREFIX):
+                    config.vms[name]['baked'] = image
+                    config.vms[name]['image'] = store.resolve(image)
+    except ValueError as err:
+        print(err)
+        log.error(str(err))
+        return False
+    network = config.general.get('network') or 'bridge'  # type: str
+    try:
+        registry = LeaseRegistry(config.general.get('lease_file') or lease_path(network))
+    except OSError as err:
+        print(err)
+        log.error(str(err))
         return False
+    if bake:
+        config.general['job_section'] = 'setup'
+    elif profiles and all(config.vms[name].get('baked') for name in profiles):
+        # The setup steps are in the images already
+        config.general['job_section'] = 'test'
+
+    scratch = Scratch(scratch_root(config.general.get('scratch', '')),
+                      int(config.general.get('scratch_headroom', 0) or 1024) * MB)
+    if scratch.root and extra_config['result_path'] == temppath:
+        extra_config['result_path'] = tempfile.mktemp(dir=scratch.root)
+    print('Result file at: {0}'.format(extra_config['result_path']))
 
     # First let us create the seed image
-    seed_dir = tempfile.mkdtemp()
+    seed_dir = scratch.mkdtemp('seed')
     print('Created {0}'.format(seed_dir))
     os.system('chmod 0777 %s' % seed_dir)
     dirs_to_delete.append(seed_dir)
+    # What we create, for tunir --reap if this process dies
+    manifest = RunManifest()
+    manifest.set('prefixes', list(scratch.prefixes()))
+    manifest.add('dirs', [seed_dir])
     if 'key' not in config.general:
         # Then we create key and metadata
         meta = os.path.join(seed_dir, 'meta')
@@ -264,31 +705,97 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
 
         # We will copy the seed in every vm run dir
         pkey = create_rsa_key(private_key)
+    elif [name for name in vm_keys if 'ip' not in config.vms[name]]:
+        # The vm(s) we boot need the public part of the given key
+        pkey = cast(RSAKey, config.general['pkey'])
+        public_key = '{0} {1}'.format(pkey.get_name(), pkey.get_base64())
+        meta = os.path.join(seed_dir, 'meta')
+        os.makedirs(meta)
+        create_user_data(seed_dir, "passw0rd")
+        create_ssh_metadata(seed_dir, public_key)
+        create_seed_img(meta, seed_dir)
+        seed_image = os.path.join(seed_dir, 'seed.img')
 
+    manifest.set('lease_file', registry.path)
+    mcast = '' # type: str
+    waiting = [] # type: List[str] # Booted vm(s) which we did not wait for
+    sampler = None
+    started = {} # type: Dict[str, float] # When we started booting each vm
+    if network == 'user' and not config.general.get('address_plan'):
+        # Addresses for the multicast network between the vm(s)
+        config.general['address_plan'] = USER_ADDRESS_PLAN
     try:
+        if network == 'user':
+            mcast = '230.0.0.1:{0}'.format(registry.acquire_port('mcast', MCAST_PORTS, check=False))
+        if config.general.get('address_plan'):
+            # We know all the IP addresses before booting, so /etc/hosts
+            # goes into the seed image of each vm.
+            plan = plan_addresses(config, registry)
+            hosts = create_hosts_text(OrderedDict((name, dict(config.vms[name], **plan.get(name, {})))
+                                                  for name in vm_keys))
         for vm_c in vm_keys:
             # Now create each vm one by one.
             # Get the current ips
             this_vm = {}
             if 'ip' not in config.vms[vm_c]:
-                current_d = tempfile.mkdtemp()
+                image_path = config.vms[vm_c].get('image')
+                size = os.path.getsize(image_path) if os.path.exists(image_path) else 0
+                current_d = scratch.mkdtemp(vm_c, size, int(ram) * MB)
                 print('Created {0}'.format(current_d))
                 os.system('chmod 0777 %s' % current_d)
                 dirs_to_delete.append(current_d)
-                system('cp  {0} {1}'.format(seed_image, current_d))
+                manifest.add('dirs', [current_d])
+                if vm_c in plan:
+                    create_vm_seed(current_d, config.vms[vm_c].get('hostname', vm_c), public_key,
+                                   plan[vm_c], hosts, network)
+                else:
+                    system('cp  {0} {1}'.format(seed_image, current_d))
                 # Next copy the qcow2 image
-                image_path = config.vms[vm_c].get('image')
                 os.system('cp {0} {1}'.format(image_path, current_d))
                 image = os.path.join(current_d, os.path.basename(image_path))
                 log.info("Booting {0}".format(image))
 
-                vm, mac = boot_qcow2(image, os.path.join(current_d, 'seed.img'), int(ram), vcpu=vcpu)
-                this_vm.update({'process': str(vm.pid), 'mac': mac})
+                if vm_c in plan:
+                    mac = plan[vm_c]['mac']
+                else:
+                    mac = registry.acquire_mac(vm_c)
+                leases = [mac]
+                ssh_port = 0
+                if network == 'user':
+                    ssh_port = registry.acquire_port(vm_c)
+                    leases.append('port:{0}'.format(ssh_port))
+                if mcast:
+                    # The multicast network stays while any vm uses it
+                    leases.append('port:{0}'.format(mcast.split(':')[1]))
+                qmp = os.path.join(current_d, 'qmp.sock')
+                qga = os.path.join(current_d, 'qga.sock')
+                profile = profiles[vm_c]
+                if scratch.dirs[current_d][1] == 'ram' and profile.get('cache') == 'none':
+                    # tmpfs can not do O_DIRECT
+                    profile = dict(profile, cache='writeback')
+                bootargs = fastboot_args(config.general, config.vms[vm_c]) if fastboot else []
+                started[vm_c] = time.time()
+                vm, mac = boot_qcow2(image, os.path.join(current_d, 'seed.img'), int(ram), vcpu=vcpu,
+                                     mac=mac, netargs=network_args(mac, network, ssh_port, mcast if plan else '',
+                                                                   profile, vcpu),
+                                     qmp=qmp, qga=qga, profile=profile, bootargs=bootargs)
+                registry.attach(leases, vm.pid)
+                this_vm.update({'process': str(vm.pid), 'mac': mac, 'qmp': qmp, 'qga': qga, 'disk_path': image,
+                                'disk': disk_name(profile), 'qemu_profile': profile_text(profile),
+                                'boot_mode': bootargs[1].split(',')[0] if bootargs else 'firmware'})
                 # Let us get this vm in the tobe delete list even if the IP never comes up
                 config.vms[vm_c].update(this_vm)
-                print("We will wait for 45 seconds for the image to boot up.")
-                time.sleep(45)
-                latest_ip = scan_arp(mac)
+                manifest.add_vm(vm_c, this_vm)
+                if vm_c in plan:
+                    latest_ip = plan[vm_c]['ip']
+                    waiting.append(vm_c)
+                elif network == 'user':
+                    latest_ip = '127.0.0.1'
+                    waiting.append(vm_c)
+                else:
+                    print("Waiting for the IP address of {0}.".format(vm_c))
+                    latest_ip = discover_ip(config.vms[vm_c], int(config.general.get('boot_timeout', 300)))
+                    waiting.append(vm_c)
                 if not latest_ip:
                     fault_in_ip_addr = True
                     break
@@ -296,11 +803,18 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
                 this_vm['host_string'] = latest_ip
                 this_vm['pkey'] = pkey
                 this_vm['port'] = config.vms[vm_c].get('port', '22')
+                if network == 'user': # We reach ssh through the forwarded port
+                    this_vm['host_string'] = '127.0.0.1'
+                    this_vm['port'] = str(ssh_port)
             else:
                 this_vm['ip'] = config.vms[vm_c].get('ip')
                 this_vm['host_string'] = config.vms[vm_c].get('ip')
                 this_vm['port'] = config.vms[vm_c].get('port', '22')
                 this_vm['pkey'] = config.general['pkey']
+                # The remote machines behind a bastion, unless the vm section says otherwise
+                for key in ('proxy_jump', 'proxy_key'):
+                    if config.general.get(key) and key not in config.vms[vm_c]:
+                        this_vm[key] = config.general[key]
 
             this_vm['user'] = config.vms[vm_c].get('user')
             if 'hostname' in config.vms[vm_c]:
@@ -314,11 +828,35 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
             print('Oops no IP for this vm.')
             raise IPException
 
+        if waiting:
+            # We did not wait after booting, the vm(s) boot at the same time
+            watchers = watch_vms(config, waiting)
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(waiting)) as executor:
+                    futures = {name: executor.submit(ready_time, config.vms[name],
+                                                     int(config.general.get('boot_timeout', 300)),
+                                                     watchers[name].seen_event if name in watchers else None,
+                                                     started[name])
+                               for name in waiting}
+                    for name, future in futures.items():
+                        seconds = future.result()
+                        if not seconds:
+                            print("{0} did not come up.".format(name))
+                            raise IPException
+                        config.vms[name]['boot_time'] = '{0:.2f}'.format(seconds)
+                        if stats is not None:
+                            stats.setdefault('boot', {})[name] = seconds
+            finally:
+                for client in watchers.values():
+                    client.close()
+
         # Now we are supposed to have all the vms booted.
         if debug:
             pprint(config.vms)
         print(' ')
-        inject_ip_to_vms(config.vms, private_key)
+        if network != 'user' or plan:
+            inject_ip_to_vms(config.vms, private_key,
+                             OrderedDict((k, v) for k, v in config.vms.items() if k not in plan))
         ansible_flag = config.general.get('ansible_dir', None) # type: str
         if ansible_flag:
             dir_to_copy = ansible_flag
@@ -329,11 +867,32 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
             os.system('cp -r {0} {1}'.format(dir_to_copy, seed_dir))
             ansible_inventory_path = os.path.join(seed_dir, 'tunir_ansible')
             create_ansible_inventory(config.vms, ansible_inventory_path)
+            config.general['ansible_config'] = create_ansible_config(config.vms, seed_dir,
+                                                                     config.general['keypath'])
+            # For the HOSTCOMMAND: ansible-playbook lines too
+            os.environ.setdefault('ANSIBLE_CONFIG', config.general['ansible_config'])
 
+        interval = config.general.get('sample_interval')
+        sampler = start_sampler(config.vms, float(interval) if interval not in (None, '') else 1.0,
+                                extra_config['result_path'] + '.resources.csv')
         # This is where we test
-        status = run_job(jobpath,job_name=jobname,config=config, ansible_path=seed_dir, extra_config=extra_config)
+        status = run_job(jobpath,job_name=jobname,config=config, ansible_path=seed_dir, extra_config=extra_config,
+                         sampler=sampler)
+        if sampler and stats is not None:
+            stats['resources'] = sampler.totals()
+        if not bake:
+            status = record_history(jobname, run_started, status, config, store, extra_config['result_path'])
+        # How much space the run took, to size the hosts
+        lines = scratch.report()
+        with open(extra_config['result_path'], 'a') as fobj:
+            for line in lines:
+                print(line)
+                fobj.write(line + '\n')
+        if stats is not None:
+            stats['scratch'] = lines
     except Exception as e:
         import traceback
+        status = False # Like a vm which did not come up
         exc_type, exc_value, exc_traceback = sys.exc_info()
         print("*** print_tb:")
         traceback.print_tb(exc_traceback, limit=1, file=sys.stdout)
@@ -342,6 +901,20 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
                               limit=2, file=sys.stdout)
 
     finally:
+        if sampler:
+            sampler.stop()
+        if config.general.get('ansible_config') and \
+                os.environ.get('ANSIBLE_CONFIG') == config.general['ansible_config']:
+            del os.environ['ANSIBLE_CONFIG']
+        if config.artifacts:
+            # Even for a failed job, that is when we need the logs
+            lines = collect_artifacts(config, config.general.get('artifacts_dir') or
+                                      extra_config['result_path'] + '-artifacts',
+                                      int(config.general.get('artifacts_max') or ARTIFACTS_MAX) * MB)
+            with open(extra_config['result_path'], 'a') as fobj:
+                for line in lines:
+                    print(line)
+                    fobj.write(line + '\n')
         if debug:
             filename = os.path.join(seed_dir, 'destroy.sh')
             with open(filename, 'w') as fobj:
@@ -352,19 +925,159 @@ def start_multihost(jobname: str, jobpath: str, debug: bool=False, oldconfig: Di
                     fobj.write('kill -9 {0}\n'.format(job_pid))
                 for d in dirs_to_delete:
                     fobj.write('rm -rf {0}\n'.format(d))
-            print("DEBUG MODE ON. Destroy from {0}".format(filename))
+            print("DEBUG MODE ON. Destroy from {0} or with tunir --reap".format(filename))
             # Put the ip/hostnames into a text file
             filename = os.path.join(seed_dir, 'hostnames.txt')
             with open(filename, 'w') as fobj:
                 for k, v in config.vms.items():
                     fobj.write('{0}={1}\n'.format(k,v['ip']))
             return status # Do not destroy for debug case
-        for vmd in config.vms.values():
-            if not 'process' in vmd: # For remote vm/bare metal
-                continue
-            job_pid = vmd['process']
-            if debug:
-                print('Killing {0}'.format(job_pid))
-            os.kill(int(job_pid), signal.SIGKILL)
-        clean_tmp_dirs(dirs_to_delete)
+        if bake and status:
+            status = seal_image(config.vms[vm_keys[0]], bake,
+                                max(int(config.general.get('shutdown_timeout', 0) or 0), 120))
+        POOL.close_all()
+        child = False
+        if config.general.get('teardown') == 'background':
+            if background():
+                # The results are in, the child process stops the vm(s)
+                print("Tearing down in the background.")
+                return status
+            child = True
+            # tunir --reap must wait for this process, not for the parent
+            manifest.set('pid', os.getpid())
+        try:
+            for vmd in config.vms.values():
+                if not 'process' in vmd: # For remote vm/bare metal
+                    continue
+                stop_vm(vmd, int(config.general.get('shutdown_timeout', 0) or 0))
+            # Only now the addresses and ports are free for others
+            registry.release()
+            clean_tmp_dirs(dirs_to_delete, scratch.prefixes())
+            manifest.remove()
+        except Exception as err:
+            if not child:
+                raise
+            log.error("Teardown failed: {0}".format(err))
+        finally:
+            if child: # Never back into the call stack of the parent
+                os._exit(0)
         return status
+
+
+def boot_benchmark(jobname: str, config_dir: str='.', runs: int=3) -> Dict[str, List[float]]:
+    """
+    Boots the vm(s) of a job again and again with an empty job file, with
+    the direct kernel boot and with the normal boot one after another, and
+    prints the boot times of both.
+
+    :param jobname: Name of the job, we read jobname.cfg
+    :param config_dir: Directory of the configuration.
+    :param runs: Number of boots for each way.
+    :return: Dictionary of the boot times for fastboot and firmware.
+    """
+    times = OrderedDict([('fastboot', []), ('firmware', [])]) # type: Dict[str, List[float]]
+    tdir = tempfile.mkdtemp()
+    jobpath = os.path.join(tdir, 'empty.txt')
+    with open(jobpath, 'w') as fobj:
+        fobj.write('')
+    try:
+        for i in range(runs):
+            for mode in times:
+                stats = {} # type: Dict[str, Any]
+                if not start_multihost(jobname, jobpath, config_dir=config_dir,
+                                       fastboot=(mode == 'fastboot'), stats=stats):
+                    print("Boot failed in {0} mode.".format(mode))
+                times[mode].extend(stats.get('boot', {}).values())
+    finally:
+        clean_tmp_dirs([tdir, ])
+    print("\nBoot time in seconds")
+    for mode, values in times.items():
+        if values:
+            print("{0}: min {1:.2f} median {2:.2f} max {3:.2f} ({4} boots)".format(
+                mode, min(values), statistics.median(values), max(values), len(values)))
+    return times
+
+
+def compare_images(jobname: str, config_dir: str='.', images: Tuple[str, str]=('', '')) -> bool:
+    """
+    Runs a job with two images side by side, each vm boots once with each
+    image, and every step runs on both one after the other. Prints the
+    difference of the boot times and of each step, and for the BENCH
+    lines the confidence interval of the difference.
+
+    :param jobname: Name of the job, we read jobname.cfg and jobname.txt
+    :param config_dir: Directory of the configuration.
+    :param images: Paths of the images A and B.
+    :return: Status of the job.
+    """
+    config = read_multihost_config(os.path.join(config_dir, jobname + '.cfg'))
+    jobpath = os.path.join(config_dir, jobname + '.txt')
+    if not config.vms or not os.path.exists(jobpath):
+        print("Missing vm configuration or job file for {0}".format(jobname))
+        return False
+    for image in images:
+        if not os.path.exists(image):
+            print("Missing image {0}".format(image))
+            return False
+    newconfig = compare_config(config, images)
+    result_path = newconfig.general.get('result_path') or tempfile.mktemp()
+    newconfig.general['result_path'] = result_path
+    with open(jobpath) as fobj:
+        lines, pairs = compare_job(fobj.readlines(), config)
+    tdir = tempfile.mkdtemp()
+    stats = {} # type: Dict[str, Any]
+    name = jobname + '-compare'
+    try:
+        write_config(newconfig, os.path.join(tdir, name + '.cfg'))
+        with open(os.path.join(tdir, name + '.txt'), 'w') as fobj:
+            fobj.write('\n'.join(lines) + '\n')
+        status = start_multihost(name, os.path.join(tdir, name + '.txt'), config_dir=tdir, stats=stats)
+    finally:
+        clean_tmp_dirs([tdir, ])
+    boots = {vm: {'boot_time': '{0:.2f}'.format(seconds)} for vm, seconds in stats.get('boot', {}).items()}
+    report = compare_report(pairs, tunirutils.STR, boots, images)
+    with open(result_path, 'a') as fobj:
+        for line in report:
+            print(line)
+            fobj.write(line + '\n')
+    return status
+
+
+def bake_job(jobname: str, config_dir: str='.') -> bool:
+    """
+    Bakes a new image for the first vm of a job, with the setup section of
+    the job file (before the BAKE line). We only bake again when the base
+    image or the setup steps change.
+
+    :param jobname: Name of the job, we read jobname.cfg and jobname.txt
+    :param config_dir: Directory of the configuration.
+    :return: True if we have the baked image.
+    """
+    config = read_multihost_config(os.path.join(config_dir, jobname + '.cfg'))
+    jobpath = os.path.join(config_dir, jobname + '.txt')
+    if not config.vms or not os.path.exists(jobpath):
+        print("Missing vm configuration or job file for {0}".format(jobname))
+        return False
+    name = config.general.get('bake_name') or jobname
+    store = BakeStore(config.general.get('bake_dir') or BAKE_DIR)
+    vm = config.vms[list(config.vms.keys())[0]]
+    try:
+        base = store.resolve(vm.get('image', ''))
+    except ValueError as err:
+        print(err)
+        return False
+    with open(jobpath) as fobj:
+        setup, _ = split_setup(fobj.readlines())
+    digest = store.input_hash(base, setup, vm.get('user', ''))
+    path = store.lookup(name, digest)
+    if path:
+        print("{0}{1} is up to date at {2}".format(BAKED_PREFIX, name, path))
+        return True
+    os.makedirs(store.path, exist_ok=True)
+    path = store.image_path(name, digest)
+    if not start_multihost(jobname, jobpath, config_dir=config_dir, bake=path):
+        print("Baking {0} failed.".format(name))
+        return False
+    store.add(name, digest, base)
+    print("Baked {0}{1} at {2}".format(BAKED_PREFIX, name, path))
+    return True
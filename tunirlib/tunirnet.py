@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"Tunir module to hand out MAC/IP addresses to the vm(s) without collisions"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import json
+import time
+import fcntl
+import socket
+import logging
+import ipaddress
+import tempfile
+from contextlib import contextmanager
+from typing import List, Dict, Tuple, Any, Iterator
+
+log = logging.getLogger('tunir')
+
+LEASE_PATH = '/var/run/tunir/leases.json'
+# For the normal users, a directory writable by their (tunir) group
+SHARED_LEASE_PATH = '/var/lib/tunir/leases.json'
+
+# Host ports for ssh forwarding, and for the multicast network between vm(s)
+SSH_PORTS = (10022, 11000)
+MCAST_PORTS = (11000, 12000)
+# Same MAC for the user mode network card of every vm, each vm has its own network
+USER_MAC = '52:54:00:12:34:56'
+
+
+def pid_alive(pid: int) -> bool:
+    "Finds if a process is still running"
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # Running as some other user
+        return True
+    return True
+
+
+def port_free(port: int) -> bool:
+    "Finds if we can listen on the given port on localhost"
+    with socket.socket() as sock:
+        try:
+            sock.bind(('127.0.0.1', port))
+        except OSError:
+            return False
+    return True
+
+
+def runtime_path(path: str=LEASE_PATH) -> str:
+    """
+    Gives the path of a runtime file like the lease file. If we can not write
+    next to the given path (like /var/run/tunir for a normal user), every user
+    gets one in $XDG_RUNTIME_DIR/tunir, or in /tmp/tunir-UID.
+
+    :param path: Path of the shared file.
+    :return: Path of the file we can use.
+    """
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname, exist_ok=True)
+        if os.access(dirname, os.W_OK):
+            return path
+    except OSError:
+        pass
+    runtime = os.environ.get('XDG_RUNTIME_DIR', '')
+    if runtime:
+        dirname = os.path.join(runtime, 'tunir')
+    else:
+        dirname = os.path.join(tempfile.gettempdir(), 'tunir-{0}'.format(os.getuid()))
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    log.info("Can not write to {0}, using {1}.".format(os.path.dirname(path), dirname))
+    return os.path.join(dirname, os.path.basename(path))
+
+
+def lease_path(network: str='bridge') -> str:
+    """
+    Gives the path of the lease file. The vm(s) of all the users on the
+    bridge share the same network, so they need the same registry: it is
+    /var/run/tunir/leases.json, or /var/lib/tunir/leases.json for the
+    users who can not write to /var/run/tunir. With the user mode network
+    only the host ports are shared, and we check those before using them,
+    so every user can have a private lease file.
+
+    :param network: The network of the vm(s), bridge or user.
+    :return: Path of the lease file.
+    """
+    if network == 'user':
+        return runtime_path(LEASE_PATH)
+    for path in (LEASE_PATH, SHARED_LEASE_PATH):
+        if os.access(os.path.dirname(path), os.W_OK):
+            return path
+    raise OSError("Can not write to {0} or {1}, create {1} writable by the tunir users, "
+                  "or give a lease_file.".format(os.path.dirname(LEASE_PATH), os.path.dirname(SHARED_LEASE_PATH)))
+
+
+def share(fd: int) -> None:
+    "Lets the group of the shared lease directory write the file too"
+    try:
+        os.fchmod(fd, 0o664)
+    except PermissionError: # Created by some other user
+        pass
+
+
+def mac_from_ip(ip: str) -> str:
+    "Creates the MAC address for a fixed IP address"
+    packed = ipaddress.ip_address(ip).packed
+    return '00:16:3e:{0:02x}:{1:02x}:{2:02x}'.format(packed[1] & 0x7f, packed[2], packed[3])
+
+
+class LeaseRegistry(object):
+    """
+    Hands out unique MAC (and fixed IP) addresses to the vm(s) of all the
+    tunir processes on this host. The leases are kept in a JSON file, which
+    we only touch while holding a lock on the lock file next to it.
+
+    A lease belongs to the tunir process which took it, and to the qemu
+    process(es) of the vm(s) using it. It is reclaimed when all of them are
+    gone.
+    """
+    def __init__(self, path: str=LEASE_PATH) -> None:
+        self.path = path
+        self.lockpath = path + '.lock'
+        self.pid = os.getpid()
+
+    @contextmanager
+    def locked(self) -> Iterator[Dict[str, Any]]:
+        "Gives the registry data, and saves it back at the end"
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.lockpath, 'a') as lockobj:
+            share(lockobj.fileno())
+            fcntl.flock(lockobj, fcntl.LOCK_EX)
+            try:
+                data = {'next': 0, 'leases': {}}  # type: Dict[str, Any]
+                if os.path.exists(self.path):
+                    with open(self.path) as fobj:
+                        try:
+                            data = json.load(fobj)
+                        except ValueError:
+                            log.error("Broken lease file {0}, starting again.".format(self.path))
+                self.reclaim(data)
+                yield data
+                temppath = self.path + '.tmp'
+                with open(temppath, 'w') as fobj:
+                    share(fobj.fileno())
+                    json.dump(data, fobj, indent=2)
+                os.rename(temppath, self.path)
+            finally:
+                fcntl.flock(lockobj, fcntl.LOCK_UN)
+
+    def reclaim(self, data: Dict[str, Any]) -> None:
+        "Removes the leases leaked by dead tunir processes"
+        for mac, lease in list(data['leases'].items()):
+            if not any(pid_alive(pid) for pid in [lease.get('pid', 0)] + lease.get('vm_pids', [])):
+                log.info("Reclaiming lease {0} {1}".format(mac, lease.get('ip', '')))
+                del data['leases'][mac]
+
+    def acquire_mac(self, owner: str) -> str:
+        """
+        Gives a new MAC address. We go round the whole range before using
+        an address again, so that old ARP entries do not point to a new vm.
+
+        :param owner: Name of the vm.
+        :return: MAC address.
+        """
+        with self.locked() as data:
+            for i in range(0x10000):
+                index = (data['next'] + i) % 0x10000
+                mac = '00:16:3e:7f:{0:02x}:{1:02x}'.format(index >> 8, index & 0xff)
+                if mac not in data['leases']:
+                    data['next'] = index + 1
+                    data['leases'][mac] = {'pid': self.pid, 'owner': owner, 'time': time.time()}
+                    return mac
+        raise ValueError("No free MAC address.")
+
+    def acquire_ip(self, owner: str, start: str) -> Tuple[str, str]:
+        """
+        Gives the first free IP address from start in the same network.
+
+        :param owner: Name of the vm.
+        :param start: First address and the network, like 192.168.122.200/24
+        :return: (IP address, MAC address)
+        """
+        interface = ipaddress.ip_interface(start)
+        network = interface.network
+        address = interface.ip
+        with self.locked() as data:
+            used = set(lease.get('ip') for lease in data['leases'].values())
+            while address in network and address != network.broadcast_address:
+                ip = str(address)
+                mac = mac_from_ip(ip)
+                if ip not in used and mac not in data['leases']:
+                    data['leases'][mac] = {'pid': self.pid, 'owner': owner, 'ip': ip, 'time': time.time()}
+                    return ip, mac
+                address += 1
+        raise ValueError("No free IP address in {0}".format(start))
+
+    def acquire_port(self, owner: str, ports: Tuple[int, int]=SSH_PORTS, check: bool=True) -> int:
+        """
+        Gives a host port which no other vm is using.
+
+        :param owner: Name of the vm.
+        :param ports: Range of the ports to use.
+        :param check: Also check that nobody is listening on the port.
+        :return: Port number.
+        """
+        with self.locked() as data:
+            for port in range(*ports):
+                key = 'port:{0}'.format(port)
+                if key in data['leases'] or (check and not port_free(port)):
+                    continue
+                data['leases'][key] = {'pid': self.pid, 'owner': owner, 'time': time.time()}
+                return port
+        raise ValueError("No free port in {0}-{1}".format(*ports))
+
+    def sweep(self) -> None:
+        "Reclaims the leases of the dead processes now, and not at the next acquire"
+        with self.locked():
+            pass
+
+    def attach(self, keys: List[str], vm_pid: int) -> None:
+        "Marks the leases (MAC addresses or port:NUMBER) as used by the qemu process too"
+        with self.locked() as data:
+            for key in keys:
+                if key in data['leases']:
+                    data['leases'][key].setdefault('vm_pids', []).append(vm_pid)
+
+    def release(self, macs: List[str]=None) -> None:
+        """
+        Releases the given leases, or all the leases of this process.
+
+        :param macs: List of MAC addresses (or port:NUMBER keys).
+        """
+        with self.locked() as data:
+            for mac, lease in list(data['leases'].items()):
+                if (macs is None and lease.get('pid') == self.pid) or (macs and mac in macs):
+                    del data['leases'][mac]
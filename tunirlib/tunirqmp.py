@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"Tunir module to control the qemu vm(s) over QMP, and to talk to the guest agent"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import json
+import time
+import queue
+import signal
+import socket
+import logging
+import threading
+from typing import List, Dict, Tuple, Any
+
+log = logging.getLogger('tunir')
+
+# Events after which a booting vm will never become ready
+FATAL_EVENTS = ('SHUTDOWN', 'GUEST_PANICKED')
+
+
+class QMPError(Exception):
+    "QMP connection failed, or qemu returned an error"
+    def __init__(self,*args,**kwargs):
+        Exception.__init__(self,*args,**kwargs)
+
+
+def qmp_args(qmp: str, qga: str='') -> List[str]:
+    """
+    Creates the qemu options for the QMP socket and the guest agent socket.
+
+    :param qmp: Path of the QMP unix socket.
+    :param qga: Path of the guest agent unix socket.
+    :return: List of qemu options.
+    """
+    args = ['-qmp', 'unix:{0},server=on,wait=off'.format(qmp)]
+    if qga:
+        args += ['-chardev', 'socket,path={0},server=on,wait=off,id=qga0'.format(qga),
+                 '-device', 'virtio-serial',
+                 '-device', 'virtserialport,chardev=qga0,name=org.qemu.guest_agent.0']
+    return args
+
+
+class QMPClient(object):
+    """
+    A small QMP client. Replies and events from qemu can come at any time,
+    so a reader thread keeps reading the socket, hands the replies to the
+    command waiting for them, and queues the events for wait_event.
+    """
+    def __init__(self, path: str, timeout: float=10) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.sock = None # type: socket.socket
+        self.fobj = None # type: Any
+        self.replies = {} # type: Dict[int, queue.Queue]
+        self.events = queue.Queue() # type: queue.Queue
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.greeting = {} # type: Dict[str, Any]
+
+    def connect(self, tries: int=50) -> 'QMPClient':
+        "Connects to qemu, tries again for a while as qemu may not be listening yet"
+        for i in range(tries):
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(self.path)
+                break
+            except OSError as err:
+                self.sock.close()
+                if i == tries - 1:
+                    raise QMPError("Can not connect to {0}: {1}".format(self.path, err))
+                time.sleep(0.1)
+        self.fobj = self.sock.makefile('r')
+        try:
+            self.greeting = json.loads(self.fobj.readline())
+        except (OSError, ValueError) as err: # qemu went away, or an empty line
+            self.close()
+            raise QMPError("No QMP greeting from {0}: {1}".format(self.path, err))
+        self.sock.settimeout(None)
+        thread = threading.Thread(target=self.reader, daemon=True)
+        thread.start()
+        self.execute('qmp_capabilities')
+        return self
+
+    def reader(self) -> None:
+        "Reads the messages from qemu till the socket closes"
+        try:
+            for line in self.fobj:
+                message = json.loads(line)
+                if 'event' in message:
+                    self.events.put(message)
+                else:
+                    # execute may remove the queue at any time, after a timeout
+                    reply = self.replies.get(message.get('id'))
+                    if reply is not None:
+                        reply.put(message)
+        except (OSError, ValueError) as err:
+            log.info("QMP reader stopped: {0}".format(err))
+        # Wake up everyone still waiting for a reply
+        for reply in list(self.replies.values()):
+            reply.put({'error': {'desc': 'QMP connection closed'}})
+
+    def execute(self, command: str, arguments: Dict[str, Any]=None, timeout: float=None) -> Any:
+        """
+        Executes a QMP command and returns the reply.
+
+        :param command: Name of the command.
+        :param arguments: Arguments of the command.
+        :param timeout: Seconds to wait for the reply.
+        :return: The return value from qemu.
+        """
+        with self.lock:
+            self.counter += 1
+            number = self.counter
+            self.replies[number] = queue.Queue()
+        message = {'execute': command, 'id': number} # type: Dict[str, Any]
+        if arguments:
+            message['arguments'] = arguments
+        try:
+            self.sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            reply = self.replies[number].get(timeout=timeout or self.timeout)
+        except (OSError, queue.Empty) as err:
+            raise QMPError("{0} failed: {1}".format(command, err))
+        finally:
+            del self.replies[number]
+        if 'error' in reply:
+            raise QMPError("{0} failed: {1}".format(command, reply['error'].get('desc')))
+        return reply.get('return')
+
+    def wait_event(self, name: str, timeout: float) -> Dict[str, Any]:
+        """
+        Waits for an event from qemu.
+
+        :param name: Name of the event like SHUTDOWN.
+        :param timeout: Seconds to wait.
+        :return: The event, or None if it did not come.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                event = self.events.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if event['event'] == name:
+                return event
+
+    def seen_event(self, names: Tuple[str, ...]=FATAL_EVENTS) -> str:
+        "Returns the name of a queued event from names, empty string if none came yet"
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return ''
+            if event['event'] in names:
+                return event['event']
+
+    def query_status(self) -> str:
+        "Returns the run state of the vm, like running or paused"
+        return self.execute('query-status')['status']
+
+    def snapshot(self, name: str, device: str='virtio0') -> None:
+        "Takes an internal snapshot of the disk while the vm is running"
+        self.execute('blockdev-snapshot-internal-sync', {'device': device, 'name': name}, timeout=300)
+
+    def close(self) -> None:
+        if self.sock:
+            self.sock.close()
+
+
+def guest_agent(path: str, command: str, timeout: float=5) -> Any:
+    """
+    Executes a command in the qemu guest agent of the vm.
+
+    :param path: Path of the guest agent unix socket.
+    :param command: Name of the command like guest-network-get-interfaces.
+    :param timeout: Seconds to wait for the reply.
+    :return: The return value from the agent.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        fobj = sock.makefile('r')
+        # The agent does not know where a new client starts, so we sync first
+        number = int(time.time() * 1000) % 100000000
+        sock.sendall(json.dumps({'execute': 'guest-sync', 'arguments': {'id': number}}).encode('utf-8') + b'\n')
+        while True:
+            line = fobj.readline()
+            if not line:
+                raise QMPError("Guest agent closed the connection")
+            try:
+                if json.loads(line).get('return') == number:
+                    break
+            except ValueError: # Left over from an old client
+                continue
+        sock.sendall(json.dumps({'execute': command}).encode('utf-8') + b'\n')
+        reply = json.loads(fobj.readline())
+    if 'error' in reply:
+        raise QMPError("{0} failed: {1}".format(command, reply['error'].get('desc')))
+    return reply.get('return')
+
+
+def guest_ip(path: str, mac: str) -> str:
+    """
+    Finds the IPv4 address of the network card with the given MAC address
+    using the guest agent.
+
+    :param path: Path of the guest agent unix socket.
+    :param mac: MAC address of the network card.
+    :return: The IP address, empty string if we do not know it yet.
+    """
+    try:
+        interfaces = guest_agent(path, 'guest-network-get-interfaces')
+    except (OSError, ValueError, QMPError):
+        return ''
+    for interface in interfaces:
+        if interface.get('hardware-address', '').lower() != mac.lower():
+            continue
+        for address in interface.get('ip-addresses', []):
+            if address.get('ip-address-type') == 'ipv4':
+                return address['ip-address']
+    return ''
+
+
+def process_gone(pid: int) -> bool:
+    "Finds if the process exited, and reaps it if it is our child"
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return True
+    except ChildProcessError: # Not our child
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+    return False
+
+
+def stop_vm(vm: Dict[str, Any], timeout: float=0) -> None:
+    """
+    Stops the qemu process of a vm. With a timeout we ask the guest to power
+    down first, else we ask qemu to quit. If QMP does not work, or the vm
+    does not stop in time, we kill the process.
+
+    :param vm: Configuration dictionary of the vm, with process and qmp.
+    :param timeout: Seconds to wait for the guest to power down.
+    """
+    pid = int(vm['process'])
+    qmp = vm.get('qmp', '')
+    if qmp and os.path.exists(qmp):
+        client = QMPClient(qmp)
+        try:
+            client.connect(tries=1)
+            if timeout:
+                client.execute('system_powerdown')
+                if not client.wait_event('SHUTDOWN', timeout):
+                    log.info("{0} did not power down in {1} seconds.".format(pid, timeout))
+            client.execute('quit')
+            for i in range(50):
+                if process_gone(pid):
+                    return
+                time.sleep(0.1)
+        except (OSError, QMPError) as err:
+            log.info("QMP stop failed for {0}: {1}".format(pid, err))
+        finally:
+            client.close()
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"Tunir module to tear down the runs in the background, and to clean up after crashed runs"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import glob
+import json
+import time
+import socket
+import logging
+from typing import List, Dict, Any
+
+from .tunirutils import clean_tmp_dirs
+from .tunirqmp import stop_vm
+from .tunirnet import LeaseRegistry, pid_alive, runtime_path
+from .tunirvagrant import destroy_box
+
+log = logging.getLogger('tunir')
+
+# Every run writes what it created in a manifest file in this directory
+RUNS_DIR = '/var/run/tunir'
+
+
+def run_marker(pid: int=0) -> str:
+    "Marks the things a tunir process created outside of this host, like EC2 nodes"
+    return '{0}:{1}'.format(socket.gethostname(), pid or os.getpid())
+
+
+def marker_dead(marker: str) -> bool:
+    "Finds if the tunir process of a marker from this host is gone"
+    host, _, pid = marker.rpartition(':')
+    return host == socket.gethostname() and pid.isdigit() and not pid_alive(int(pid))
+
+
+def is_qemu(pid: int) -> bool:
+    "Finds if the process is still a qemu, and not a new process with the same pid"
+    try:
+        with open('/proc/{0}/cmdline'.format(pid), 'rb') as fobj:
+            return b'qemu' in fobj.read()
+    except OSError:
+        return False
+
+
+class RunManifest(object):
+    """
+    Keeps the list of the vm(s), directories, leases and Vagrant boxes of a
+    run in a JSON file, written after every change. If tunir crashes, the
+    reaper can still find and remove all of those.
+    """
+    def __init__(self, kind: str='', path: str='') -> None:
+        """
+        :param kind: Part of the file name, for a second manifest of the same process.
+        :param path: Path of the manifest file.
+        """
+        name = 'run-{0}{1}.json'.format(os.getpid(), '-' + kind if kind else '')
+        self.path = path or runtime_path(os.path.join(RUNS_DIR, name))
+        self.data = {'pid': os.getpid(), 'time': time.time(), 'vms': {}, 'dirs': [], 'prefixes': ['/tmp'],
+                     'lease_file': '', 'vagrant': {}} # type: Dict[str, Any]
+
+    def save(self) -> None:
+        temppath = self.path + '.tmp'
+        with open(temppath, 'w') as fobj:
+            json.dump(self.data, fobj, indent=2)
+        os.rename(temppath, self.path)
+
+    def add(self, key: str, values: List[Any]) -> None:
+        "Adds to the dirs or prefixes list"
+        self.data[key].extend(value for value in values if value not in self.data[key])
+        self.save()
+
+    def add_vm(self, name: str, vm: Dict[str, Any]) -> None:
+        self.data['vms'][name] = {'process': vm['process'], 'qmp': vm.get('qmp', '')}
+        self.save()
+
+    def set(self, key: str, value: Any) -> None:
+        self.data[key] = value
+        self.save()
+
+    def remove(self) -> None:
+        "The run cleaned up after itself"
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def background() -> bool:
+    """
+    Forks a new process for the teardown, in a new session so that it
+    lives after tunir exits.
+
+    :return: True in the parent process, False in the child.
+    """
+    if os.fork():
+        return True
+    os.setsid()
+    return False
+
+
+def reap_run(data: Dict[str, Any]) -> None:
+    """
+    Removes everything in the manifest of a run.
+
+    :param data: The manifest data.
+    """
+    for name, vm in data.get('vms', {}).items():
+        if is_qemu(int(vm['process'])):
+            print("Stopping {0} (pid {1})".format(name, vm['process']))
+            stop_vm(vm)
+    if data.get('lease_file'):
+        # The leases go with the dead tunir and qemu processes
+        LeaseRegistry(data['lease_file']).sweep()
+    clean_tmp_dirs(data.get('dirs', []), tuple(data.get('prefixes', ['/tmp'])))
+    box = data.get('vagrant')
+    if box:
+        print("Destroying the Vagrant box in {0}".format(box['path']))
+        destroy_box(box['path'], box['name'], box['provider'])
+
+
+def reap(path: str='', force: bool=False) -> int:
+    """
+    Cleans up the runs whose tunir process is gone.
+
+    :param path: Directory of the manifest files.
+    :param force: Clean up the runs which are still going on too.
+    :return: Number of the runs we cleaned up.
+    """
+    path = path or os.path.dirname(runtime_path(os.path.join(RUNS_DIR, 'run.json')))
+    count = 0
+    for filename in sorted(glob.glob(os.path.join(path, 'run-*.json'))):
+        try:
+            with open(filename) as fobj:
+                data = json.load(fobj)
+        except (OSError, ValueError) as err:
+            log.error("Can not read {0}: {1}".format(filename, err))
+            continue
+        if data.get('pid') == os.getpid() or (pid_alive(data.get('pid', 0)) and not force):
+            continue
+        print("Reaping the run of tunir process {0} from {1}".format(data.get('pid'), time.ctime(data.get('time', 0))))
+        reap_run(data)
+        os.unlink(filename)
+        count += 1
+    return count
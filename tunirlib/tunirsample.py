@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"Tunir module to sample the host resources the vm(s) use during a job"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any
+
+log = logging.getLogger('tunir')
+
+MB = 1024 * 1024
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+# Columns of the time series file
+SAMPLE_FIELDS = ('time', 'vm', 'step', 'cpu', 'rss', 'read', 'write', 'load')
+
+
+def read_proc(pid: int) -> Dict[str, float]:
+    """
+    Reads the CPU time, the RSS and the disk I/O of a process.
+
+    :param pid: Process id.
+    :return: Dictionary with cpu (seconds), rss, read and write (bytes), empty if the process is gone.
+    """
+    values = {'cpu': 0.0, 'rss': 0.0, 'read': 0.0, 'write': 0.0}
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as fobj:
+            # The name can have spaces, the fields start after it
+            fields = fobj.read().rpartition(')')[2].split()
+        values['cpu'] = (int(fields[11]) + int(fields[12])) / CLK_TCK
+        with open('/proc/{0}/status'.format(pid)) as fobj:
+            for line in fobj:
+                if line.startswith('VmRSS:'):
+                    values['rss'] = int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        return {}
+    try:
+        with open('/proc/{0}/io'.format(pid)) as fobj:
+            for line in fobj:
+                key, _, value = line.partition(':')
+                if key == 'read_bytes':
+                    values['read'] = int(value)
+                elif key == 'write_bytes':
+                    values['write'] = int(value)
+    except OSError: # Only root can read the io of other users
+        pass
+    return values
+
+
+def host_load() -> float:
+    "The one minute load average of the host"
+    try:
+        with open('/proc/loadavg') as fobj:
+            return float(fobj.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class Sampler(threading.Thread):
+    """
+    Reads /proc for each qemu process every interval seconds, and adds the
+    CPU time, disk I/O and the peak RSS to the job step running at that
+    time. We also sample when the step changes, so each step gets what the
+    vm(s) used while it ran. Every sample goes into a CSV time series file.
+    """
+    def __init__(self, pids: Dict[str, int], interval: float=1.0, path: str='') -> None:
+        """
+        :param pids: Name of each vm and the pid of its qemu.
+        :param interval: Seconds between two samples.
+        :param path: Path of the time series file, empty for none.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.path = path
+        self.step = '' # The job step running now
+        self.last = {} # type: Dict[str, Dict[str, float]]
+        self.steps = OrderedDict() # type: Dict[str, Dict[str, Dict[str, float]]]
+        self.max_load = 0.0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.fobj = open(path, 'w') if path else None
+        if self.fobj:
+            self.fobj.write(','.join(SAMPLE_FIELDS) + '\n')
+
+    def sample(self) -> None:
+        "Reads all the processes once, and adds the difference to the current step"
+        with self.lock:
+            now = time.time()
+            load = host_load()
+            self.max_load = max(self.max_load, load)
+            for name, pid in self.pids.items():
+                values = read_proc(pid)
+                if not values:
+                    continue
+                last = self.last.get(name)
+                self.last[name] = values
+                if last is None: # The first sample is where we start counting
+                    continue
+                total = self.steps.setdefault(self.step, OrderedDict()).setdefault(
+                    name, {'cpu': 0.0, 'rss': 0.0, 'read': 0.0, 'write': 0.0})
+                for key in ('cpu', 'read', 'write'):
+                    total[key] += max(values[key] - last[key], 0)
+                total['rss'] = max(total['rss'], values['rss'])
+                if self.fobj:
+                    self.fobj.write('{0:.3f},{1},"{2}",{3:.2f},{4:.0f},{5:.0f},{6:.0f},{7:.2f}\n'.format(
+                        now, name, self.step.replace('"', '""'), values['cpu'], values['rss'],
+                        values['read'], values['write'], load))
+
+    def mark(self, step: str) -> None:
+        "A new job step starts now"
+        self.sample()
+        with self.lock:
+            self.step = step
+
+    def run(self) -> None:
+        self.sample()
+        while not self.done.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as err: # Never break the job for the numbers
+                log.error("Sampler: {0}".format(err))
+
+    def stop(self) -> None:
+        "Takes the last sample and stops the thread, we can call it many times"
+        if self.done.is_set():
+            return
+        self.done.set()
+        if self.is_alive():
+            self.join()
+        self.sample()
+        with self.lock:
+            if self.fobj:
+                self.fobj.close()
+                self.fobj = None
+
+    def totals(self) -> Dict[str, Dict[str, float]]:
+        "What each vm used in the whole job"
+        result = OrderedDict() # type: Dict[str, Dict[str, float]]
+        for values in self.steps.values():
+            for name, step in values.items():
+                total = result.setdefault(name, {'cpu': 0.0, 'rss': 0.0, 'read': 0.0, 'write': 0.0})
+                for key in ('cpu', 'read', 'write'):
+                    total[key] += step[key]
+                total['rss'] = max(total['rss'], step['rss'])
+        return result
+
+    def report(self) -> List[str]:
+        "Lines with the usage of each vm in the job, and in each step"
+        def text(values: Dict[str, float]) -> str:
+            return "cpu {0:.2f}s, peak rss {1:.1f} MB, read {2:.1f} MB, write {3:.1f} MB".format(
+                values['cpu'], values['rss'] / MB, values['read'] / MB, values['write'] / MB)
+
+        lines = ["resources: {0} {1}".format(name, text(values)) for name, values in self.totals().items()]
+        for step, values in self.steps.items():
+            for name, used in values.items():
+                if used['cpu'] or used['read'] or used['write']:
+                    lines.append("resources: {0} [{1}] {2}".format(name, step or 'before the job', text(used)))
+        lines.append("resources: host load max {0:.2f}".format(self.max_load))
+        if self.path:
+            lines.append("resources: samples in {0}".format(self.path))
+        return lines
+
+
+def start_sampler(vms: Dict[str, Dict[str, Any]], interval: float, path: str='') -> Sampler:
+    """
+    Starts a sampler for the vm(s) we booted.
+
+    :param vms: The vm(s) of the job, only the ones with a qemu process are sampled.
+    :param interval: Seconds between two samples, 0 or less for no sampler.
+    :param path: Path of the time series file.
+    :return: The running Sampler, or None.
+    """
+    pids = OrderedDict((name, int(vm['process'])) for name, vm in vms.items() if vm.get('process'))
+    if interval <= 0 or not pids:
+        return None
+    sampler = Sampler(pids, interval, path)
+    sampler.start()
+    return sampler
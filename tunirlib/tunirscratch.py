@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"Tunir module to keep the run directories of the vm(s) in RAM when we can"
+
+# Copyright © 2015-2016  Kushal Das <kushaldas@gmail.com>
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+import os
+import shutil
+import tempfile
+import logging
+from collections import OrderedDict
+from typing import List, Dict, Tuple
+
+log = logging.getLogger('tunir')
+
+# scratch = ram in the configuration means this tmpfs
+RAM_SCRATCH = '/dev/shm'
+MB = 1024 * 1024
+
+
+def mem_available() -> int:
+    "Bytes of memory the host can still give, from /proc/meminfo"
+    try:
+        with open('/proc/meminfo') as fobj:
+            for line in fobj:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def dir_usage(path: str) -> int:
+    "Bytes used by the files in a directory, counting only the allocated blocks"
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError: # Removed while we walk
+                pass
+    return total
+
+
+class Scratch(object):
+    """
+    Creates the run directories (seed, disk copy) of a job. With a RAM backed
+    root (a tmpfs like /dev/shm) the directories go there, as long as the
+    filesystem and the host memory can take the new files, the space the
+    guest may write (headroom) and the memory of the vm. Else we use the
+    disk as before.
+    """
+    def __init__(self, root: str='', headroom: int=1024 * MB) -> None:
+        self.root = root
+        self.headroom = headroom
+        self.reserved = 0 # Space the vm(s) in RAM may still write
+        # Memory of the vm(s) in RAM, the guests take it later so MemAvailable does not show it yet
+        self.reserved_ram = 0
+        self.dirs = OrderedDict() # type: Dict[str, Tuple[str, str]]
+
+    def fits(self, need: int, ram: int=0) -> bool:
+        """
+        Finds if the RAM scratch can take more files.
+
+        :param need: Bytes we will write now, and the headroom.
+        :param ram: Bytes of memory the vm will use.
+        :return: True if there is space.
+        """
+        if not self.root or not os.path.isdir(self.root):
+            return False
+        free = shutil.disk_usage(self.root).free - self.reserved
+        return need <= free and need + ram + self.reserved + self.reserved_ram <= mem_available()
+
+    def mkdtemp(self, name: str, size: int=0, ram: int=0) -> str:
+        """
+        Creates a run directory.
+
+        :param name: Name of the vm (or seed), for the report.
+        :param size: Bytes we will copy into the directory.
+        :param ram: Bytes of memory the vm will use, 0 if no vm writes there.
+        :return: Path of the directory.
+        """
+        headroom = self.headroom if ram else 0
+        if self.fits(size + headroom, ram):
+            path = tempfile.mkdtemp(prefix='tunir-', dir=self.root)
+            self.reserved += headroom
+            self.reserved_ram += ram
+            kind = 'ram'
+        else:
+            if self.root:
+                print("Not enough RAM for {0}, using the disk.".format(name))
+            path = tempfile.mkdtemp()
+            kind = 'disk'
+        self.dirs[path] = (name, kind)
+        return path
+
+    def prefixes(self) -> Tuple[str, ...]:
+        "Where clean_tmp_dirs may remove our directories"
+        if self.root:
+            return ('/tmp', self.root)
+        return ('/tmp',)
+
+    def report(self) -> List[str]:
+        "Lines with the space used by each run directory"
+        lines = [] # type: List[str]
+        total = {'ram': 0, 'disk': 0}
+        for path, (name, kind) in self.dirs.items():
+            used = dir_usage(path)
+            total[kind] += used
+            lines.append("scratch: {0} {1} {2:.1f} MB ({3})".format(name, kind, used / MB, path))
+        lines.append("scratch total: ram {0:.1f} MB, disk {1:.1f} MB".format(total['ram'] / MB, total['disk'] / MB))
+        return lines
+
+
+def scratch_root(value: str) -> str:
+    "The directory for the scratch value of the configuration, ram means /dev/shm"
+    if value == 'ram':
+        return RAM_SCRATCH
+    return value or ''
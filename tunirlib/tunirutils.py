@@ -1,16 +1,29 @@
 import os
 import re
+import base64
 import sys
 import time
 import json
+import uuid
+import shlex
 import shutil
+import hashlib
+import posixpath
+import random
+import statistics
 import paramiko
 import socket
 import codecs
 import logging
+import threading
 import subprocess
+import configparser
+import concurrent.futures
 from collections import OrderedDict
-from typing import List, Dict, Set, Tuple, Union, Callable, TypeVar, Any, cast
+from typing import List, Dict, Set, Tuple, Union, Callable, TypeVar, Any, Iterator, cast
+from .tunirqmp import QMPClient
+from .tunirbake import split_setup
+from .tunirsample import Sampler
 log = logging.getLogger('tunir')
 
 T_Callable = TypeVar('T_Callable', bound=Callable[...,Any])
@@ -48,23 +61,56 @@ class TunirConfig:
     def __init__(self) -> None:
         self.general = {}  # type: Dict[str, str]
         self.vms = {}  # type: Dict[str, Dict[str,str]]
+        self.groups = {}  # type: Dict[str, str]
+        self.artifacts = {}  # type: Dict[str, str]
 
 
-def match_vm_numbers(vm_keys: List[str], jobpath: str) -> bool:
+def expand_range(text: str) -> List[str]:
+    """
+    Expands a range of vm names like vm[1-4] or node[01-10].
+
+    :param text: The range text.
+    :return: List of names, empty if text is not a range.
+    """
+    match = re.search(r'^([\w.-]*)\[(\d+)-(\d+)\]$', text)
+    if not match:
+        return []
+    prefix, start, end = match.groups()
+    width = len(start) if start.startswith('0') else 1
+    return ['{0}{1:0{2}d}'.format(prefix, i, width) for i in range(int(start), int(end) + 1)]
+
+
+# Directives which have the vm name(s) as the second word
+TARGET_DIRECTIVES = ('BENCH', 'POLL', 'REBOOT', 'SNAPSHOT', 'WAITFOR', 'WAITUNTIL')
+# Directives with the vm name(s) in a vm:path word, and the index of that word
+TRANSFER_DIRECTIVES = {'GET': 1, 'PUT': 2, 'SYNC': 2}
+
+
+def match_vm_numbers(vm_keys: List[str], jobpath: str, groups: Dict[str, str]=None) -> bool:
     """Matches vm definations mentioned in config, and in the job file.
 
     :param vm_keys: vm(s) from the configuration
     :param jobpath: Path to the job file.
+    :param groups: Named groups of vm(s) from the configuration
     """
     commands = [] # type: List[str]
+    groups = groups or {}
     with open(jobpath) as fobj:
         commands = fobj.readlines()
     job_vms = {} # type: Dict[str, bool]
     for command in commands:
-        if re.search('^vm[0-9] ', command):
-            index = command.find(' ')
-            vm_name = command[:index]
-            job_vms[vm_name] = True
+        words = command.split()
+        word = words[0] if words else ''
+        if word in TARGET_DIRECTIVES and len(words) > 1:
+            word = words[1]
+        elif word in TRANSFER_DIRECTIVES and len(words) > TRANSFER_DIRECTIVES[word]:
+            word = words[TRANSFER_DIRECTIVES[word]].partition(':')[0]
+        for item in word.split(','):
+            if re.search(r'^vm[0-9]+$', item):
+                job_vms[item] = True
+            elif item not in groups:
+                for vm_name in expand_range(item):
+                    job_vms[vm_name] = True
     job_vms_keys = job_vms.keys()
     diff = list(set(job_vms_keys) - set(vm_keys))
     if diff:
@@ -77,6 +123,14 @@ def match_vm_numbers(vm_keys: List[str], jobpath: str) -> bool:
     return True
 
 
+def proxy_command(vm: Dict[str, str]) -> str:
+    "The ssh ProxyCommand through the bastion of a vm, with the proxy_key (or the key) of the vm"
+    host, port, user = parse_jump(vm['proxy_jump'], vm['user'])
+    key = vm.get('proxy_key') or vm.get('key')
+    return "ssh {0}-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -W %h:%p -p {1} {2}@{3}".format(
+        '-i {0} '.format(key) if key else '', port, user, host)
+
+
 def create_ansible_inventory(vms: Dict[str, Dict[str,str]], filepath: str) -> None:
     """Creates our inventory file for ansible
 
@@ -89,8 +143,13 @@ def create_ansible_inventory(vms: Dict[str, Dict[str,str]], filepath: str) -> No
     for k, v in vms.items():
         # ip hostname format for /etc/hosts
         hostname = v.get('hostname',k)
-        line = "{0} ansible_ssh_host={1} ansible_ssh_user={2}\n".format(hostname,v['ip'],v['user'])
-        text += line
+        line = "{0} ansible_ssh_host={1} ansible_ssh_user={2}".format(hostname, v.get('host_string', v['ip']),
+                                                                      v['user'])
+        if str(v.get('port', '22')) != '22': # For user mode networking
+            line += " ansible_ssh_port={0}".format(v['port'])
+        if v.get('proxy_jump'):
+            line += " ansible_ssh_common_args='-o ProxyCommand=\"{0}\"'".format(proxy_command(v))
+        text += line + "\n"
 
     dirpath = os.path.dirname(filepath)
     original_inventory = os.path.join(dirpath, 'inventory')
@@ -103,53 +162,193 @@ def create_ansible_inventory(vms: Dict[str, Dict[str,str]], filepath: str) -> No
             fobj.write(extra)
 
 
+# Our ansible settings, what the ansible.cfg of the ansible_dir has stays
+ANSIBLE_SETTINGS = OrderedDict([
+    ('defaults', OrderedDict([
+        ('host_key_checking', 'False'),
+        ('retry_files_enabled', 'False'),
+        # Facts are gathered once for all the playbooks of the job
+        ('gathering', 'smart'),
+        ('fact_caching', 'jsonfile'),
+        ('fact_caching_timeout', '86400'),
+    ])),
+    ('ssh_connection', OrderedDict([
+        ('pipelining', 'True'),
+        ('ssh_args', '-o ControlMaster=auto -o ControlPersist=60s '
+                     '-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'),
+    ])),
+])
+
+
+def create_ansible_config(vms: Dict[str, Dict[str,str]], dirpath: str, keypath: str) -> str:
+    """Creates the ansible.cfg next to our inventory file, so that every
+    playbook reuses one ssh connection for each vm (ControlPersist and
+    pipelining), runs on all the vm(s) at once, and caches the facts.
+
+    :param vms: Dictionary containing vm details
+    :param dirpath: The directory with the tunir_ansible inventory
+    :param keypath: Path of the private key for the vm(s)
+    :return: Path of the ansible.cfg
+    """
+    filepath = os.path.join(dirpath, 'ansible.cfg')
+    parser = configparser.RawConfigParser()
+    if os.path.exists(filepath): # From the ansible_dir
+        parser.read(filepath)
+    values = {
+        'defaults': {'inventory': os.path.join(dirpath, 'tunir_ansible'), 'private_key_file': keypath,
+                     'forks': str(max(len(vms), 1)), 'fact_caching_connection': os.path.join(dirpath, 'facts')},
+        'ssh_connection': {'control_path_dir': os.path.join(dirpath, 'cp')},
+    }
+    for section, options in ANSIBLE_SETTINGS.items():
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for key, value in list(options.items()) + list(values[section].items()):
+            if not parser.has_option(section, key):
+                parser.set(section, key, value)
+    with open(filepath, 'w') as fobj:
+        parser.write(fobj)
+    return filepath
+
+
+def ssh_banner_ready(host: str, port: str='22', timeout: float=5) -> bool:
+    """
+    Cheap check before we try to login, if the port accepts a TCP
+    connection and sends the SSH banner.
+    """
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            return sock.recv(64).startswith(b'SSH-')
+    except (OSError, socket.timeout):
+        return False
+
+
+def vm_banner_ready(config: Dict[str, Any], timeout: float=5) -> bool:
+    "ssh_banner_ready for a vm, through its bastion if it has a proxy_jump"
+    if not config.get('proxy_jump'):
+        return ssh_banner_ready(config['host_string'], config.get('port', '22'))
+    try:
+        chan = POOL.sock(config)
+    except (OSError, paramiko.ssh_exception.SSHException): # Bastion down, or the vm port is closed
+        return False
+    try:
+        chan.settimeout(timeout)
+        return chan.recv(64).startswith(b'SSH-')
+    except (OSError, socket.timeout):
+        return False
+    finally:
+        chan.close()
+
+
+def wait_ready(config: Dict[str, Any], deadline: float=300, failed: Callable[[], str]=None) -> bool:
+    """
+    Waits till we can login to the vm and run true, using exponential
+    backoff with jitter between the tries.
+
+    :param config: Configuration dictionary of the vm.
+    :param deadline: Maximum seconds to wait.
+    :param failed: Optional function which returns why the vm will never be ready.
+    :return: True if the vm is ready.
+    """
+    end = time.time() + deadline
+    for delay in backoff(initial=0.5, maximum=10):
+        reason = failed() if failed else ''
+        if reason:
+            print("{0} will not be ready: {1}".format(config.get('host_string', ''), reason))
+            return False
+        if vm_banner_ready(config):
+            try:
+                result = POOL.run(config, 'true', timeout=30)
+                if result.return_code == 0:
+                    return True
+            except Exception: # Keeping trying
+                POOL.drop(config)
+        remaining = end - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+    return False
+
+
 def poll(config: Dict[str, str]) -> bool:
     "Keeps polling for a SSH connection"
-    for i in range(30):
-        try:
-            print("Polling for SSH connection")
-            result = run(config['host_string'], config.get('port', '22'), config['user'],
-                         config.get('password', None), 'true', key_filename=config.get('key', None),
-                         timeout=config.get('timeout', 60), pkey=config.get('pkey', None))
-            if result.return_code == 0:
-                return True
-        except: # Keeping trying
-            time.sleep(10)
-    return False
+    print("Polling for SSH connection")
+    return wait_ready(config, int(config.get('poll_timeout', 300)))
 
 
-def run(host='127.0.0.1', port='22', user='root',
-                  password=None, command='/bin/true', bufsize=-1, key_filename='',
-                  timeout=120, pkey=None, debug=False):
-    # type(str, str, str, str, str, int, str, int, Any, bool) -> T_Result
+def poll_directive(command: str, config: TunirConfig) -> bool:
     """
-    Excecutes a command using paramiko and returns the result.
+    Executes a POLL directive, waits for all the given vm(s) together.
+
+        POLL
+        POLL all
+        POLL vm2,vm3 timeout=120
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: True if all the vm(s) are ready.
+    """
+    match = re.search(r'\s+timeout=(\d+)\s*$', command)
+    if match:
+        command = command[:match.start()]
+    words = command.split()
+    names = expand_targets(words[1], config) if len(words) > 1 else [default_vm(config)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = {}  # type: Dict[str, concurrent.futures.Future]
+        for name in names:
+            vm = config.vms[name]
+            deadline = int(match.group(1)) if match else int(vm.get('poll_timeout', 300))
+            futures[name] = executor.submit(wait_ready, vm, deadline)
+        failed = [name for name, future in futures.items() if not future.result()]
+    if failed:
+        print("Poll failed for {0}".format(', '.join(failed)))
+        return False
+    return True
+
+
+def connect(host='127.0.0.1', port='22', user='root', password=None,
+            key_filename='', pkey=None, debug=False, sock=None):
+    # type: (str, str, str, str, str, Any, bool, Any) -> paramiko.SSHClient
+    """
+    Opens an authenticated SSH connection using paramiko.
     :param host: Host to connect
     :param port: The port number
     :param user: The username of the system
     :param password: User password
-    :param command: The command to run
     :param key_filename: SSH private key file.
     :param pkey: RSAKey if we want to login with a in-memory key
     :param debug: Boolean to print debug messages
-    :return:
+    :param sock: Channel to the host through a bastion, from SSHPool.sock
+    :return: Connected paramiko.SSHClient
     """
     if debug:
         print(host, port, user)
-    port = int(port)
+    port_number = int(port)
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     if password:
-        client.connect(hostname=host, port=int(port),
-            username=user, password=password, banner_timeout=10)
+        client.connect(hostname=host, port=port_number,
+            username=user, password=password, banner_timeout=10, sock=sock)
     elif key_filename:
-        client.connect(hostname=host, port=int(port),
-            username=user, key_filename=key_filename, banner_timeout=10)
+        client.connect(hostname=host, port=port_number,
+            username=user, key_filename=key_filename, banner_timeout=10, sock=sock)
     else:
         if debug:
             print('We have a key')
-        client.connect(hostname=host, port=port,
-                username=user, pkey=pkey, banner_timeout=10)
+        client.connect(hostname=host, port=port_number,
+                username=user, pkey=pkey, banner_timeout=10, sock=sock)
+    return client
+
+
+def exec_on_client(client, command, timeout=120, bufsize=-1):
+    # type: (paramiko.SSHClient, str, int, int) -> Result
+    """
+    Executes a command on a new channel of an already connected client.
+    :param client: Connected paramiko.SSHClient
+    :param command: The command to run
+    :param timeout: Timeout for the channel operations
+    :return: Result object with the output and the return code
+    """
     chan = client.get_transport().open_session()
     chan.settimeout(timeout)
     chan.set_combine_stderr(True)
@@ -161,16 +360,151 @@ def run(host='127.0.0.1', port='22', user='root',
     stderr_text = stderr.read()
     out = Result(stdout_text)
     status = int(chan.recv_exit_status())
-    client.close()
     out.return_code = status
     return out
 
 
-def clean_tmp_dirs(dirs):
-    # type: (List[str]) -> None
-    "Removes the temporary directories"
+# Window and packet sizes of the SFTP channels
+SFTP_WINDOW = 64 * 1024 * 1024
+SFTP_PACKET = 32768
+
+
+def parse_jump(text: str, user: str) -> Tuple[str, int, str]:
+    """
+    Parses a proxy_jump value like [user@]bastion[:port].
+
+    :param text: The proxy_jump value.
+    :param user: The user of the vm, when the value does not have one.
+    :return: (host, port, user)
+    """
+    if ',' in text:
+        raise ValueError("Only one jump host is supported: {0}".format(text))
+    login, _, address = text.strip().rpartition('@')
+    host, _, port = address.partition(':')
+    return host, int(port or 22), login or user
+
+
+class SSHPool(object):
+    """
+    Keeps one authenticated SSH connection for each (host, port, user), so
+    that many commands can run on separate channels of the same transport.
+    The vm(s) behind a bastion (proxy_jump) connect over direct-tcpip
+    channels of one connection to the bastion.
+    """
+    def __init__(self) -> None:
+        self.clients = {}  # type: Dict[Tuple[Any, ...], paramiko.SSHClient]
+        self.jumps = {}  # type: Dict[Tuple[Any, ...], paramiko.SSHClient]
+        self.locks = {}  # type: Dict[Tuple[Any, ...], threading.Lock]
+        self.jump_locks = {}  # type: Dict[Tuple[Any, ...], threading.Lock]
+        self.lock = threading.Lock()
+
+    def key(self, config: Dict[str, Any]) -> Tuple[str, int, str, str]:
+        # The same private address can be behind two bastions
+        return config['host_string'], int(config.get('port', '22')), config['user'], config.get('proxy_jump') or ''
+
+    def cached(self, clients: Dict[Tuple[Any, ...], paramiko.SSHClient],
+               locks: Dict[Tuple[Any, ...], threading.Lock], key: Tuple[Any, ...],
+               opener: Callable[[], paramiko.SSHClient]) -> paramiko.SSHClient:
+        "Returns the live client of the key, or opens a new one, one opener at a time for each key"
+        with self.lock:
+            key_lock = locks.setdefault(key, threading.Lock())
+        with key_lock:
+            client = clients.get(key)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+                client.close()
+            client = opener()
+            clients[key] = client
+            return client
+
+    def client(self, config: Dict[str, Any]) -> paramiko.SSHClient:
+        """
+        Returns a connected client for the given vm configuration, opens a
+        new connection if we do not have a live one.
+        """
+        return self.cached(self.clients, self.locks, self.key(config), lambda: connect(
+            config['host_string'], config.get('port', '22'), config['user'], config.get('password', None),
+            key_filename=config.get('key', None), pkey=config.get('pkey', None), sock=self.sock(config)))
+
+    def jump(self, config: Dict[str, Any]) -> paramiko.SSHClient:
+        """
+        Returns the connection to the bastion of the vm, the same one for
+        all the vm(s) behind it. We login with the proxy_key, or with the
+        key of the vm.
+        """
+        host, port, user = parse_jump(config['proxy_jump'], config['user'])
+        if config.get('proxy_key'):
+            key_filename, pkey = config['proxy_key'], None
+        else:
+            key_filename, pkey = config.get('key', None), config.get('pkey', None)
+        return self.cached(self.jumps, self.jump_locks, (host, port, user),
+                           lambda: connect(host, str(port), user, key_filename=key_filename, pkey=pkey))
+
+    def sock(self, config: Dict[str, Any]) -> paramiko.Channel:
+        "A direct-tcpip channel through the bastion to the ssh port of the vm, None without a proxy_jump"
+        if not config.get('proxy_jump'):
+            return None
+        return self.jump(config).get_transport().open_channel(
+            'direct-tcpip', (config['host_string'], int(config.get('port', '22'))), ('127.0.0.1', 0))
+
+    def run(self, config: Dict[str, Any], command: str, timeout: int=None) -> Result:
+        "Runs the command on a new channel of the pooled connection"
+        if timeout is None:
+            timeout = config.get('timeout', 600)
+        return exec_on_client(self.client(config), command, timeout)
+
+    def sftp(self, config: Dict[str, Any]) -> paramiko.SFTPClient:
+        "Opens a SFTP session on the pooled connection, with a large window for the transfers"
+        return paramiko.SFTPClient.from_transport(self.client(config).get_transport(),
+                                                  window_size=SFTP_WINDOW, max_packet_size=SFTP_PACKET)
+
+    def drop(self, config: Dict[str, Any]) -> None:
+        "Closes the connection for the given vm, for example after a reboot"
+        client = self.clients.pop(self.key(config), None)
+        if client is not None:
+            client.close()
+
+    def close_all(self) -> None:
+        "Closes all the pooled connections, and then the bastion connections"
+        for client in list(self.clients.values()) + list(self.jumps.values()):
+            client.close()
+        self.clients = {}
+        self.jumps = {}
+
+
+POOL = SSHPool()
+
+
+def run(host='127.0.0.1', port='22', user='root',
+                  password=None, command='/bin/true', bufsize=-1, key_filename='',
+                  timeout=120, pkey=None, debug=False, sock=None):
+    # type(str, str, str, str, str, int, str, int, Any, bool, Any) -> T_Result
+    """
+    Excecutes a command using paramiko and returns the result.
+    :param host: Host to connect
+    :param port: The port number
+    :param user: The username of the system
+    :param password: User password
+    :param command: The command to run
+    :param key_filename: SSH private key file.
+    :param pkey: RSAKey if we want to login with a in-memory key
+    :param debug: Boolean to print debug messages
+    :param sock: Channel to the host through a bastion, from SSHPool.sock
+    :return:
+    """
+    client = connect(host, port, user, password, key_filename, pkey, debug, sock)
+    out = exec_on_client(client, command, timeout, bufsize)
+    client.close()
+    return out
+
+
+def clean_tmp_dirs(dirs, prefixes=('/tmp',)):
+    # type: (List[str], Tuple[str, ...]) -> None
+    "Removes the temporary directories, only under the given prefixes"
     for path in dirs:
-        if os.path.exists(path) and path.startswith('/tmp'):
+        if os.path.exists(path) and path.startswith(tuple(prefixes)):
             shutil.rmtree(path)
 
 
@@ -203,41 +537,994 @@ def try_again(func):
     return cast(T_Callable, wrapper)
 
 
-@try_again
-def execute(config: Dict[str, str], command: str, container: bool=False) -> Tuple[Result, str]:
+COMMAND_STATUS = {
+    'gating': 'no',
+    'expect_failure': 'yes',
+    'non_gating': 'dontcare',
+}  # type: Dict[str, str]
+
+
+def parse_command(command: str) -> Tuple[str, str]:
     """
-    Executes a given command based on the system.
-    :param config: Configuration dictionary.
-    :param command: The command to execute
-    :return: (Output text, string)
+    Finds the type of a job command from its prefix.
+    :param command: The command from the job file
+    :return: (command type, command without the prefix)
     """
-    result = None
     command_type = 'gating'
-    command_status = {
-        'gating': 'no',
-        'expect_failure': 'yes',
-        'non_gating': 'dontcare',
-    }
-
     if command.startswith('@@'):
         command_type = 'expect_failure'
         command = command[3:].strip()
     elif command.startswith('##'):
         command_type = 'non_gating'
         command = command[3:].strip()
+    return command_type, command
+
+
+@try_again
+def execute(config: Dict[str, str], command: str, container: bool=False) -> Tuple[Result, str]:
+    """
+    Executes a given command based on the system.
+    :param config: Configuration dictionary.
+    :param command: The command to execute
+    :return: (Output text, string)
+    """
+    result = None
+    command_type, command = parse_command(command)
 
     result = run(config['host_string'], config.get('port', '22'), config['user'],
                      config.get('password', None), command, key_filename=config.get('key', None),
-                     timeout=config.get('timeout', 600), pkey=config.get('pkey', None))
+                     timeout=config.get('timeout', 600), pkey=config.get('pkey', None), sock=POOL.sock(config))
 
-    negative = command_status[command_type]
-    if result.return_code != 0 and command_type is 'expect_failure':  # If the command does not fail, then it is a failure.
+    negative = COMMAND_STATUS[command_type]
+    if result.return_code != 0 and command_type == 'expect_failure':  # If the command does not fail, then it is a failure.
         negative = 'yes'
 
     return result, negative
 
 
-def update_result(result: Result, command: str, negative: str) -> bool:
+def execute_nongating(config: Dict[str, Any], command: str) -> Tuple[Result, str]:
+    """
+    Executes a non gating command on a new channel of the pooled connection.
+    Any error becomes a failed result, as it can not change the job status.
+
+    :param config: Configuration dictionary.
+    :param command: The command to execute (with the ## prefix)
+    :return: (Output text, string)
+    """
+    command_type, command = parse_command(command)
+    try:
+        result = POOL.run(config, command)
+    except Exception as err:
+        log.error(str(err))
+        result = Result(str(err))
+        result.return_code = -1
+    return result, COMMAND_STATUS[command_type]
+
+
+def create_batch_script(commands: List[str], marker: str) -> str:
+    """
+    Creates one shell script out of many job commands. After every command
+    we print the marker with the index and the return code, and the script
+    stops at the first gating failure like run_job does.
+
+    :param commands: List of job commands (with @@ or ## prefix if any).
+    :param marker: Unique text to mark the end of each command.
+    :return: The shell script as text.
+    """
+    lines = [] # type: List[str]
+    for index, command in enumerate(commands):
+        command_type, shell_command = parse_command(command)
+        lines.append("( {0}\n)".format(shell_command.strip() or ':'))
+        lines.append("__tunir_rc=$?; printf '\\n{0} %d %d\\n' {1} $__tunir_rc".format(marker, index))
+        if command_type == 'gating':
+            lines.append('[ $__tunir_rc -eq 0 ] || exit 0')
+    return '\n'.join(lines) + '\n'
+
+
+def split_batch_output(text: str, marker: str) -> List[Tuple[int, str, int]]:
+    """
+    Splits the output of a batch script back into per command output.
+
+    :param text: Combined output of the batch script
+    :param marker: The marker used in create_batch_script
+    :return: List of (index, output, return code) for each finished command
+    """
+    parts = re.split(r'\r?\n{0} (\d+) (-?\d+)\r?\n'.format(re.escape(marker)), text)
+    values = [] # type: List[Tuple[int, str, int]]
+    for i in range(1, len(parts) - 1, 3):
+        values.append((int(parts[i]), parts[i - 1], int(parts[i + 1])))
+    return values
+
+
+def execute_batch(config: Dict[str, str], commands: List[str]) -> List[Tuple[Result, str]]:
+    """
+    Executes many commands on the same system using a single SSH exec.
+    We do not try again on an ssh error, the commands may have run already.
+    :param config: Configuration dictionary.
+    :param commands: The commands to execute
+    :return: List of (Output text, string) for the commands till the first gating failure
+    """
+    marker = '__TUNIR_{0}'.format(uuid.uuid4().hex)
+    script = create_batch_script(commands, marker)
+    batch = run(config['host_string'], config.get('port', '22'), config['user'],
+                config.get('password', None), 'sh -c {0}'.format(shlex.quote(script)),
+                key_filename=config.get('key', None), timeout=config.get('timeout', 600),
+                pkey=config.get('pkey', None), sock=POOL.sock(config))
+
+    finished = {index: (text, return_code) for index, text, return_code in split_batch_output(batch.text, marker)}
+    values = [] # type: List[Tuple[Result, str]]
+    for index, command in enumerate(commands):
+        command_type, _ = parse_command(command)
+        if index not in finished:
+            # The script stopped early, like for a syntax error, a reboot or a lost connection
+            if marker in batch.text:
+                tail = batch.text.rpartition(marker)[2].partition('\n')[2]
+            else:
+                tail = batch.text
+            result = Result("The batch stopped before this command finished.\n{0}".format(tail))
+            result.return_code = -1
+            values.append((result, COMMAND_STATUS['gating']))
+            break
+        text, return_code = finished[index]
+        result = Result(text)
+        result.return_code = return_code
+        values.append((result, COMMAND_STATUS[command_type]))
+        if command_type == 'gating' and return_code != 0:
+            break
+    return values
+
+
+def backoff(initial: float=1.0, maximum: float=30.0, factor: float=2.0) -> Iterator[float]:
+    """
+    Yields sleep times growing exponentially up to maximum, with some jitter
+    so that many waiters do not hit a vm at the same time.
+    """
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * factor, maximum)
+
+
+def parse_waitfor(command: str) -> Tuple[str, str, str, int]:
+    """
+    Parses the WAITFOR and WAITUNTIL directives.
+
+        WAITFOR vm1 journalctl -f /Started nginx/ timeout=120
+        WAITUNTIL vm1 curl -s localhost:80 timeout=120
+
+    :param command: The directive from the job file.
+    :return: (vm name, command, pattern, timeout), pattern is empty for WAITUNTIL.
+    """
+    timeout = 300
+    pattern = ''
+    match = re.search(r'\s+timeout=(\d+)\s*$', command)
+    if match:
+        timeout = int(match.group(1))
+        command = command[:match.start()]
+    words = command.strip().split(' ', 2)
+    if len(words) < 3:
+        raise ValueError("Wrong directive: {0}".format(command))
+    directive, vm_name, shell_command = words
+    if directive == 'WAITFOR':
+        # The pattern starts after the last " /", the command may have paths in it
+        index = shell_command.rfind(' /')
+        if index == -1 or not shell_command.endswith('/') or len(shell_command) < index + 3:
+            raise ValueError("Missing /pattern/ in {0}".format(command))
+        pattern = shell_command[index + 2:-1]
+        shell_command = shell_command[:index]
+    return vm_name, shell_command.strip(), pattern, timeout
+
+
+def wait_for_pattern(config: Dict[str, Any], command: str, pattern: str, timeout: int) -> Result:
+    """
+    Streams the output of a command (like journalctl -f) and returns as soon as
+    the pattern matches, the command gets closed after that.
+
+    :param config: Configuration dictionary of the vm.
+    :param command: The command to stream the output from.
+    :param pattern: Regular expression to look for.
+    :param timeout: Maximum seconds to wait.
+    :return: Result object, return_code is 0 if the pattern matched.
+    """
+    regex = re.compile(pattern)
+    deadline = time.time() + timeout
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    text = ''
+    result = None # type: Result
+    chan = POOL.client(config).get_transport().open_session()
+    try:
+        chan.set_combine_stderr(True)
+        chan.get_pty()
+        chan.exec_command(command)
+        while time.time() < deadline:
+            chan.settimeout(max(deadline - time.time(), 0.1))
+            try:
+                data = chan.recv(32768)
+            except socket.timeout:
+                break
+            if not data: # The command exited
+                break
+            text += decoder.decode(data)
+            match = regex.search(text)
+            if match:
+                result = Result("Matched: {0}".format(match.group(0)))
+                result.return_code = 0
+                return result
+            text = text[-65536:] # We only need the latest output
+    finally:
+        chan.close()
+    result = Result("Pattern /{0}/ not found in {1} seconds.\n{2}".format(pattern, timeout, text[-4096:]))
+    result.return_code = 1
+    return result
+
+
+def wait_until(config: Dict[str, Any], command: str, timeout: int) -> Result:
+    """
+    Runs a probe command again and again with backoff till it passes.
+
+    :param config: Configuration dictionary of the vm.
+    :param command: The probe command.
+    :param timeout: Maximum seconds to wait.
+    :return: Result object of the last try.
+    """
+    deadline = time.time() + timeout
+    result = Result("Never ran: {0}".format(command))
+    result.return_code = -1
+    for delay in backoff():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            result = POOL.run(config, command, timeout=max(int(remaining), 1))
+            if result.return_code == 0:
+                break
+        except Exception as err: # The vm may not be ready for ssh yet
+            POOL.drop(config)
+            result = Result(str(err))
+            result.return_code = -1
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+    return result
+
+
+def wait_directive(command: str, config: TunirConfig) -> Tuple[Result, float]:
+    """
+    Executes a WAITFOR or WAITUNTIL directive.
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (Result, seconds we waited)
+    """
+    vm_name, shell_command, pattern, timeout = parse_waitfor(command)
+    start = time.time()
+    if command.startswith('WAITFOR'):
+        result = wait_for_pattern(config.vms[vm_name], shell_command, pattern, timeout)
+    else:
+        result = wait_until(config.vms[vm_name], shell_command, timeout)
+    duration = time.time() - start
+    print("Waited for {0:.2f} seconds.".format(duration))
+    return result, duration
+
+
+def expand_targets(text: str, config: TunirConfig) -> List[str]:
+    """
+    Finds the vm names from a target like vm1,vm3 or vm[1-32] or all, or
+    a group name from the groups section of the configuration.
+
+    :param text: The target text from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: List of vm names.
+    """
+    names = [] # type: List[str]
+    for item in text.split(','):
+        if not item:
+            continue
+        if item == 'all':
+            values = list(config.vms.keys())
+        elif item in config.groups:
+            values = expand_targets(config.groups[item], config)
+        else:
+            values = expand_range(item) or [item]
+        for name in values:
+            if name not in config.vms:
+                raise ValueError("Unknown vm {0}".format(name))
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def is_target(text: str, config: TunirConfig) -> bool:
+    "Finds if the first word of a job command names vm(s)"
+    for item in text.split(','):
+        if not (item == 'all' or item in config.vms or item in config.groups or
+                re.search(r'^vm[0-9]+$', item) or expand_range(item)):
+            return False
+    return True
+
+
+def default_vm(config: TunirConfig) -> str:
+    "Commands without a vm name run on vm1, or on the first vm"
+    if 'vm1' in config.vms:
+        return 'vm1'
+    return next(iter(config.vms))
+
+
+BOOT_ID = 'cat /proc/sys/kernel/random/boot_id'
+
+
+def reboot_vm(config: Dict[str, Any], timeout: int) -> Tuple[bool, float]:
+    """
+    Reboots a vm, and waits till ssh answers with a new boot_id.
+
+    :param config: Configuration dictionary of the vm.
+    :param timeout: Maximum seconds to wait for the vm to come back.
+    :return: (True if the vm came back, seconds taken)
+    """
+    old_id = POOL.run(config, BOOT_ID, timeout=60).text.strip()
+    start = time.time()
+    chan = POOL.client(config).get_transport().open_session()
+    chan.get_pty()
+    chan.exec_command('sudo systemctl reboot || sudo reboot')
+    # Give the command a moment before we drop the connection
+    wait_till = start + 10
+    while time.time() < wait_till and not chan.exit_status_ready() and not chan.closed:
+        time.sleep(0.2)
+    POOL.drop(config)
+
+    deadline = start + timeout
+    for delay in backoff():
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        if time.time() >= deadline:
+            break
+        if not vm_banner_ready(config):
+            continue
+        try:
+            boot_id = POOL.run(config, BOOT_ID, timeout=30).text.strip()
+            if boot_id and boot_id != old_id:
+                return True, time.time() - start
+        except Exception: # Still rebooting
+            POOL.drop(config)
+    return False, time.time() - start
+
+
+def reboot_directive(command: str, config: TunirConfig) -> Tuple[Result, float]:
+    """
+    Executes a REBOOT directive, all the given vm(s) reboot at the same time.
+
+        REBOOT vm1,vm2 timeout=600
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (Result, seconds taken by the slowest vm)
+    """
+    timeout = 600
+    match = re.search(r'\s+timeout=(\d+)\s*$', command)
+    if match:
+        timeout = int(match.group(1))
+        command = command[:match.start()]
+    words = command.split()
+    names = expand_targets(words[1], config) if len(words) > 1 else [default_vm(config)]
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = [executor.submit(reboot_vm, config.vms[name], timeout) for name in names]
+        values = [future.result() for future in futures]
+    lines = [] # type: List[str]
+    return_code = 0
+    for name, (done, seconds) in zip(names, values):
+        if done:
+            lines.append("{0} rebooted in {1:.2f} seconds.".format(name, seconds))
+        else:
+            lines.append("{0} did not come back in {1} seconds.".format(name, timeout))
+            return_code = 1
+    result = Result('\n'.join(lines))
+    result.return_code = return_code
+    print(result.text)
+    return result, time.time() - start
+
+
+def snapshot_directive(command: str, config: TunirConfig) -> Tuple[Result, float]:
+    """
+    Executes a SNAPSHOT directive, takes an internal snapshot of the disk
+    of the running vm(s) over QMP.
+
+        SNAPSHOT vm1,vm2 before-upgrade
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (Result, seconds taken)
+    """
+    words = command.split()
+    if len(words) != 3:
+        raise ValueError("Wrong directive: {0}".format(command))
+    start = time.time()
+    lines = [] # type: List[str]
+    for name in expand_targets(words[1], config):
+        vm = config.vms[name]
+        if not vm.get('qmp'):
+            raise ValueError("{0} does not have a QMP socket".format(name))
+        client = QMPClient(vm['qmp']).connect(tries=1)
+        try:
+            client.snapshot(words[2], vm.get('disk', 'virtio0'))
+            lines.append("{0}: snapshot {1} taken, vm is {2}.".format(name, words[2], client.query_status()))
+        finally:
+            client.close()
+    result = Result('\n'.join(lines))
+    result.return_code = 0
+    return result, time.time() - start
+
+
+def ansible_directive(command: str, config: TunirConfig) -> Tuple[Result, float]:
+    """
+    Executes an ANSIBLE directive, runs ansible-playbook on the host with
+    the ansible.cfg of the job, from the directory where we copied the
+    ansible_dir. The rest of the line goes to ansible-playbook.
+
+        ANSIBLE site.yml --tags setup
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (Result, seconds taken by the playbook)
+    """
+    words = shlex.split(command)
+    path = config.general.get('ansible_config', '')
+    if len(words) < 2:
+        raise ValueError("Wrong directive: {0}".format(command))
+    if not path:
+        raise ValueError("{0} needs an ansible_dir in the general section".format(words[0]))
+    start = time.time()
+    try:
+        process = subprocess.run(['ansible-playbook'] + words[1:], cwd=os.path.dirname(path),
+                                 env=dict(os.environ, ANSIBLE_CONFIG=path), stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, universal_newlines=True)
+    except OSError as err: # No ansible on the host
+        result = Result("ansible-playbook failed: {0}".format(err))
+        result.return_code = 127
+        return result, time.time() - start
+    seconds = time.time() - start
+    result = Result("{0}\nPlaybook {1} took {2:.2f} seconds.".format(process.stdout.rstrip('\n'), words[1], seconds))
+    result.return_code = process.returncode
+    return result, seconds
+
+
+BENCH_OPTIONS = ('runs', 'warmup', 'max', 'min', 'metric', 'tolerance', 'better')
+
+
+def parse_bench(command: str) -> Tuple[str, Dict[str, str], str]:
+    """
+    Parses the BENCH directive, the options come before the command.
+
+        BENCH vm1 runs=10 warmup=2 max=0.5 dd if=/dev/zero of=/tmp/a bs=1M count=100
+        BENCH vm1 runs=5 metric=([0-9.]+)MB/s min=500 ./disk-test
+        BENCH vm1 metric=([0-9.]+)MB/s better=higher ./disk-test
+        BENCH vm1,vm2 runs=10 ./startup-test
+
+    better is lower (the default, like seconds) or higher (like a
+    throughput), it is higher when only min is given.
+
+    :param command: The directive from the job file.
+    :return: (vm name(s), options, command)
+    """
+    words = command.strip().split(' ')
+    if len(words) < 3:
+        raise ValueError("Wrong directive: {0}".format(command))
+    options = {'runs': '5', 'warmup': '1', 'tolerance': '10'} # type: Dict[str, str]
+    index = 2
+    while index < len(words):
+        key, _, value = words[index].partition('=')
+        if key not in BENCH_OPTIONS or not value:
+            break
+        options[key] = value
+        index += 1
+    shell_command = ' '.join(words[index:]).strip()
+    if not shell_command:
+        raise ValueError("Missing command in {0}".format(command))
+    if 'better' not in options:
+        options['better'] = 'higher' if 'min' in options and 'max' not in options else 'lower'
+    if not (options['runs'].isdigit() and int(options['runs']) >= 1 and options['warmup'].isdigit()):
+        raise ValueError("BENCH needs runs of 1 or more and warmup of 0 or more: {0}".format(command))
+    if options['better'] not in ('lower', 'higher'):
+        raise ValueError("better is lower or higher: {0}".format(command))
+    return words[1], options, shell_command
+
+
+def bench_stats(values: List[float]) -> Dict[str, float]:
+    "min, median, p95 (nearest rank) and stddev of the measured values"
+    ordered = sorted(values)
+    rank = max(int(-(-95 * len(ordered) // 100)), 1) # ceil(0.95 * n)
+    return {'min': ordered[0], 'median': statistics.median(ordered), 'p95': ordered[rank - 1],
+            'stddev': statistics.stdev(ordered) if len(ordered) > 1 else 0.0}
+
+
+def bench_baseline(path: str, key: str, median: float=None) -> float:
+    """
+    Reads (and with a median, records) the baseline median of a BENCH step
+    from a JSON file.
+
+    :param path: Path of the baseline file.
+    :param key: The BENCH directive.
+    :param median: New median to record if we did not have one.
+    :return: The stored median, None if we did not have one.
+    """
+    data = {} # type: Dict[str, float]
+    if os.path.exists(path):
+        with open(path) as fobj:
+            data = json.load(fobj)
+    if key not in data and median is not None:
+        data[key] = median
+        with open(path, 'w') as fobj:
+            json.dump(data, fobj, indent=2)
+        return None
+    return data.get(key)
+
+
+# Two sided 95% t values for 1 to 30 degrees of freedom, we use 1.96 after that
+T95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+       2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+       2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+
+
+def mean_difference(first: List[float], second: List[float]) -> Tuple[float, float, float]:
+    """
+    Difference of the means of two samples (second - first), with the 95%
+    confidence interval from Welch's t-test.
+
+    :return: (difference, low, high)
+    """
+    diff = statistics.mean(second) - statistics.mean(first)
+    if len(first) < 2 or len(second) < 2:
+        return diff, diff, diff
+    var_a = statistics.variance(first) / len(first)
+    var_b = statistics.variance(second) / len(second)
+    error = (var_a + var_b) ** 0.5
+    if not error:
+        return diff, diff, diff
+    freedom = (var_a + var_b) ** 2 / (var_a ** 2 / (len(first) - 1) + var_b ** 2 / (len(second) - 1))
+    freedom = max(int(freedom + 1e-9), 1) # Round down, but not 5.999999 to 5
+    tvalue = T95[freedom - 1] if freedom <= len(T95) else 1.96
+    return diff, diff - tvalue * error, diff + tvalue * error
+
+
+def bench_directive(command: str, config: TunirConfig) -> Tuple[Result, float]:
+    """
+    Executes a BENCH directive, runs the command again and again on the
+    pooled connection, and times each run on the host. With a metric, the
+    first group of the regular expression on the output is the value.
+    The step fails if a run fails, if the median is over max (or under
+    min), or if it is over the stored baseline (bench_baseline in the
+    general section) by more than tolerance percent.
+
+    With many vm(s) the runs are interleaved, one run on each vm in turn
+    (in the reverse order every other round), so the noise of the host
+    hits all of them alike. For two vm(s) we also give the difference.
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (Result, seconds taken)
+    """
+    target, options, shell_command = parse_bench(command)
+    names = expand_targets(target, config)
+    runs = int(options['runs'])
+    warmup = int(options['warmup'])
+    metric = re.compile(options['metric']) if 'metric' in options else None
+    start = time.time()
+    values = OrderedDict((name, []) for name in names) # type: Dict[str, List[float]]
+    for index in range(warmup + runs):
+        for name in (names if index % 2 == 0 else reversed(names)):
+            begin = time.perf_counter()
+            result = POOL.run(config.vms[name], shell_command)
+            seconds = time.perf_counter() - begin
+            if result.return_code != 0:
+                result.text = "BENCH run {0} failed on {1}:\n{2}".format(index + 1, name, result.text)
+                return result, time.time() - start
+            if index < warmup:
+                continue
+            if metric:
+                match = metric.search(result.text)
+                if not match:
+                    result = Result("Missing metric {0} in the output:\n{1}".format(options['metric'], result.text))
+                    result.return_code = 1
+                    return result, time.time() - start
+                values[name].append(float(match.group(1)))
+            else:
+                values[name].append(seconds)
+
+    unit = 'metric' if metric else 'seconds'
+    lines = ["runs: {0} warmup: {1}".format(runs, warmup)]
+    return_code = 0
+    medians = {} # type: Dict[str, float]
+    for name, measured in values.items():
+        stats = bench_stats(measured)
+        medians[name] = stats['median']
+        prefix = '{0}: '.format(name) if len(names) > 1 else ''
+        lines.append(prefix + "min {min:.4f} median {median:.4f} p95 {p95:.4f} stddev {stddev:.4f}".format(**stats) +
+                     " ({0})".format(unit))
+        if 'max' in options and stats['median'] > float(options['max']):
+            lines.append(prefix + "median is over the max {0}".format(options['max']))
+            return_code = 1
+        if 'min' in options and stats['median'] < float(options['min']):
+            lines.append(prefix + "median is under the min {0}".format(options['min']))
+            return_code = 1
+        if config.general.get('bench_baseline'):
+            key = command if len(names) == 1 else '{0} [{1}]'.format(command, name)
+            baseline = bench_baseline(config.general['bench_baseline'], key, stats['median'])
+            if baseline is None:
+                lines.append(prefix + "recorded as the baseline")
+            else:
+                tolerance = float(options['tolerance']) / 100
+                if options['better'] == 'higher':
+                    limit = baseline * (1 - tolerance)
+                    worse = stats['median'] < limit
+                else:
+                    limit = baseline * (1 + tolerance)
+                    worse = stats['median'] > limit
+                lines.append(prefix + "baseline median {0:.4f}, limit {1:.4f} ({2} is better)".format(
+                    baseline, limit, options['better']))
+                if worse:
+                    lines.append(prefix + "median is {0} the baseline".format(
+                        'under' if options['better'] == 'higher' else 'over'))
+                    return_code = 1
+    if len(names) == 2:
+        first, second = names
+        diff, low, high = mean_difference(values[first], values[second])
+        percent = (medians[second] - medians[first]) * 100 / medians[first] if medians[first] else 0.0
+        lines.append("delta {0} - {1}: mean {2:+.4f} (95% CI {3:+.4f} .. {4:+.4f}), median {5:+.2f}%".format(
+            second, first, diff, low, high, percent))
+    result = Result('\n'.join(lines))
+    result.return_code = return_code
+    print(result.text)
+    return result, time.time() - start
+
+
+def parse_transfer(command: str, config: TunirConfig) -> Tuple[List[str], str, str]:
+    """
+    Parses the PUT and GET directives.
+
+        PUT tests.tar.gz vm1:/tmp/
+        PUT run.sh all:run.sh
+        GET vm1,vm2:/var/log/messages ./logs/
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (vm names, local path, remote path)
+    """
+    words = command.split()
+    index = TRANSFER_DIRECTIVES.get(words[0], 0)
+    if len(words) != 3 or ':' not in words[index]:
+        raise ValueError("Wrong directive: {0}".format(command))
+    target, _, remote = words[index].partition(':')
+    local = words[3 - index]
+    if not remote:
+        raise ValueError("Missing remote path in {0}".format(command))
+    return expand_targets(target, config), local, remote
+
+
+def transfer_text(name: str, size: int, seconds: float) -> str:
+    "A line with the throughput of one transfer"
+    rate = size / seconds / (1024 * 1024) if seconds else 0.0
+    return "{0}: {1} bytes in {2:.2f} seconds ({3:.1f} MB/s)".format(name, size, seconds, rate)
+
+
+def put_file(config: Dict[str, Any], local: str, remote: str) -> Tuple[int, float]:
+    """
+    Uploads a file to a vm over SFTP, keeps the permissions of the file.
+
+    :param config: Configuration dictionary of the vm.
+    :param local: Path of the local file.
+    :param remote: Remote path, a path ending with / is a directory.
+    :return: (bytes, seconds)
+    """
+    if remote.endswith('/'):
+        remote += os.path.basename(local)
+    start = time.perf_counter()
+    sftp = POOL.sftp(config)
+    try:
+        sftp.put(local, remote) # The writes are pipelined
+        sftp.chmod(remote, os.stat(local).st_mode & 0o7777)
+    finally:
+        sftp.close()
+    return os.path.getsize(local), time.perf_counter() - start
+
+
+def get_file(config: Dict[str, Any], remote: str, local: str) -> Tuple[int, float]:
+    """
+    Downloads a file from a vm over SFTP.
+
+    :param config: Configuration dictionary of the vm.
+    :param remote: Remote path.
+    :param local: Local path, an existing directory or a path ending with / is a directory.
+    :return: (bytes, seconds)
+    """
+    if local.endswith('/') or os.path.isdir(local):
+        os.makedirs(local, exist_ok=True)
+        local = os.path.join(local, os.path.basename(remote))
+    start = time.perf_counter()
+    sftp = POOL.sftp(config)
+    try:
+        sftp.get(remote, local) # The reads are prefetched
+    finally:
+        sftp.close()
+    return os.path.getsize(local), time.perf_counter() - start
+
+
+def transfer_directive(command: str, config: TunirConfig) -> Tuple[Result, float]:
+    """
+    Executes a PUT or GET directive over SFTP on the pooled connections.
+    With many vm(s), all of them transfer at the same time (at most fanout
+    at once). A GET from many vm(s) goes into a directory for each vm.
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (Result, seconds taken)
+    """
+    names, local, remote = parse_transfer(command, config)
+    upload = command.startswith('PUT')
+    if upload and not os.path.isfile(local):
+        raise ValueError("Missing local file {0}".format(local))
+
+    def transfer_one(name: str) -> Tuple[int, float]:
+        if upload:
+            return put_file(config.vms[name], local, remote)
+        if len(names) > 1:
+            return get_file(config.vms[name], remote, os.path.join(local, name) + '/')
+        return get_file(config.vms[name], remote, local)
+
+    start = time.time()
+    lines = [] # type: List[str]
+    return_code = 0
+    total = 0
+    workers = int(config.general.get('fanout', 16) or 16)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(names))) as executor:
+        futures = [(name, executor.submit(transfer_one, name)) for name in names]
+        for name, future in futures:
+            try:
+                size, seconds = future.result()
+            except (IOError, OSError, paramiko.SSHException) as err:
+                lines.append("{0}: {1}".format(name, err))
+                return_code = 1
+                continue
+            total += size
+            lines.append(transfer_text(name, size, seconds))
+    duration = time.time() - start
+    if len(names) > 1:
+        lines.append(transfer_text('total', total, duration))
+    result = Result('\n'.join(lines))
+    result.return_code = return_code
+    print(result.text)
+    return result, duration
+
+
+# SFTP sessions for each vm in a SYNC
+SYNC_WORKERS = 4
+# sha256 of the local files, by (path, size, mtime)
+LOCAL_HASHES = {} # type: Dict[Tuple[str, int, float], str]
+# (size, mtime, sha256) of the remote files we hashed or copied, by (host, port, user, directory)
+REMOTE_HASHES = {} # type: Dict[Tuple[Any, ...], Dict[str, Tuple[int, float, str]]]
+
+
+def local_manifest(path: str) -> Dict[str, Tuple[str, int, float]]:
+    """
+    sha256, mode and mtime of each file under a local directory, we only
+    hash a file again when its size or mtime changes.
+
+    :param path: The directory.
+    :return: Dictionary of the relative paths (with /) to (sha256, mode, mtime).
+    """
+    result = {} # type: Dict[str, Tuple[str, int, float]]
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filepath = os.path.join(root, name)
+            stat = os.stat(filepath)
+            key = (filepath, stat.st_size, stat.st_mtime)
+            if key not in LOCAL_HASHES:
+                digest = hashlib.sha256()
+                with open(filepath, 'rb') as fobj:
+                    for block in iter(lambda: fobj.read(1024 * 1024), b''):
+                        digest.update(block)
+                LOCAL_HASHES[key] = digest.hexdigest()
+            relpath = os.path.relpath(filepath, path).replace(os.sep, '/')
+            result[relpath] = (LOCAL_HASHES[key], stat.st_mode & 0o7777, stat.st_mtime)
+    return result
+
+
+def remote_manifest(config: Dict[str, Any], path: str) -> Dict[str, str]:
+    """
+    sha256 of each file under a directory of the vm. We list the size and
+    mtime of the files first, and only hash on the vm the files which we
+    did not hash or copy before with the same size and mtime. Creates the
+    directory if needed.
+
+    :param config: Configuration dictionary of the vm.
+    :param path: The remote directory.
+    :return: Dictionary of the relative paths to sha256.
+    """
+    known = REMOTE_HASHES.setdefault(POOL.key(config) + (path,), {})
+    quoted = shlex.quote(path)
+    # The names may have any character, and the pty changes the newlines,
+    # so the list comes NUL separated in base64.
+    result = POOL.run(config, "mkdir -p {0} && cd {0} && find . -type f -printf '%s %T@ %P\\0' | base64".format(
+        quoted))
+    if result.return_code != 0:
+        raise IOError("Can not read {0}: {1}".format(path, result.text.strip()))
+    manifest = {} # type: Dict[str, str]
+    files = {} # type: Dict[str, Tuple[int, float]]
+    try:
+        listing = base64.b64decode(''.join(result.text.split())).decode('utf-8', 'surrogateescape')
+    except ValueError as err:
+        raise IOError("Can not read {0}: {1}".format(path, err))
+    for entry in listing.split('\0'):
+        words = entry.split(' ', 2)
+        if len(words) == 3:
+            files[words[2]] = (int(words[0]), float(words[1]))
+    missing = [] # type: List[str]
+    for name, (size, mtime) in files.items():
+        value = known.get(name)
+        if value and value[0] == size and abs(value[1] - mtime) < 1e-6:
+            manifest[name] = value[2]
+        else:
+            missing.append(name)
+    for index in range(0, len(missing), 200):
+        chunk = missing[index:index + 200]
+        # One line for each name in the same order, sha256sum escapes some names in its output
+        names = ' '.join(shlex.quote(name) for name in chunk)
+        result = POOL.run(config, 'cd {0} && for name in {1}; do (sha256sum < "$name" || echo -) 2>/dev/null; '
+                                  'done'.format(quoted, names))
+        lines = result.text.splitlines()
+        if len(lines) != len(chunk):
+            raise IOError("Can not hash the files in {0}: {1}".format(path, result.text.strip()))
+        for name, line in zip(chunk, lines):
+            digest = line.split(' ')[0]
+            if digest != '-': # Removed since we listed it
+                manifest[name] = digest
+                known[name] = files[name] + (digest,)
+    return manifest
+
+
+def sync_vm(config: Dict[str, Any], local: str, remote: str, delete: bool=False) -> Tuple[int, int, int, int]:
+    """
+    Makes a directory of the vm the same as a local directory, we only copy
+    the files which changed, on a few SFTP sessions at the same time.
+
+    :param config: Configuration dictionary of the vm.
+    :param local: The local directory.
+    :param remote: The remote directory.
+    :param delete: Also remove the remote files which are not in the local directory, and
+                   the directories they leave empty.
+    :return: (files copied, files deleted, files unchanged, bytes copied)
+    """
+    source = local_manifest(local)
+    target = remote_manifest(config, remote)
+    known = REMOTE_HASHES[POOL.key(config) + (remote,)]
+    changed = sorted(name for name, (digest, mode, mtime) in source.items() if target.get(name) != digest)
+    removed = sorted(name for name in target if name not in source) if delete else []
+    dirs = sorted(set(posixpath.dirname(name) for name in changed) - {''})
+    if dirs:
+        POOL.run(config, 'cd {0} && mkdir -p {1}'.format(shlex.quote(remote), ' '.join(shlex.quote(d) for d in dirs)))
+
+    def copy(names: List[str]) -> int:
+        size = 0
+        sftp = POOL.sftp(config)
+        try:
+            for name in names:
+                filepath = os.path.join(local, *name.split('/'))
+                digest, mode, mtime = source[name]
+                sftp.put(filepath, posixpath.join(remote, name))
+                sftp.chmod(posixpath.join(remote, name), mode)
+                # SFTP keeps whole seconds, that is the mtime the next SYNC sees
+                sftp.utime(posixpath.join(remote, name), (int(mtime), int(mtime)))
+                known[name] = (os.path.getsize(filepath), float(int(mtime)), digest)
+                size += os.path.getsize(filepath)
+        finally:
+            sftp.close()
+        return size
+
+    size = 0
+    if changed:
+        parts = [changed[i::SYNC_WORKERS] for i in range(min(SYNC_WORKERS, len(changed)))]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            size = sum(executor.map(copy, parts))
+    if removed:
+        result = POOL.run(config, 'cd {0} && rm -f {1}'.format(shlex.quote(remote),
+                                                              ' '.join(shlex.quote(name) for name in removed)))
+        if result.return_code != 0:
+            raise IOError("Can not delete in {0}: {1}".format(remote, result.text.strip()))
+        # The deepest first, rmdir keeps the ones which still have files
+        parents = set() # type: Set[str]
+        for name in removed:
+            parent = posixpath.dirname(name)
+            while parent and not os.path.isdir(os.path.join(local, *parent.split('/'))):
+                parents.add(parent)
+                parent = posixpath.dirname(parent)
+        if parents:
+            POOL.run(config, 'cd {0} && rmdir -- {1} 2>/dev/null; true'.format(
+                shlex.quote(remote), ' '.join(shlex.quote(d) for d in sorted(parents, key=lambda d: -d.count('/')))))
+    for name in removed:
+        known.pop(name, None)
+    return len(changed), len(removed), len(source) - len(changed), size
+
+
+def sync_directive(command: str, config: TunirConfig) -> Tuple[Result, float]:
+    """
+    Executes a SYNC directive, on all the given vm(s) at the same time.
+
+        SYNC ./tests vm1,vm2:/opt/tests
+        SYNC ./tests all:/opt/tests delete=yes
+
+    :param command: The directive from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (Result, seconds taken)
+    """
+    delete = False
+    match = re.search(r'\s+delete=(yes|no)\s*$', command)
+    if match:
+        delete = match.group(1) == 'yes'
+        command = command[:match.start()]
+    names, local, remote = parse_transfer(command, config)
+    if not os.path.isdir(local):
+        raise ValueError("Missing local directory {0}".format(local))
+    start = time.time()
+    lines = [] # type: List[str]
+    return_code = 0
+    workers = int(config.general.get('fanout', 16) or 16)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(names))) as executor:
+        futures = [(name, executor.submit(sync_vm, config.vms[name], local, remote.rstrip('/') or '/', delete))
+                   for name in names]
+        for name, future in futures:
+            try:
+                copied, removed, unchanged, size = future.result()
+            except (IOError, OSError, paramiko.SSHException) as err:
+                lines.append("{0}: {1}".format(name, err))
+                return_code = 1
+                continue
+            lines.append("{0}: {1} copied, {2} deleted, {3} unchanged, {4} bytes".format(
+                name, copied, removed, unchanged, size))
+    result = Result('\n'.join(lines))
+    result.return_code = return_code
+    print(result.text)
+    return result, time.time() - start
+
+
+def split_targets(command: str, config: TunirConfig) -> Tuple[List[str], str]:
+    """
+    Finds the vm(s) for a job command.
+
+    :param command: Text command from the job file.
+    :param config: TunirConfig with the vm(s).
+    :return: (vm names, command to run on the vm(s))
+    """
+    index = command.find(' ')
+    if index > 0 and is_target(command[:index], config):
+        # We have a command for multihost
+        return expand_targets(command[:index], config), command[index+1:]
+    # All special keywords are checked before, so it will run on vm1
+    return [default_vm(config)], command
+
+
+def execute_fanout(config: TunirConfig, names: List[str], command: str) -> List[Tuple[str, Result, str]]:
+    """
+    Executes the same command on many vm(s) at the same time, at most
+    fanout (from the general section, default 16) at once.
+
+    :param config: TunirConfig with the vm(s).
+    :param names: Names of the vm(s).
+    :param command: The command to execute
+    :return: List of (vm name, Output text, string) in the order of names
+    """
+    def execute_one(name: str) -> Tuple[Result, str]:
+        try:
+            return execute(config.vms[name], command)
+        except Exception as err: # One broken vm should not stop the others
+            log.error("{0}: {1}".format(name, err))
+            result = Result(str(err))
+            result.return_code = -1
+            return result, COMMAND_STATUS[parse_command(command)[0]]
+
+    workers = int(config.general.get('fanout', 16) or 16)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(names))) as executor:
+        values = list(executor.map(execute_one, names))
+    return [(name, result, negative) for name, (result, negative) in zip(names, values)]
+
+
+def update_result(result: Result, command: str, negative: str, duration: float=None,
+                  elapsed: float=None, results: Dict[str, Dict[str, str]]=None) -> bool:
     """
     Updates the result based on input.
 
@@ -245,6 +1532,9 @@ def update_result(result: Result, command: str, negative: str) -> bool:
     :param job: Job object from model.
     :param command: Text command.
     :param negative: If it is a negative command, values (yes/no).
+    :param duration: Time taken by the step in seconds, if measured.
+    :param elapsed: Wall time of the step for the run history, not written in the report.
+    :param results: Where we keep the results, STR by default.
 
     :return: Boolean, False if the job as whole is failed.
     """
@@ -258,7 +1548,11 @@ def update_result(result: Result, command: str, negative: str) -> bool:
 
     d = {'command': command, 'result': result.text,
          'ret': str(result.return_code), 'status': status} # type: Dict[str,str]
-    STR[command] = d
+    if duration is not None:
+        d['duration'] = '{0:.2f}'.format(duration)
+    if elapsed is not None:
+        d['elapsed'] = '{0:.3f}'.format(elapsed)
+    (STR if results is None else results)[command] = d
 
     if result.return_code != 0 and negative == 'no':
         # Save the error message and status as fail.
@@ -266,19 +1560,39 @@ def update_result(result: Result, command: str, negative: str) -> bool:
 
     return True
 
-def write_ip_information(user: str, key: str, config: TunirConfig) -> None:
+def write_ip_information(user: str, key: str, config: TunirConfig, path: str="./current_run_info.json") -> None:
     """
     Writes the vm information to a JSON file
     """
     data = {"user": user, "keyfile": key}
     for key in config.vms:
         data[key] = config.vms[key]["ip"]
-    with open("./current_run_info.json", "w") as fobj:
+    with open(path, "w") as fobj:
         json.dump(data, fobj)
 
 
+# Directives which run as a step in the job, each takes the directive text
+# and the TunirConfig, and returns (Result, duration).
+STEP_DIRECTIVES = {
+    'ANSIBLE': ansible_directive,
+    'PLAYBOOK': ansible_directive,
+    'BENCH': bench_directive,
+    'GET': transfer_directive,
+    'PUT': transfer_directive,
+    'SYNC': sync_directive,
+    'WAITFOR': wait_directive,
+    'WAITUNTIL': wait_directive,
+    'REBOOT': reboot_directive,
+    'SNAPSHOT': snapshot_directive,
+}  # type: Dict[str, Callable[[str, TunirConfig], Tuple[Result, float]]]
+
+# Job file keywords which are not shell commands for a vm
+DIRECTIVES = ('SLEEP', 'POLL', 'HOSTCOMMAND:', 'HOSTTEST:') + tuple(STEP_DIRECTIVES.keys())
+
+
 def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, container=None,
-            port: str='22', config: TunirConfig = None, ansible_path: str='' ) -> bool:
+            port: str='22', config: TunirConfig = None, ansible_path: str='', sampler: Sampler=None,
+            results: Dict[str, Dict[str, str]]=None) -> bool:
     """
     Runs the given command using paramiko.
 
@@ -289,6 +1603,9 @@ def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, cont
     :param port: The port number to connect in case of a vm.
     :param vms: For multihost configuration
     :param ansible_path: Path to dir with ansible details
+    :param sampler: Sampler of the vm processes, we tell it when each step starts.
+    :param results: Where we keep the results, STR by default. The jobs running at the same time
+                    need one each.
 
     :return: Status of the job in boolean
     """
@@ -314,27 +1631,54 @@ def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, cont
         else:
             private_key_path = os.path.join(ansible_path, 'private.pem')
 
-    write_ip_information( config.vms["vm1"]["user"], config.general["keypath"], config)
+    if results is None: # A fleet run writes the information of each host in the fleet directory
+        results = STR
+        write_ip_information(config.vms[default_vm(config)]["user"], config.general["keypath"], config)
     with open(jobpath) as fobj:
         commands = fobj.readlines()
+    # The setup section (before the BAKE line) may be in a baked image already
+    setup, tests = split_setup(commands)
+    section = config.general.get('job_section', '')
+    if section == 'setup':
+        commands = setup
+    elif section == 'test':
+        commands = tests
+    else:
+        commands = setup + tests
 
+    batch_size = int(config.general.get('batch', 0) or 0)  # type: int
+    nongating_workers = int(config.general.get('nongating_workers', 0) or 0)  # type: int
+    background = None # type: concurrent.futures.ThreadPoolExecutor
+    pending = [] # type: List[Tuple[str, concurrent.futures.Future]]
+    if nongating_workers:
+        background = concurrent.futures.ThreadPoolExecutor(max_workers=nongating_workers)
+    position = 0 # type: int
     try:
-        for command in commands:
+        while position < len(commands):
+            command = commands[position]
+            position += 1
             hosttest = False
+            handler = None # type: Callable[[str, TunirConfig], Tuple[Result, float]]
             cmd = ''
             negative = ''
+            duration = None # type: float
             result = Result('none') # type: Result
             command = command.strip(' \n')
             log.info("Next command: {0}".format(command))
+            if sampler and command: # SLEEP and POLL steps get their own lines too
+                sampler.mark(command)
             if command.startswith('SLEEP'): # We will have to sleep
                 word = command.split(' ')[1]
                 print("Sleeping for %s." % word)
                 time.sleep(int(word))
                 continue
-            if command.startswith("POLL"): # We will have to POLL vm1
-                #  For now we will keep polling for 300 seconds.
-                #  TODO: fix for multivm situation
-                pres = poll(config.vms['vm1'])
+            if command.startswith("POLL"): # We will have to POLL the vm(s)
+                try:
+                    pres = poll_directive(command, config)
+                except ValueError as error: # Like an unknown vm name
+                    print(error)
+                    log.error(str(error))
+                    pres = False
                 if not pres:
                     print("Final poll failed")
                     status = False
@@ -348,24 +1692,68 @@ def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, cont
             elif command.startswith('HOSTTEST:'):
                 cmd = command[10:].strip()
                 hosttest = True
+            elif command.split(' ')[0] in STEP_DIRECTIVES:
+                handler = STEP_DIRECTIVES[command.split(' ')[0]]
 
 
             print("Executing command: %s" % command)
             shell_command = command
-            if not hosttest:
-                if re.search('^vm[0-9] ', command):
-                    # We have a command for multihost
-                    index = command.find(' ')
-                    vm_name = command[:index]
-                    shell_command = command[index+1:]
-                    localconfig = config.vms[vm_name]
-                else: #At this case, all special keywords checked, now it will run on vm1
-                    vm_name = 'vm1'
-                    shell_command = command
-                    localconfig = config.vms[vm_name]
+            batch = [command] # type: List[str]
+            names = [] # type: List[str]
+            if not hosttest and not handler:
+                names, shell_command = split_targets(command, config)
+                localconfig = config.vms[names[0]]
+                if background and len(names) == 1 and shell_command.startswith('##'):
+                    # Keep the place in the report, the result comes later
+                    results[command] = {'command': command, 'result': '', 'ret': '', 'status': ''}
+                    pending.append((command, background.submit(execute_nongating, localconfig, shell_command)))
+                    continue
+                # Next plain commands for the same vm can go together in one exec
+                while len(names) == 1 and batch_size > 1 and len(batch) < batch_size and position < len(commands):
+                    next_command = commands[position].strip(' \n')
+                    if not next_command: # Nothing to run
+                        position += 1
+                        continue
+                    if next_command.startswith(DIRECTIVES):
+                        break
+                    next_names, next_shell_command = split_targets(next_command, config)
+                    if next_names != names or (background and next_shell_command.startswith('##')):
+                        break
+                    print("Executing command: %s" % next_command)
+                    if sampler: # The batch runs as one exec, what it uses goes to the last line
+                        sampler.mark(next_command)
+                    batch.append(next_command)
+                    position += 1
 
+            step_start = time.time()
             try:
-                if not hosttest:
+                if len(batch) > 1:
+                    values = execute_batch(localconfig, [split_targets(line, config)[1] for line in batch])
+                    for line, (result, negative) in zip(batch, values):
+                        # Each line gets the wall time of the whole batch
+                        status = update_result(result, line, negative, elapsed=time.time() - step_start,
+                                               results=results)
+                        if not status:
+                            break
+                    if not status:
+                        break
+                    continue
+                elif len(names) > 1:
+                    passed = 0
+                    for vm_name, result, negative in execute_fanout(config, names, shell_command):
+                        if update_result(result, "{0} {1}".format(vm_name, shell_command), negative,
+                                         elapsed=time.time() - step_start, results=results):
+                            passed += 1
+                        else:
+                            status = False
+                    print("Ran on {0} vm(s), {1} passed, {2} failed.".format(len(names), passed, len(names) - passed))
+                    if not status:
+                        break
+                    continue
+                elif handler:
+                    result, duration = handler(command, config)
+                    negative = "no"
+                elif not hosttest:
                     result, negative = execute(localconfig, shell_command)
                 else: #  This is only for HOSTTEST directive
                     out, err, eid = system(cmd)
@@ -373,7 +1761,7 @@ def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, cont
                     result.return_code = eid
                     negative = "no"
                 # From here we are following the normal flow
-                status = update_result(result, command, negative)
+                status = update_result(result, command, negative, duration, time.time() - step_start, results)
                 if not status:
                     break
             except socket.timeout: # We have a timeout in the command
@@ -395,12 +1783,18 @@ def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, cont
         # If we are here, that means all commands ran successfully.
 
     finally:
+        # Wait for the non gating commands still running in the background
+        for command, future in pending:
+            result, negative = future.result()
+            update_result(result, command, negative, results=results)
+        if background:
+            background.shutdown()
         # Now for stateless jobs
         print("\n\nJob status: %s\n\n" % status)
         nongating = {'number':0, 'pass':0, 'fail':0}
 
         with codecs.open(result_path, 'w', encoding='utf-8') as fobj:
-            for key, value in STR.items():
+            for key, value in results.items():
                 fobj.write("command: %s\n" % value['command'])
                 print("command: %s" % value['command'])
                 if value['command'].startswith((' ##', '##')):
@@ -411,6 +1805,9 @@ def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, cont
                         nongating['pass'] += 1
                 fobj.write("status: %s\n" % value['status'])
                 print("status: %s\n" % value['status'])
+                if 'duration' in value:
+                    fobj.write("duration: %s\n" % value['duration'])
+                    print("duration: %s\n" % value['duration'])
                 fobj.write(str(value['result']))
                 print(value['result'])
                 fobj.write("\n")
@@ -428,6 +1825,20 @@ def run_job(jobpath: str, job_name: str='', extra_config: Dict[str,str]={}, cont
 
             fobj.write("\n\n")
             print("\n\n")
+            for name, vm in config.vms.items():
+                if vm.get('qemu_profile'):
+                    msg = "{0} profile: {1}\n".format(name, vm['qemu_profile'])
+                    fobj.write(msg)
+                    print(msg)
+                if vm.get('boot_time'):
+                    msg = "{0} boot: {1} seconds ({2})\n".format(name, vm['boot_time'], vm.get('boot_mode', ''))
+                    fobj.write(msg)
+                    print(msg)
+            if sampler:
+                sampler.stop()
+                for line in sampler.report():
+                    fobj.write(line + '\n')
+                    print(line)
             msg = """Non gating tests status:
 Total:{number}
 Passed:{pass}
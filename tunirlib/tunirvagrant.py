@@ -164,25 +164,32 @@ end'''
         os.chdir(self.original_path)
 
     def destroy(self):
-        os.chdir(self.path)
-        print("Let us destroy the box.")
-        cmd = 'vagrant destroy -f'
-        log.info(cmd)
-        out, err, retcode = system(cmd)
-        if retcode != 0:
-            print("Error while trying to destroy the instance.")
-            print(err)
-
-        cmd = 'vagrant box remove {0} -f'.format(self.name)
-        log.info(cmd)
-        out, err, retcode = system(cmd)
-        if retcode != 0:
-            print("Error while trying to remove the box.")
-            print(err)
-
-        if self.provider == 'libvirt':
-            refresh_vol_pool() # Remove libvirt cache
-        os.chdir(self.original_path)
+        destroy_box(self.path, self.name, self.provider)
+
+
+def destroy_box(path, name, provider='libvirt'):
+    # type: (str, str, str) -> None
+    "Destroys the Vagrant box running from the given path, and removes it"
+    original_path = os.path.abspath(os.path.curdir)
+    os.chdir(path)
+    print("Let us destroy the box.")
+    cmd = 'vagrant destroy -f'
+    log.info(cmd)
+    out, err, retcode = system(cmd)
+    if retcode != 0:
+        print("Error while trying to destroy the instance.")
+        print(err)
+
+    cmd = 'vagrant box remove {0} -f'.format(name)
+    log.info(cmd)
+    out, err, retcode = system(cmd)
+    if retcode != 0:
+        print("Error while trying to remove the box.")
+        print(err)
+
+    if provider == 'libvirt':
+        refresh_vol_pool() # Remove libvirt cache
+    os.chdir(original_path)
 
 def vagrant_and_run(config, path='/var/run/tunir/'):
     """